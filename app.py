@@ -2,19 +2,26 @@
 # Description: Flask backend application for the CaddyPanel interface.
 # ... (rest of initial comments and imports) ...
 
+import gzip
 import json
 import os
 import re 
 import subprocess
+import threading
 from pathlib import Path
 from functools import wraps
 from flask import (Flask, render_template, url_for, request, jsonify, abort,
-                   session, redirect, flash)
+                   session, redirect, flash, Response)
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, timezone
 import secrets
 import stats_aggregator
 
+try:  # Optional (requirements-optional.txt): brotli for JSON responses, else gzip
+    import brotli
+except ImportError:
+    brotli = None
+
 # --- Configuration ---
 # ... (unchanged)
 APP_DATA_DIR = Path(os.environ.get('APP_DATA_DIR', '.')).resolve() 
@@ -22,6 +29,11 @@ CADDY_CONFIG_FILE = Path(os.environ.get('CADDY_CONFIG', os.environ.get('CADDY_CO
 CADDY_ACCESS_LOG_FILE = Path(os.environ.get('CADDY_ACCESS_LOG_FILE', '/var/log/caddy_panel/caddy_access.json.log'))
 
 STATS_DB_PATH = APP_DATA_DIR / 'stats.db'
+JSON_COMPRESS_MIN_BYTES = 1024  # smaller JSON responses are sent uncompressed
+# Open /api/stats/stream responses per worker process; keep it below gunicorn's
+# --threads so the other requests of the worker always find a thread.
+LIVE_STREAMS_PER_WORKER = 8
+LIVE_STREAM_SEND_TIMEOUT_SECONDS = 30  # a client that reads nothing for this long is dropped
 PREFERENCES_FILE = APP_DATA_DIR / 'preferences.json'
 USERS_FILE = APP_DATA_DIR / 'users.json'
 BASE_DIR = Path('.').resolve() 
@@ -528,11 +540,61 @@ def reload_caddy_config():
 # --- Real Log Data Processing for Stats Page ---
 # --- Stats Routes (backed by stats_aggregator) ---
 
+@app.after_request
+def compress_json(response):
+    """Compress JSON responses of JSON_COMPRESS_MIN_BYTES or more (brotli if
+    installed and accepted, else gzip): gunicorn serves the panel directly, with
+    no reverse proxy to do it."""
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or not 200 <= response.status_code < 300):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < JSON_COMPRESS_MIN_BYTES:
+        return response
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _stats_etag():
+    """(ETag, 304 response or None) of a stats API request. The ETag covers the
+    path, the arguments and stats.db's generation file, so answering a client
+    that is up to date opens no SQLite connection. (None, None) without one."""
+    etag = stats_aggregator.stats_etag(request.path, sorted(request.args.items(multi=True)))
+    if etag and request.if_none_match.contains_weak(etag):
+        return etag, _with_etag(app.response_class(status=304), etag)
+    return etag, None
+
+
+def _with_etag(response, etag):
+    # Weak: the same JSON may be sent gzipped, brotli-compressed or plain.
+    if etag:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.route('/stats')
 @login_required
 def stats_page():
     return render_template('stats.html', username=session.get('username'))
 
+def _stats_range_args():
+    """(start, end, step) of a stats request: ?from=&to= (ISO 8601 or epoch
+    seconds) instead of a period, ?step= (1h, 6h, 1d, 1w) for either. None when
+    absent. Raises ValueError."""
+    return tuple(
+        parse(request.args[name]) if request.args.get(name) else None
+        for name, parse in (('from', stats_aggregator.parse_time_arg),
+                            ('to', stats_aggregator.parse_time_arg),
+                            ('step', stats_aggregator.parse_step_arg))
+    )
+
 @app.route('/api/stats')
 @login_required
 def get_stats():
@@ -541,26 +603,33 @@ def get_stats():
     host = request.args.get('host', None)
     if host:
         host = unquote(host)
-
-    # Process any new log entries incrementally
     try:
-        stats_aggregator.process_new_logs(app.config['CADDY_ACCESS_LOG_FILE'])
-    except Exception as e:
-        print(f"Error processing new logs: {e}")
+        start, end, step = _stats_range_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    etag, not_modified = _stats_etag()
+    if not_modified:
+        return not_modified
 
-    # Run rollup (throttled internally to once every 6 hours)
-    try:
-        stats_aggregator.rollup_old_buckets()
-    except Exception as e:
-        print(f"Error during stats rollup: {e}")
+    # Log ingestion and rollup run in the separate stats ingester process
+    # (python -m stats_aggregator run); this endpoint only reads stats.db.
 
     # Get aggregated stats for the requested period/host
     try:
-        stats_data = stats_aggregator.get_stats(period, host)
+        stats_data = stats_aggregator.get_stats(period, host, start, end, step)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error getting stats: {e}")
         stats_data = stats_aggregator._empty_stats(period, host)
         stats_data["log_read_error"] = f"Server error retrieving stats: {e}"
+        etag = None  # not worth revalidating
+
+    try:
+        stats_data["ingest"] = stats_aggregator.get_ingest_status(app.config['CADDY_ACCESS_LOG_FILE'])
+    except Exception as e:
+        print(f"Error getting ingest status: {e}")
+        stats_data["ingest"] = None
 
     # If no data at all, try auto-configuring Caddy logging
     if not stats_data["log_read_error"] and not stats_aggregator.has_data():
@@ -584,25 +653,131 @@ def get_stats():
                 f"Log file {app.config['CADDY_ACCESS_LOG_FILE']} not found. "
                 "Configure Caddy for JSON logging to stdout."
             )
+        elif not logging_configured and stats_data["ingest"] and not stats_data["ingest"]["ingester_running"]:
+            stats_data["log_read_error"] = (
+                "The stats ingester is not running. "
+                "Start it with: python -m stats_aggregator run"
+            )
         elif not logging_configured and stats_data["total_requests"] == 0:
             stats_data["log_read_error"] = (
                 "No processable log entries found. "
                 "Check that Caddy is configured for JSON logging."
             )
 
-    return jsonify(stats_data)
+    return _with_etag(jsonify(stats_data), etag)
+
+
+@app.route('/api/stats/compare')
+@login_required
+def get_stats_compare():
+    """Several hosts side by side (?hosts=a,b,c, default the 10 busiest) over a
+    ?period= or ?from=&to=, with ?step=, from one scan instead of one
+    /api/stats request per host."""
+    from urllib.parse import unquote
+    hosts = request.args.get('hosts', '')
+    hosts = [unquote(h.strip()) for h in hosts.split(',') if h.strip()] or None
+    etag, not_modified = _stats_etag()
+    if not_modified:
+        return not_modified
+    try:
+        start, end, step = _stats_range_args()
+        comparison = stats_aggregator.compare_hosts(hosts, request.args.get('period', '7d'), start, end, step)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error comparing hosts: {e}")
+        return jsonify({"error": f"Server error comparing hosts: {e}"}), 500
+    return _with_etag(jsonify(comparison), etag)
+
+
+@app.route('/api/stats/live')
+@login_required
+def get_stats_live():
+    """Per-minute stats of the last hour (?minutes= up to 180), served from the
+    ingester's live ring without querying stats.db."""
+    from urllib.parse import unquote
+    host = request.args.get('host', None)
+    if host:
+        host = unquote(host)
+    minutes = request.args.get('minutes', 60, type=int)
+    try:
+        live = stats_aggregator.get_live_stats(host, minutes)
+    except Exception as e:
+        print(f"Error getting live stats: {e}")
+        return jsonify({"error": f"Server error retrieving live stats: {e}"}), 500
+    if live is None:
+        return jsonify({"error": "No live data yet. Is the stats ingester running?"}), 503
+    return jsonify(live)
+
+
+_live_streams = threading.BoundedSemaphore(LIVE_STREAMS_PER_WORKER)
+
+@app.route('/api/stats/stream')
+@login_required
+def get_stats_stream():
+    """Server-Sent Events: a 'delta' event with the requests, status classes,
+    bytes and latency of every host (or ?host=) after each ingest commit that
+    added entries, so open dashboards update in place instead of refetching
+    /api/stats. Served from the live ring, like /api/stats/live.
+
+    Each stream holds a gunicorn thread (gthread workers, see supervisord.conf)
+    for up to stats_aggregator.LIVE_STREAM_MAX_SECONDS; past
+    LIVE_STREAMS_PER_WORKER open streams the worker answers 503."""
+    from urllib.parse import unquote
+    host = request.args.get('host', None)
+    if host:
+        host = unquote(host)
+    if not _live_streams.acquire(blocking=False):
+        return jsonify({"error": "Too many open live streams."}), 503, {'Retry-After': '30'}
+    sock = request.environ.get('gunicorn.socket')
+    previous_timeout = sock.gettimeout() if sock is not None else None
+
+    def close():
+        # The keep-alive connection outlives the stream: give it its timeout back
+        try:
+            if sock is not None:
+                sock.settimeout(previous_timeout)
+        except OSError:
+            pass
+        finally:
+            _live_streams.release()
+
+    def events():
+        yield 'retry: 5000\n\n'
+        try:
+            for seq, delta in stats_aggregator.stream_live_deltas(host):
+                if delta is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield f"id: {seq}\nevent: delta\ndata: {json.dumps(delta, separators=(',', ':'))}\n\n"
+        except Exception as e:
+            print(f"Error streaming live stats: {e}")
+
+    try:
+        if sock is not None:
+            sock.settimeout(LIVE_STREAM_SEND_TIMEOUT_SECONDS)
+        response = Response(events(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(close)
+    except BaseException:
+        close()  # no response to release the slot when it is closed
+        raise
+    return response
 
 
 @app.route('/api/stats/hosts')
 @login_required
 def get_stats_hosts():
     """Return the list of hosts that have stats data."""
+    etag, not_modified = _stats_etag()
+    if not_modified:
+        return not_modified
     try:
         hosts = stats_aggregator.get_available_hosts()
     except Exception as e:
         print(f"Error getting available hosts: {e}")
-        hosts = []
-    return jsonify(hosts)
+        return jsonify([])
+    return _with_etag(jsonify(hosts), etag)
 
 # --- Helper functions for Caddyfile parsing ---
 
@@ -804,4 +979,14 @@ if __name__ == '__main__':
         print(f"Dev: Creating default preferences file at {PREFERENCES_FILE}")
         save_preferences(DEFAULT_PREFERENCES) 
 
+    # Dev server has no supervisord: run the stats ingester in a background thread
+    # (only in the reloader child, so it is not started twice).
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(
+            target=stats_aggregator.run_ingester,
+            args=(CADDY_ACCESS_LOG_FILE,),
+            kwargs={'geoip_db_path': GEOIP_DB_PATH},
+            daemon=True,
+        ).start()
+
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('FLASK_PORT', 5000)))
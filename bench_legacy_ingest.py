@@ -0,0 +1,419 @@
+"""
+Ingest path of stats_aggregator.py before checkpoints were batched, for
+bench_stats.py upserts to measure against.
+
+Copied verbatim from stats_aggregator.py at the repository's first commit
+(git show 1d3a19d:stats_aggregator.py): process_new_logs() and what it calls,
+with init_stats_db() for the schema it writes. Not used by the panel; do not
+fix or restyle it, it is the baseline.
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+from datetime import datetime, timezone
+
+
+def _parse_ts(ts_value):
+    """Parse a Caddy log timestamp to a Unix epoch float.
+    Accepts:
+      - numeric (int/float): used directly as epoch
+      - string: RFC3339 / ISO 8601 format (e.g. '2024-01-15T10:30:00Z')
+    Returns 0.0 if the value cannot be parsed."""
+    if isinstance(ts_value, (int, float)):
+        return float(ts_value) if ts_value > 0 else 0.0
+    if isinstance(ts_value, str) and ts_value:
+        try:
+            # Try ISO 8601 / RFC3339
+            # Python 3.7+ supports datetime.fromisoformat for most formats
+            s = ts_value.replace('Z', '+00:00')
+            dt = datetime.fromisoformat(s)
+            return dt.timestamp()
+        except (ValueError, OverflowError):
+            pass
+    return 0.0
+
+
+# --- Optional GeoIP ---
+_geoip_reader = None
+
+
+def _resolve_country(ip_str):
+    """Resolve an IP address string to an ISO 3166-1 alpha-2 country code.
+    Returns 'Unknown' if GeoIP is not configured or resolution fails."""
+    if not _geoip_reader or not ip_str:
+        return 'Unknown'
+    try:
+        resp = _geoip_reader.country(ip_str)
+        return resp.country.iso_code or 'Unknown'
+    except Exception:
+        return 'Unknown'
+
+
+_db_path = None
+
+VALID_PERIODS = ('24h', '7d', '30d', '90d', '1y')
+HOURLY_RETENTION_DAYS = 7
+DAILY_RETENTION_DAYS = 365
+MAX_INITIAL_LINES = 500000
+MAX_INITIAL_BYTES = 50 * 1024 * 1024  # 50 MB
+TOP_N_PATHS = 20
+TOP_N_UAS = 10
+TOP_N_COUNTRIES = 20
+
+
+def init_stats_db(db_path):
+    """Initialize the stats database. Create tables if they don't exist.
+    Must be called before any other function."""
+    global _db_path
+    _db_path = str(db_path)
+
+    conn = sqlite3.connect(_db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS hourly_stats (
+            bucket_hour TEXT NOT NULL,
+            host TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            status_1xx INTEGER DEFAULT 0,
+            status_2xx INTEGER DEFAULT 0,
+            status_3xx INTEGER DEFAULT 0,
+            status_4xx INTEGER DEFAULT 0,
+            status_5xx INTEGER DEFAULT 0,
+            total_duration REAL DEFAULT 0,
+            total_size INTEGER DEFAULT 0,
+            error_count INTEGER DEFAULT 0,
+            top_paths TEXT DEFAULT '{}',
+            top_uas TEXT DEFAULT '{}',
+            top_countries TEXT DEFAULT '{}',
+            PRIMARY KEY (bucket_hour, host)
+        );
+
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            bucket_date TEXT NOT NULL,
+            host TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            status_1xx INTEGER DEFAULT 0,
+            status_2xx INTEGER DEFAULT 0,
+            status_3xx INTEGER DEFAULT 0,
+            status_4xx INTEGER DEFAULT 0,
+            status_5xx INTEGER DEFAULT 0,
+            total_duration REAL DEFAULT 0,
+            total_size INTEGER DEFAULT 0,
+            error_count INTEGER DEFAULT 0,
+            top_paths TEXT DEFAULT '{}',
+            top_uas TEXT DEFAULT '{}',
+            top_countries TEXT DEFAULT '{}',
+            PRIMARY KEY (bucket_date, host)
+        );
+
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_hourly_hour ON hourly_stats(bucket_hour);
+        CREATE INDEX IF NOT EXISTS idx_daily_date ON daily_stats(bucket_date);
+    """)
+    conn.commit()
+
+    # Migration: add top_countries column to existing tables
+    for table in ('hourly_stats', 'daily_stats'):
+        try:
+            cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+            if 'top_countries' not in cols:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN top_countries TEXT DEFAULT '{{}}'")
+                print(f"Stats DB migration: added top_countries to {table}")
+        except Exception as e:
+            print(f"Stats DB migration check for {table}: {e}")
+
+    conn.close()
+
+
+def _get_conn(timeout=10):
+    """Get a connection to the stats database."""
+    if _db_path is None:
+        raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
+    return sqlite3.connect(_db_path, timeout=timeout)
+
+
+def _top_n_from_dict(d, n):
+    """Keep top N items from a dict by value, return as sorted dict."""
+    if not d:
+        return {}
+    return dict(sorted(d.items(), key=lambda x: x[1], reverse=True)[:n])
+
+
+def _merge_top_json(existing_json, new_counts, n):
+    """Merge new count dict into an existing JSON top-N dict.
+
+    existing_json: str (JSON dict like {"path": count, ...})
+    new_counts: dict ({"path": count, ...})
+    n: keep top N entries after merge
+
+    Returns: str (JSON dict)
+    """
+    merged = {}
+    if existing_json:
+        try:
+            merged = json.loads(existing_json)
+        except (json.JSONDecodeError, TypeError):
+            merged = {}
+    for k, v in new_counts.items():
+        merged[k] = merged.get(k, 0) + v
+    return json.dumps(_top_n_from_dict(merged, n))
+
+
+def process_new_logs(log_file_path):
+    """Process new Caddy access log entries since last processing.
+
+    Uses byte offset tracking for efficiency. On first run (no offset stored),
+    reads only the tail of the log file to avoid processing huge history.
+
+    Returns the number of new entries processed.
+    """
+    if _db_path is None:
+        return 0
+
+    log_path = Path(log_file_path) if not isinstance(log_file_path, Path) else log_file_path
+    if not log_path.exists():
+        return 0
+
+    current_size = log_path.stat().st_size
+
+    conn = _get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+
+    # Read last processed state
+    last_ts = 0.0
+    last_offset = 0
+    row = conn.execute("SELECT value FROM meta WHERE key = 'last_processed_ts'").fetchone()
+    if row:
+        try:
+            last_ts = float(row[0])
+        except (ValueError, TypeError):
+            pass
+    row = conn.execute("SELECT value FROM meta WHERE key = 'last_processed_offset'").fetchone()
+    if row:
+        try:
+            last_offset = int(row[0])
+        except (ValueError, TypeError):
+            pass
+
+    # Detect log rotation (file got smaller than our last offset)
+    if current_size < last_offset:
+        last_offset = 0
+        last_ts = 0.0
+
+    if current_size <= last_offset:
+        conn.execute("ROLLBACK")
+        conn.close()
+        return 0
+
+    # Read new log entries
+    new_entries = []
+    max_ts = last_ts
+    new_offset = last_offset
+    is_first_run = (last_offset == 0 and last_ts == 0.0)
+
+    try:
+        with open(log_path, 'r', encoding='utf-8') as f:
+            if is_first_run:
+                # First run: seek near end of file to avoid reading huge history
+                if current_size > MAX_INITIAL_BYTES:
+                    f.seek(current_size - MAX_INITIAL_BYTES)
+                    f.readline()  # discard partial first line
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if len(new_entries) >= MAX_INITIAL_LINES:
+                        break
+                    try:
+                        entry = json.loads(line)
+                        ts = _parse_ts(entry.get('ts', 0))
+                        if ts > 0:
+                            entry['_ts_epoch'] = ts
+                            new_entries.append(entry)
+                            max_ts = max(max_ts, ts)
+                    except (json.JSONDecodeError, ValueError):
+                        continue
+                new_offset = f.tell()
+            else:
+                # Subsequent runs: read from last offset
+                f.seek(last_offset)
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        ts = _parse_ts(entry.get('ts', 0))
+                        if ts > 0:
+                            entry['_ts_epoch'] = ts
+                            new_entries.append(entry)
+                            max_ts = max(max_ts, ts)
+                    except (json.JSONDecodeError, ValueError):
+                        continue
+                new_offset = f.tell()
+    except IOError as e:
+        print(f"Error reading log file {log_path}: {e}")
+        conn.execute("ROLLBACK")
+        conn.close()
+        return 0
+
+    if not new_entries:
+        # No new processable entries, update offset anyway
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_offset', ?)",
+            (str(new_offset),),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_file_size', ?)",
+            (str(current_size),),
+        )
+        conn.commit()
+        conn.close()
+        return 0
+
+    # Aggregate new entries by (bucket_hour, host)
+    buckets = {}
+    for entry in new_entries:
+        ts = entry.get('_ts_epoch', _parse_ts(entry.get('ts', 0)))
+        dt = datetime.fromtimestamp(ts, tz=timezone.utc)
+        bucket_hour = dt.strftime('%Y-%m-%dT%H')
+
+        request = entry.get('request', {})
+        if not isinstance(request, dict):
+            request = {}
+        host = request.get('host', entry.get('host', 'Unknown'))
+        status = int(entry.get('status', 0))
+        duration = float(entry.get('duration', 0))
+        size = int(entry.get('size', 0))
+
+        uri = request.get('uri', '/')
+        path = uri.split('?')[0] if isinstance(uri, str) and uri else '/'
+
+        headers = request.get('headers', {})
+        if not isinstance(headers, dict):
+            headers = {}
+        ua_list = headers.get('User-Agent', ['Unknown'])
+        if not isinstance(ua_list, list):
+            ua_list = ['Unknown']
+        ua_full = ua_list[0] if ua_list else 'Unknown'
+        ua_simple = ua_full.split('/')[0].split('(')[0].strip() or 'Unknown'
+
+        key = (bucket_hour, host)
+        if key not in buckets:
+            buckets[key] = {
+                'total': 0, 'status_1xx': 0, 'status_2xx': 0, 'status_3xx': 0,
+                'status_4xx': 0, 'status_5xx': 0, 'total_duration': 0.0,
+                'total_size': 0, 'error_count': 0,
+                'top_paths': {}, 'top_uas': {}, 'top_countries': {},
+            }
+
+        b = buckets[key]
+        b['total'] += 1
+        if 100 <= status <= 199:
+            b['status_1xx'] += 1
+        elif 200 <= status <= 299:
+            b['status_2xx'] += 1
+        elif 300 <= status <= 399:
+            b['status_3xx'] += 1
+        elif 400 <= status <= 499:
+            b['status_4xx'] += 1
+        elif 500 <= status <= 599:
+            b['status_5xx'] += 1
+            b['error_count'] += 1
+        b['total_duration'] += duration
+        b['total_size'] += size
+        b['top_paths'][path] = b['top_paths'].get(path, 0) + 1
+        b['top_uas'][ua_simple] = b['top_uas'].get(ua_simple, 0) + 1
+
+        # GeoIP: resolve client IP to country
+        client_ip = request.get('remote_ip', request.get('client_ip', ''))
+        if not client_ip and isinstance(headers, dict):
+            # Fallback: check X-Forwarded-For or X-Real-IP headers
+            xff = headers.get('X-Forwarded-For', [])
+            if xff and isinstance(xff, list) and xff[0]:
+                client_ip = xff[0].split(',')[0].strip()
+            else:
+                xri = headers.get('X-Real-Ip', [])
+                if xri and isinstance(xri, list) and xri[0]:
+                    client_ip = xri[0]
+        country = _resolve_country(client_ip)
+        if country != 'Unknown':
+            b['top_countries'][country] = b['top_countries'].get(country, 0) + 1
+
+    # Truncate top paths/UAs/countries per bucket to limit stored size
+    for b in buckets.values():
+        b['top_paths'] = _top_n_from_dict(b['top_paths'], TOP_N_PATHS)
+        b['top_uas'] = _top_n_from_dict(b['top_uas'], TOP_N_UAS)
+        b['top_countries'] = _top_n_from_dict(b['top_countries'], TOP_N_COUNTRIES)
+
+    # Upsert into hourly_stats
+    for (bucket_hour, host), data in buckets.items():
+        existing = conn.execute(
+            "SELECT top_paths, top_uas, top_countries FROM hourly_stats WHERE bucket_hour = ? AND host = ?",
+            (bucket_hour, host),
+        ).fetchone()
+
+        if existing:
+            merged_paths = _merge_top_json(existing[0], data['top_paths'], TOP_N_PATHS)
+            merged_uas = _merge_top_json(existing[1], data['top_uas'], TOP_N_UAS)
+            merged_countries = _merge_top_json(existing[2], data['top_countries'], TOP_N_COUNTRIES)
+
+            conn.execute(
+                """UPDATE hourly_stats SET
+                    total = total + ?, status_1xx = status_1xx + ?,
+                    status_2xx = status_2xx + ?, status_3xx = status_3xx + ?,
+                    status_4xx = status_4xx + ?, status_5xx = status_5xx + ?,
+                    total_duration = total_duration + ?, total_size = total_size + ?,
+                    error_count = error_count + ?, top_paths = ?, top_uas = ?,
+                    top_countries = ?
+                WHERE bucket_hour = ? AND host = ?""",
+                (
+                    data['total'], data['status_1xx'], data['status_2xx'],
+                    data['status_3xx'], data['status_4xx'], data['status_5xx'],
+                    data['total_duration'], data['total_size'], data['error_count'],
+                    merged_paths, merged_uas, merged_countries, bucket_hour, host,
+                ),
+            )
+        else:
+            conn.execute(
+                """INSERT INTO hourly_stats
+                    (bucket_hour, host, total, status_1xx, status_2xx,
+                     status_3xx, status_4xx, status_5xx, total_duration,
+                     total_size, error_count, top_paths, top_uas, top_countries)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    bucket_hour, host, data['total'], data['status_1xx'],
+                    data['status_2xx'], data['status_3xx'], data['status_4xx'],
+                    data['status_5xx'], data['total_duration'], data['total_size'],
+                    data['error_count'],
+                    json.dumps(data['top_paths']),
+                    json.dumps(data['top_uas']),
+                    json.dumps(data['top_countries']),
+                ),
+            )
+
+    # Update meta
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_ts', ?)",
+        (str(max_ts),),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_offset', ?)",
+        (str(new_offset),),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_file_size', ?)",
+        (str(current_size),),
+    )
+
+    conn.commit()
+    conn.close()
+
+    print(f"Stats: processed {len(new_entries)} new log entries.")
+    return len(new_entries)
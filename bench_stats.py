@@ -0,0 +1,693 @@
+"""
+CaddyPanel stats benchmarks
+
+Micro-benchmarks for the hot paths of stats_aggregator, run on a synthetic
+but realistic Caddy JSON access log: full request headers, TLS connection
+info and response headers, the way `log { format json }` writes them.
+
+Usage:
+    python bench_stats.py decoder [--lines N] [--sample FILE]
+    python bench_stats.py timestamps [--lines N]
+    python bench_stats.py upserts [--lines N] [--hosts N]  (write lock held by one ingest, vs the original)
+    python bench_stats.py query [--hosts N]     (also: stats.db size, text vs integer keys)
+    python bench_stats.py request [--hosts N]   (stats.db overhead of one /api/stats request)
+    python bench_stats.py topn
+
+--sample replays lines from a real caddy_access.json.log instead of the
+synthetic ones.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time as time_module
+from datetime import datetime, timedelta, timezone
+
+import stats_aggregator
+from stats_sketches import HyperLogLog, LatencyHistogram, SpaceSaving
+
+_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "curl/8.5.0",
+    "Go-http-client/2.0",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Uptime-Kuma/1.23.11",
+]
+_PATHS = ["/", "/index.html", "/api/v1/items", "/api/v1/items/42", "/static/app.js", "/static/style.css",
+          "/favicon.ico", "/login", "/robots.txt", "/.well-known/acme-challenge/x", "/wp-login.php"]
+_STATUSES = [200] * 30 + [204, 301, 302, 304, 304, 401, 403, 404, 404, 500, 502]
+
+
+def make_log_line(rnd, ts, hosts=40):
+    """One Caddy access log line (bytes, newline included)."""
+    host = f"app{rnd.randrange(hosts)}.example.com"
+    ip = f"{rnd.randint(1, 223)}.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randint(1, 254)}"
+    uri = rnd.choice(_PATHS)
+    if rnd.random() < 0.3:
+        uri += f"?page={rnd.randrange(50)}&sort=desc"
+    headers = {
+        "User-Agent": [rnd.choice(_USER_AGENTS)],
+        "Accept": ["text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"],
+        "Accept-Encoding": ["gzip, deflate, br, zstd"],
+        "Accept-Language": ["en-US,en;q=0.9,fr;q=0.8"],
+        "Sec-Fetch-Mode": ["navigate"],
+        "Sec-Fetch-Site": ["none"],
+        "Cookie": [f"session={rnd.getrandbits(128):032x}; theme=dark"],
+    }
+    if rnd.random() < 0.2:
+        headers["X-Forwarded-For"] = [f"{ip}, 10.0.0.{rnd.randint(1, 254)}"]
+    entry = {
+        "level": "info",
+        "ts": ts,
+        "logger": "http.log.access.log0",
+        "msg": "handled request",
+        "request": {
+            "remote_ip": ip,
+            "remote_port": str(rnd.randint(1024, 65535)),
+            "client_ip": ip,
+            "proto": "HTTP/2.0",
+            "method": "GET",
+            "host": host,
+            "uri": uri,
+            "headers": headers,
+            "tls": {
+                "resumed": False,
+                "version": 772,
+                "cipher_suite": 4865,
+                "proto": "h2",
+                "server_name": host,
+            },
+        },
+        "bytes_read": 0,
+        "user_id": "",
+        "duration": rnd.expovariate(40),
+        "size": rnd.randint(0, 250000),
+        "status": rnd.choice(_STATUSES),
+        "resp_headers": {
+            "Server": ["Caddy"],
+            "Alt-Svc": ['h3=":443"; ma=2592000'],
+            "Content-Type": ["text/html; charset=utf-8"],
+            "Date": ["Mon, 15 Apr 2024 10:30:00 GMT"],
+            "Strict-Transport-Security": ["max-age=31536000;"],
+        },
+    }
+    return (json.dumps(entry, separators=(',', ':')) + "\n").encode()
+
+
+def make_sample(n, span_seconds=7 * 86400, seed=42, hosts=40):
+    """n log lines spread evenly over the last `span_seconds`."""
+    rnd = random.Random(seed)
+    start = time_module.time() - span_seconds
+    return [make_log_line(rnd, start + span_seconds * i / n, hosts) for i in range(n)]
+
+
+def load_sample(path, n):
+    """Up to n complete lines from a real access log."""
+    lines = []
+    with open(path, 'rb') as f:
+        for raw in f:
+            if raw.endswith(b'\n') and raw.strip():
+                lines.append(raw)
+                if len(lines) >= n:
+                    break
+    return lines
+
+
+def _timeit(fn, repeat=3):
+    """Best wall time of `repeat` runs of fn()."""
+    best = None
+    for _ in range(repeat):
+        t0 = time_module.perf_counter()
+        fn()
+        elapsed = time_module.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _report(rows):
+    width = max(len(r[0]) for r in rows)
+    for label, value in rows:
+        print(f"  {label:<{width}}  {value}")
+
+
+def bench_decoder(lines):
+    """Lines/sec for each installed decoder backend."""
+    size_mb = sum(len(l) for l in lines) / 1024 / 1024
+    print(f"Decoder: {len(lines)} lines, {size_mb:.1f} MB, avg {size_mb * 1024 * 1024 / len(lines):.0f} bytes/line")
+    rows = []
+    for name in stats_aggregator.DECODER_BACKENDS:
+        try:
+            _, decode = stats_aggregator.get_decoder(name)
+        except ImportError:
+            rows.append((name, "not installed"))
+            continue
+
+        def run():
+            for raw in lines:
+                decode(raw)
+
+        elapsed = _timeit(run)
+        rows.append((name, f"{len(lines) / elapsed:>12,.0f} lines/s  ({size_mb / elapsed:.0f} MB/s)"))
+    _report(rows)
+
+
+def _legacy_parse_ts(ts_value):
+    """The timestamp parser before the integer bucket path, for comparison."""
+    if isinstance(ts_value, (int, float)):
+        return float(ts_value) if ts_value > 0 else 0.0
+    if isinstance(ts_value, str) and ts_value:
+        try:
+            return datetime.fromisoformat(ts_value.replace('Z', '+00:00')).timestamp()
+        except (ValueError, OverflowError):
+            pass
+    return 0.0
+
+
+def bench_timestamps(n):
+    """Timestamp -> hourly bucket key, per line: legacy datetime path ('%Y-%m-%dT%H'
+    string) vs integer path (epoch hour)."""
+    rnd = random.Random(7)
+    start = time_module.time() - 7 * 86400
+    epochs = sorted(start + rnd.random() * 7 * 86400 for _ in range(n))
+    tz = timezone(timedelta(hours=2))
+    # RFC3339 strings as Caddy writes them with time_format iso8601 / rfc3339.
+    # Microsecond precision so the legacy fromisoformat() can parse them on 3.10.
+    strings = [datetime.fromtimestamp(e, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ') for e in epochs]
+    strings_offset = [datetime.fromtimestamp(e, tz=tz).isoformat() for e in epochs]
+
+    def legacy(values):
+        for v in values:
+            ts = _legacy_parse_ts(v)
+            datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%dT%H')
+
+    def current(values):
+        parse = stats_aggregator._parse_ts
+        for v in values:
+            int(parse(v)) // 3600
+
+    for values in (epochs, strings, strings_offset):
+        for v in values[:1000]:
+            assert int(stats_aggregator._parse_ts(v)) // 3600 == int(_legacy_parse_ts(v)) // 3600
+
+    print(f"Timestamps: {n} values -> hourly bucket key")
+    rows = []
+    for label, values in (("epoch float", epochs), ("RFC3339 Z", strings), ("RFC3339 +02:00", strings_offset)):
+        t_legacy = _timeit(lambda: legacy(values))
+        t_current = _timeit(lambda: current(values))
+        rows.append((label, f"legacy {n / t_legacy:>12,.0f}/s   integer path {n / t_current:>12,.0f}/s"
+                            f"   x{t_legacy / t_current:.1f}"))
+    _report(rows)
+
+
+# stats.db before integer keys: text bucket keys and the host name in every row
+# (top-N JSON columns only filled by the per-key flush below).
+_TEXT_LAYOUT_DDL = """
+    CREATE TABLE hourly_stats (
+        bucket_hour TEXT NOT NULL, host TEXT NOT NULL,
+        total INTEGER DEFAULT 0, status_1xx INTEGER DEFAULT 0, status_2xx INTEGER DEFAULT 0,
+        status_3xx INTEGER DEFAULT 0, status_4xx INTEGER DEFAULT 0, status_5xx INTEGER DEFAULT 0,
+        total_duration REAL DEFAULT 0, total_size INTEGER DEFAULT 0, error_count INTEGER DEFAULT 0,
+        top_paths TEXT DEFAULT '{}', top_uas TEXT DEFAULT '{}', top_countries TEXT DEFAULT '{}',
+        visitors BLOB, latency BLOB,
+        PRIMARY KEY (bucket_hour, host)
+    );
+    CREATE TABLE daily_stats (
+        bucket_date TEXT NOT NULL, host TEXT NOT NULL,
+        total INTEGER DEFAULT 0, status_1xx INTEGER DEFAULT 0, status_2xx INTEGER DEFAULT 0,
+        status_3xx INTEGER DEFAULT 0, status_4xx INTEGER DEFAULT 0, status_5xx INTEGER DEFAULT 0,
+        total_duration REAL DEFAULT 0, total_size INTEGER DEFAULT 0, error_count INTEGER DEFAULT 0,
+        top_paths TEXT DEFAULT '{}', top_uas TEXT DEFAULT '{}', top_countries TEXT DEFAULT '{}',
+        visitors BLOB, latency BLOB,
+        PRIMARY KEY (bucket_date, host)
+    );
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE ingested_ranges (
+        fingerprint TEXT NOT NULL, start_offset INTEGER NOT NULL, end_offset INTEGER NOT NULL,
+        PRIMARY KEY (fingerprint, start_offset)
+    );
+    CREATE TABLE top_keys (key_id INTEGER PRIMARY KEY, dim INTEGER NOT NULL, key TEXT NOT NULL, UNIQUE (dim, key));
+    CREATE TABLE hourly_top (
+        bucket_hour TEXT NOT NULL, host TEXT NOT NULL, dim INTEGER NOT NULL, key_id INTEGER NOT NULL,
+        count INTEGER NOT NULL, err INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (host, dim, bucket_hour, key_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE daily_top (
+        bucket_date TEXT NOT NULL, host TEXT NOT NULL, dim INTEGER NOT NULL, key_id INTEGER NOT NULL,
+        count INTEGER NOT NULL, err INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (host, dim, bucket_date, key_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_hourly_hour ON hourly_stats(bucket_hour);
+    CREATE INDEX idx_daily_date ON daily_stats(bucket_date);
+"""
+
+
+class _LockTimer(sqlite3.Connection):
+    """Connection that records how long each BEGIN IMMEDIATE..COMMIT held the write lock."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.locked = 0.0
+        self.longest = 0.0
+        self._begin = None
+
+    def execute(self, sql, *args):
+        if sql.startswith("BEGIN IMMEDIATE"):
+            self._begin = time_module.perf_counter()
+        return super().execute(sql, *args)
+
+    def commit(self):
+        super().commit()
+        if self._begin is not None:
+            held = time_module.perf_counter() - self._begin
+            self.locked += held
+            self.longest = max(self.longest, held)
+            self._begin = None
+
+
+_COUNTERS = "total, status_1xx, status_2xx, status_3xx, status_4xx, status_5xx, total_size, error_count"
+
+
+def _hourly_counters(conn, text_layout):
+    """{(epoch hour, host): counters} of the per-host hourly_stats rows."""
+    if text_layout:
+        rows = conn.execute(f"SELECT bucket_hour, host, {_COUNTERS} FROM hourly_stats")
+        return {(int(datetime.strptime(r[0], '%Y-%m-%dT%H').replace(tzinfo=timezone.utc).timestamp()) // 3600,
+                 r[1]): r[2:] for r in rows}
+    rows = conn.execute(f"SELECT s.hour, h.host, {_COUNTERS} FROM hourly_stats s JOIN hosts h USING (host_id)")
+    return {(r[0], r[1]): r[2:] for r in rows}
+
+
+def bench_upserts(lines):
+    """Time of one ingest of `lines` and how long it holds the write lock:
+    process_new_logs as it was before checkpoints were batched (bench_legacy_ingest,
+    a verbatim copy: decoding and one SELECT + UPDATE/INSERT per bucket, all in
+    one transaction) vs the current one (decoded and folded outside the lock,
+    a _checkpoint every CHECKPOINT_LINES, which also writes the sketches and
+    all-hosts rows). Each reads the same log twice, first inserting then
+    updating every (hour, host) row; their per-host counters must agree."""
+    import bench_legacy_ingest as legacy
+
+    sa = stats_aggregator
+    rows = []
+    results = {}
+    for label, module in (("original process_new_logs", legacy), ("process_new_logs", sa)):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'caddy_access.json.log')
+            module.init_stats_db(os.path.join(tmp, 'stats.db'))
+            conns = []
+
+            def connect(*args, connect=sqlite3.connect, **kwargs):
+                conns.append(connect(*args, factory=_LockTimer, **kwargs))
+                return conns[-1]
+
+            # Skip the first-run tail limit, read the log from the start
+            conn = sqlite3.connect(module._db_path)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_ts', '1')")
+            conn.commit()
+            conn.close()
+            timings = []
+            sqlite3.connect = connect  # both open their connections with sqlite3.connect()
+            try:
+                for _ in range(2):
+                    with open(log, 'ab') as f:
+                        f.writelines(lines)
+                    for c in conns:  # the current one keeps its connection
+                        c.locked = c.longest = 0.0
+                    t0 = time_module.perf_counter()
+                    count = module.process_new_logs(log)
+                    elapsed = time_module.perf_counter() - t0
+                    assert count == len(lines), count
+                    timings.append((elapsed, sum(c.locked for c in conns), max(c.longest for c in conns)))
+            finally:
+                sqlite3.connect = connect.__kwdefaults__['connect']
+                sa.close_connections()
+            conn = sqlite3.connect(module._db_path)
+            results[label] = _hourly_counters(conn, module is legacy)
+            conn.close()
+        rows.append((label, "   ".join(
+            f"{name} {total * 1000:7.1f} ms (lock {locked * 1000:7.1f} ms, longest {longest * 1000:6.1f} ms)"
+            for name, (total, locked, longest) in zip(("insert", "update"), timings))))
+    print(f"Upserts: {len(lines)} lines -> {len(results['process_new_logs'])} (hour, host) buckets")
+    if results["original process_new_logs"] != results["process_new_logs"]:
+        print("  WARNING: the original and the current process_new_logs counted differently")
+    _report(rows)
+
+
+def _make_stats_db(path, hosts, seed=5):
+    """A stats.db in the text-keyed layout (_TEXT_LAYOUT_DDL), top-N in the child
+    tables: 7 days of hourly rows and 365 days of daily rows for every host."""
+    rnd = random.Random(seed)
+    pools = [
+        [f"/app/{i}/item" for i in range(3000)],
+        list(dict.fromkeys(ua.split('/')[0] for ua in _USER_AGENTS)) + [f"bot{i}" for i in range(40)],
+        [f"{chr(65 + i // 26)}{chr(65 + i % 26)}" for i in range(120)],
+    ]
+    capacities = [stats_aggregator.TOP_N_PATHS, stats_aggregator.TOP_N_UAS, stats_aggregator.TOP_N_COUNTRIES]
+    next_id = itertools.count(1)
+    key_ids = [{key: next(next_id) for key in pool} for pool in pools]
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    visitors = []  # a pool of sketches from 10 to ~20000 distinct IPs
+    for size in range(40):
+        sketch = HyperLogLog()
+        for _ in range(int(10 * 1.21 ** size)):
+            sketch.add_hash(rnd.getrandbits(64))
+        visitors.append(sketch.to_bytes())
+    latencies = []  # and of histograms from 10 to ~20000 requests
+    for size in range(40):
+        histogram = LatencyHistogram()
+        for _ in range(int(10 * 1.21 ** size)):
+            histogram.add(rnd.lognormvariate(-3.5, 1.2))
+        latencies.append(histogram.to_bytes())
+
+    conn = sqlite3.connect(path)
+    conn.executescript(_TEXT_LAYOUT_DDL)
+    conn.executemany(
+        "INSERT INTO top_keys (key_id, dim, key) VALUES (?, ?, ?)",
+        [(key_id, dim, key) for dim, ids in enumerate(key_ids) for key, key_id in ids.items()],
+    )
+
+    def write(table, top_table, bucket_key, host, scale):
+        total = rnd.randint(10, 1000) * scale
+        host = f"site{host}.example.com"
+        conn.execute(
+            f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, NULL, ?, ?)",
+            (bucket_key, host, total, 0, total, 0, 0, 0, total * 0.05, total * 20000, 0,
+             rnd.choice(visitors), rnd.choice(latencies)),
+        )
+        children = []
+        for dim, (pool, capacity) in enumerate(zip(pools, capacities)):
+            floor = rnd.randint(0, total // capacity) if len(pool) > capacity else 0
+            if floor:
+                children.append((bucket_key, host, dim, 0, floor, 0))
+            for key in rnd.sample(pool, capacity):
+                children.append((bucket_key, host, dim, key_ids[dim][key], rnd.randint(1, total), rnd.randint(0, floor)))
+        conn.executemany(f"INSERT INTO {top_table} VALUES (?, ?, ?, ?, ?, ?)", children)
+
+    for h in range(7 * 24):
+        for host in range(hosts):
+            write('hourly_stats', 'hourly_top', (now - timedelta(hours=h)).strftime('%Y-%m-%dT%H'), host, 1)
+    for d in range(7, 365):
+        for host in range(hosts):
+            write('daily_stats', 'daily_top', (now - timedelta(days=d)).strftime('%Y-%m-%d'), host, 24)
+    conn.commit()
+    conn.close()
+
+
+def _db_sizes(path):
+    """(file bytes, {table or index: bytes}) after VACUUM."""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("VACUUM")
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        total = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        try:
+            tables = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+        except sqlite3.OperationalError:  # SQLite built without dbstat
+            tables = {}
+    finally:
+        conn.close()
+    return total, tables
+
+
+def bench_query(hosts):
+    """stats.db size in the text-keyed and the integer-keyed layout, the migration
+    between them (and its longest write transaction), and get_stats() latency per
+    period on the result: all hosts summed from the per-host rows vs read from the
+    all-hosts rows."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'stats.db')
+        t0 = time_module.perf_counter()
+        _make_stats_db(db, hosts)
+        print(f"Query: {hosts} hosts, 7 days hourly + 365 days daily (built in {time_module.perf_counter() - t0:.1f}s)")
+        text_total, text_tables = _db_sizes(db)
+
+        stats_aggregator.init_stats_db(db)
+        t0 = time_module.perf_counter()
+        longest = 0.0
+        done = False
+        while not done:
+            step = time_module.perf_counter()
+            done = stats_aggregator.migrate_text_layout(max_seconds=0)
+            longest = max(longest, time_module.perf_counter() - step)
+        print(f"  migration took {time_module.perf_counter() - t0:.1f}s, longest write transaction "
+              f"{longest * 1000:.0f} ms ({stats_aggregator.LAYOUT_MIGRATION_BATCH_ROWS} rows per batch)")
+        int_total, int_tables = _db_sizes(db)
+
+        timings = {}
+        results = {}
+        for label in ("per-host rows", "all-hosts rows"):
+            if label == "all-hosts rows":
+                t0 = time_module.perf_counter()
+                stats_aggregator.build_all_hosts_rows()
+                stats_aggregator.refresh_host_totals(force=True)
+                print(f"  building all-hosts rows took {time_module.perf_counter() - t0:.1f}s, "
+                      f"stats.db now {_db_sizes(db)[0] / 1048576:.1f} MiB")
+            for period in stats_aggregator.VALID_PERIODS:
+                for host in (None, "site1.example.com"):
+                    # _compute_stats: get_stats without the query cache
+                    compute = lambda: stats_aggregator._compute_stats(period, host, datetime.now(timezone.utc))
+                    timings[(label, period, host)] = _timeit(compute)
+                    result = compute()
+                    results[(label, period, host)] = [
+                        result[k] for k in ('total_requests', 'requests_by_host', 'unique_visitors', 'latency_ms')
+                    ]
+
+    rows = [("stats.db", f"text keys {text_total / 1048576:8.1f} MiB   integer keys {int_total / 1048576:8.1f} MiB"
+                         f"   -{(1 - int_total / text_total) * 100:.0f}%")]
+    # Per table, with its indexes (autoindexes and the text layout's time indexes)
+    indexes = {'idx_hourly_hour': 'hourly_stats', 'idx_daily_date': 'daily_stats',
+               'idx_hourly_host_total': 'hourly_stats', 'idx_daily_host_total': 'daily_stats'}
+
+    def table_of(name):
+        return indexes.get(name) or name.replace('sqlite_autoindex_', '').rsplit('_', 1)[0] \
+            if name.startswith('sqlite_autoindex_') or name in indexes else name
+
+    for name in ('hourly_stats', 'daily_stats', 'hourly_top', 'daily_top', 'top_keys', 'hosts'):
+        before = sum(size for table, size in text_tables.items() if table_of(table) == name)
+        after = sum(size for table, size in int_tables.items() if table_of(table) == name)
+        if before or after:
+            rows.append((f"  {name}", f"          {before / 1048576:8.1f} MiB                {after / 1048576:8.1f} MiB"))
+    for period in stats_aggregator.VALID_PERIODS:
+        for host in (None, "site1.example.com"):
+            label = f"{period} {'all hosts' if host is None else 'one host'}"
+            before, after = timings[("per-host rows", period, host)], timings[("all-hosts rows", period, host)]
+            rows.append((label, f"get_stats: per-host rows {before * 1000:8.1f} ms   all-hosts rows {after * 1000:8.1f} ms"
+                                f"   x{before / after:.1f}"))
+            if results[("per-host rows", period, host)] != results[("all-hosts rows", period, host)]:
+                print(f"  WARNING: {label}: results differ")
+    _report(rows)
+
+
+def bench_request(hosts, requests=300):
+    """What /api/stats costs in stats.db calls besides the query itself: the calls
+    the endpoint makes (get_stats answered by the query cache, get_ingest_status,
+    has_data) and a cache miss, with each call opening its own connections (as
+    before connections were kept) vs the thread's persistent ones."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'stats.db')
+        log = os.path.join(tmp, 'caddy_access.json.log')
+        _make_stats_db(db, hosts)
+        stats_aggregator.init_stats_db(db)
+        stats_aggregator.migrate_text_layout()
+        stats_aggregator.build_all_hosts_rows()
+        stats_aggregator.refresh_host_totals(force=True)
+        print(f"Request: {hosts} hosts, {requests} requests per case")
+
+        def miss():
+            stats_aggregator._compute_stats('24h', None, datetime.now(timezone.utc))
+
+        def per_call(steps):
+            # Dropping the thread's connections (stats.db and the query cache)
+            # before every call reproduces a connect() per call.
+            for step in steps:
+                stats_aggregator.close_connections()
+                stats_aggregator._query_cache._discard()
+                step()
+
+        cases = [
+            ("cached /api/stats", (lambda: stats_aggregator.get_stats('7d'),
+                                   lambda: stats_aggregator.get_ingest_status(log),
+                                   stats_aggregator.has_data)),
+            ("get_stats miss, 24h", (miss,)),
+        ]
+        stats_aggregator.get_stats('7d')  # fill the query cache
+        rows = []
+        for label, steps in cases:
+            fresh = _timeit(lambda: [per_call(steps) for _ in range(requests)]) / requests
+            kept = _timeit(lambda: [step() for _ in range(requests) for step in steps]) / requests
+            rows.append((label, f"connection per call {fresh * 1e6:8.0f} us   persistent {kept * 1e6:8.0f} us"
+                                f"   x{fresh / kept:.1f}"))
+        stats_aggregator.close_connections()
+    _report(rows)
+
+
+def bench_topn(days=30, batches_per_hour=6, batch_lines=200, seed=7):
+    """Accuracy of the top-10 paths of a 7-day and a 30-day view against exact counts:
+    top-N truncated on every merge (JSON layout) vs Space-Saving sketches of TOP_N_PATHS
+    counters and of the TOP_SKETCH_FACTOR times larger ones buckets keep. Traffic is
+    Zipf-distributed over 5000 paths, 30% of it re-shuffled every hour (trending pages).
+    Hours are merged from ingest batches, days beyond the hourly retention from hours.
+    Then the same for a path ranked just below the top-N in every hour (_bench_topn_runner_up)."""
+    rnd = random.Random(seed)
+    paths = [f"/app/{i}" for i in range(5000)]
+    weights = [1 / (i + 1) for i in range(len(paths))]
+    n = stats_aggregator.TOP_N_PATHS
+    capacities = (n, stats_aggregator._TOP_COLUMNS[0][1])
+    hourly_days = stats_aggregator.HOURLY_RETENTION_DAYS
+    exact = {}
+    exact_7d = {}
+    truncated = []  # per hour, then per day: {path: count}
+    sketches = {capacity: [] for capacity in capacities}
+    for hour in range(days * 24):
+        trending = paths[:]
+        rnd.shuffle(trending)
+        hour_dict = {}
+        hour_sketches = [SpaceSaving(capacity) for capacity in capacities]
+        for _ in range(batches_per_hour):
+            batch = {}
+            for stable, moving in zip(rnd.choices(paths, weights, k=batch_lines),
+                                      rnd.choices(trending, weights, k=batch_lines)):
+                path = moving if rnd.random() < 0.3 else stable
+                batch[path] = batch.get(path, 0) + 1
+                exact[path] = exact.get(path, 0) + 1
+                if hour >= (days - hourly_days) * 24:
+                    exact_7d[path] = exact_7d.get(path, 0) + 1
+            for k, v in batch.items():
+                hour_dict[k] = hour_dict.get(k, 0) + v
+            hour_dict = stats_aggregator._top_n_from_dict(hour_dict, n)
+            for sketch in hour_sketches:
+                sketch.update(batch)
+        truncated.append(hour_dict)
+        for capacity, sketch in zip(capacities, hour_sketches):
+            sketches[capacity].append(sketch)
+
+    def rollup(hours, merge):
+        rolled = []
+        for day in range(days - hourly_days):
+            rolled.append(merge(hours[day * 24:(day + 1) * 24]))
+        return rolled + hours[(days - hourly_days) * 24:]
+
+    def merge_truncated(parts, n=None):
+        merged = {}
+        for d in parts:
+            for k, v in d.items():
+                merged[k] = merged.get(k, 0) + v
+        return stats_aggregator._top_n_from_dict(merged, n) if n else merged
+
+    truncated = rollup(truncated, lambda hours: merge_truncated(hours, n))
+    for capacity in capacities:
+        sketches[capacity] = rollup(sketches[capacity], lambda hours: _merge_sketches(hours, capacity))
+
+    def score(estimate, truth):
+        best = sorted(truth, key=lambda k: -truth[k])[:10]
+        ranked = sorted(estimate, key=lambda k: (-estimate[k], k))[:10]
+        errors = [(estimate[k] - truth.get(k, 0)) / max(truth.get(k, 0), 1) * 100 for k in ranked]
+        return (f"recall {len(set(ranked) & set(best)):2d}/10   count error: top 5 "
+                f"{sum(errors[:5]) / 5:+6.1f}%, all 10 {sum(errors) / len(errors):+6.1f}%, "
+                f"worst {max(errors, key=abs):+6.1f}%")
+
+    print(f"Top-N: {sum(exact.values())} requests over {days} days, top {n} per bucket, "
+          f"sketches of {' and '.join(map(str, capacities))} counters")
+    rows = []
+    for label, parts, truth in (("7d", -hourly_days * 24, exact_7d), (f"{days}d", 0, exact)):
+        rows.append((f"{label} truncated", score(merge_truncated(truncated[parts:]), truth)))
+        for capacity in capacities:
+            rows.append((f"{label} sketches x{capacity}", score(_merge_sketches(sketches[capacity][parts:]).counts, truth)))
+    _report(rows)
+    _bench_topn_runner_up(rnd, capacities)
+
+
+def _merge_sketches(parts, capacity=None):
+    merged = SpaceSaving(capacity or sum(len(p) for p in parts) or 1)
+    for p in parts:
+        merged.merge(p)
+    return merged
+
+
+def _bench_topn_runner_up(rnd, capacities, hours=7 * 24, runner_up_hits=40):
+    """Rank in the 7-day top-10 of a path that is #TOP_N_PATHS + 1 in every hour:
+    each hour a different TOP_N_PATHS of 1000 hot pages get more hits than it, the
+    long tail less. Over the week it is the busiest path, but a bucket of only
+    TOP_N_PATHS counters drops it every hour."""
+    n = stats_aggregator.TOP_N_PATHS
+    runner_up = "/runner-up"
+    hot = [f"/hot/{i}" for i in range(1000)]
+    tail = [f"/tail/{i}" for i in range(5000)]
+    exact = {}
+    sketches = {capacity: [] for capacity in capacities}
+    for _ in range(hours):
+        counts = {path: runner_up_hits + 10 + rnd.randint(0, 20) for path in rnd.sample(hot, n)}
+        counts[runner_up] = runner_up_hits
+        for path in rnd.choices(tail, k=3000):
+            counts[path] = min(counts.get(path, 0) + 1, runner_up_hits - 5)
+        for path, count in counts.items():
+            exact[path] = exact.get(path, 0) + count
+        batch = list(counts.items())
+        rnd.shuffle(batch)
+        for capacity in capacities:
+            sketch = SpaceSaving(capacity)
+            for i in range(0, len(batch), 500):  # a few ingest batches per hour
+                sketch.update(dict(batch[i:i + 500]))
+            sketches[capacity].append(sketch)
+
+    truth = sorted(exact, key=lambda k: -exact[k])
+    rows = [("exact", f"{runner_up} #{truth.index(runner_up) + 1} with {exact[runner_up]} requests")]
+    for capacity in capacities:
+        merged = _merge_sketches(sketches[capacity]).counts
+        ranked = sorted(merged, key=lambda k: (-merged[k], k))[:10]
+        found = (f"#{ranked.index(runner_up) + 1} with {merged[runner_up]} requests" if runner_up in ranked
+                 else "not in the top 10")
+        rows.append((f"sketches x{capacity}", f"{runner_up} {found}, recall "
+                     f"{len(set(ranked) & set(truth[:10])):2d}/10"))
+    print(f"Top-N: a path ranked #{n + 1} in each of {hours} hours")
+    _report(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmark', choices=['decoder', 'timestamps', 'upserts', 'query', 'request', 'topn'])
+    parser.add_argument('--lines', type=int, default=100000, help='Number of log lines')
+    parser.add_argument('--sample', help='Real Caddy JSON access log to take lines from')
+    parser.add_argument('--hosts', type=int, default=40, help='Number of distinct vhosts in synthetic lines')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'timestamps':
+        bench_timestamps(args.lines)
+        return 0
+    if args.benchmark == 'query':
+        bench_query(args.hosts)
+        return 0
+    if args.benchmark == 'request':
+        bench_request(args.hosts)
+        return 0
+    if args.benchmark == 'topn':
+        bench_topn()
+        return 0
+
+    if args.sample:
+        lines = load_sample(args.sample, args.lines)
+    elif args.benchmark == 'upserts':
+        # One ingest batch: the last couple of hours of traffic.
+        lines = make_sample(args.lines, span_seconds=2 * 3600, hosts=args.hosts)
+    else:
+        lines = make_sample(args.lines, hosts=args.hosts)
+    if not lines:
+        print("No log lines to benchmark.")
+        return 1
+
+    if args.benchmark == 'decoder':
+        bench_decoder(lines)
+    elif args.benchmark == 'upserts':
+        bench_upserts(lines)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,24 +7,188 @@ for reliable, long-term statistics with efficient querying.
 Retention:
 - Hourly buckets (hourly_stats): 7 days of detailed per-host, per-path data
 - Daily buckets (daily_stats): 365 days of aggregated data
+- Buckets are keyed by integer epoch hours / days (unix time // 3600, // 86400)
+  and a host id; host names are stored once in `hosts`.
+- Top-N paths, user agents and countries per bucket live in child tables
+  (hourly_top, daily_top) keyed by interned strings (top_keys), so queries rank
+  them with SUM ... GROUP BY in SQLite. Writers cache host and key ids in process.
+- Databases in the older text-keyed layout (and top-N still in JSON columns) are
+  converted by the ingester in short resumable batches (migrate_text_layout),
+  or at once by `python -m stats_aggregator migrate`, which also compacts the
+  file. Until then the web workers read the old tables through TEMP views.
+- Each bucket's top-N is a Space-Saving sketch (stats_sketches.py) of
+  TOP_SKETCH_FACTOR times TOP_N_* counters, merged with its error bounds intact
+  on ingest, in rollup and at query time, and only cut to the list shown by
+  get_stats: a path with more than 1/(TOP_N_PATHS * TOP_SKETCH_FACTOR) of a
+  period's requests is always ranked, even if it never made the top of a single hour.
+- Unique visitors (distinct client IPs) per bucket are a HyperLogLog (visitors
+  column, at most 2 KB), unioned across hours, hosts and periods by get_stats.
+  Client IPs go straight into the bucket's sketch while ingesting, so a bucket
+  takes the same memory however many addresses it sees.
+- Request durations per bucket are a logarithmic histogram (latency column,
+  about 0.5 KB, quantiles within 2%), so get_stats reports p50/p90/p95/p99
+  for any period and host selection, overall and per timeseries point.
+- Every bucket also has an all-hosts row (host_id ALL_HOSTS_ID = 0, not in
+  `hosts`) written alongside the per-host rows, so the unfiltered dashboard reads
+  one row per bucket whatever the number of vhosts. Its top-N sketches keep
+  ALL_HOSTS_TOP_FACTOR times more counters. Requests per host for each period come
+  from the small host_totals table the ingester refreshes (refresh_host_totals).
+  Databases from before are given all-hosts rows by the ingester, a day at a time
+  (build_all_hosts_rows); until then get_stats sums the per-host rows.
+- get_stats serves the VALID_PERIODS or any from/to range within retention, at
+  any whole-hour step: hourly_stats where it still has the hours, else whole
+  days from daily_stats. Points are gap-filled by integer bucket arithmetic.
+  compare_hosts() returns the same figures for several hosts from one scan.
+- get_stats results are shared by all web workers through a query cache next to
+  stats.db (stats_cache.py), valid for one hour and one write generation: every
+  write that changes results bumps meta 'generation' in the same transaction.
+  Writers also copy it to stats.generation after the commit, so the web app can
+  answer If-None-Match without SQLite (stats_etag).
 
 Rollup:
 - Hourly -> Daily: consolidates hourly data older than 7 days
 - Daily cleanup: deletes daily data older than 365 days
+- Run by the ingester, one day per transaction (rollup_old_buckets). Meta
+  'rollup_watermark_day' is the last day moved into daily_stats; get_stats reads
+  days up to it from daily_stats and everything after from hourly_stats, so a
+  rollup that is behind never hides or double-counts data.
 
 GeoIP:
 - Optional: resolves client IPs to country codes via MaxMind GeoLite2 (.mmdb)
 - Falls back gracefully if database is not available
+- Lookups go through a bounded LRU cache (exact IP and /24 or /48 network entries,
+  plus negative entries for private/unresolvable addresses); see geoip_cache_stats()
+
+Ingester:
+- Log ingestion and rollup run in a dedicated process, not in the web workers:
+      python -m stats_aggregator run
+- The web app only reads stats.db; get_ingest_status() reports how fresh it is.
+- Every thread keeps its stats.db connections open (_read_conn, _write_conn),
+  with mmap and a larger page cache for reads and synchronous=NORMAL for the
+  ingester's commits; the ingester truncates the WAL every few minutes.
+- New lines are picked up as Caddy writes them (inotify, or adaptive polling; see
+  stats_tailer.py) and committed in micro-batches of N lines or T milliseconds.
+- It also keeps per-minute counters of the last few hours in a shared ring file
+  next to stats.db (stats_live.py), which get_live_stats() reads without SQLite,
+  and stream_live_deltas() turns into what each commit added, for the
+  dashboard's event stream.
+
+Backfill:
+- History older than the live tail (rotated backups, .gz archives) is imported with
+      python -m stats_aggregator backfill [files...]
+- Byte ranges already ingested are tracked per file (ingested_ranges), keyed by a
+  fingerprint of the file's first line, so re-running a backfill never double-counts.
+  Gzip archives read to the end are marked complete and not decompressed again.
+
+Decoding:
+- Log lines are decoded into a compact LogRecord holding only the fields used here.
+- Backend: msgspec (typed schema, requirements-optional.txt) or orjson when
+  installed, stdlib json otherwise.
+  Override with STATS_LOG_DECODER=msgspec|orjson|json. See bench_stats.py.
+- Before decoding, lines are filtered on their raw "logger" field: only
+  http.log.access* by default (STATS_LOGGER_INCLUDE / STATS_LOGGER_EXCLUDE, comma
+  separated). Skipped lines are counted per logger in meta (skipped_loggers).
 """
 
+import gzip
+import hashlib
+import ipaddress
 import json
+import os
+import queue
+import signal
 import sqlite3
+import sys
+import threading
 import time as time_module
+from collections import OrderedDict, namedtuple
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime
 import re as _re
 
+import stats_cache
+import stats_live
+import stats_tailer
+from stats_sketches import HyperLogLog, LatencyHistogram, SpaceSaving
+
+
+_DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _days_from_civil(y, m, d):
+    """Days since 1970-01-01 for a proleptic Gregorian date (H. Hinnant's algorithm)."""
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+# Size cap for the per-hour memo dict below (~170 days of distinct hours).
+_HOUR_KEYS_MAX = 4096
+
+# Epoch of 'YYYY-MM-DDTHH' prefixes already seen (None if the date is invalid).
+# Consecutive log lines share the hour, so the calendar math runs once per hour.
+_rfc3339_hours = {}
+
+
+def _rfc3339_hour_epoch(prefix):
+    try:
+        year = int(prefix[0:4])
+        month = int(prefix[5:7])
+        day = int(prefix[8:10])
+        hour = int(prefix[11:13])
+    except ValueError:
+        return None
+    if not (1 <= month <= 12 and 1 <= day <= _DAYS_IN_MONTH[month] and 0 <= hour < 24):
+        return None
+    if month == 2 and day == 29 and not (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+        return None
+    return _days_from_civil(year, month, day) * 86400 + hour * 3600
+
+
+def _parse_rfc3339(s):
+    """Hand-rolled parser for 'YYYY-MM-DDTHH:MM:SS[.frac](Z|+HH:MM|-HH:MM)',
+    the shape Caddy writes with time_format iso8601/rfc3339(_nano).
+    Returns the epoch float, or None if `s` is not in exactly that shape."""
+    if len(s) < 20 or s[4] != '-' or s[7] != '-' or s[10] not in 'Tt ' or s[13] != ':' or s[16] != ':':
+        return None
+    prefix = s[:13]
+    base = _rfc3339_hours.get(prefix, False)
+    if base is False:
+        if len(_rfc3339_hours) >= _HOUR_KEYS_MAX:
+            _rfc3339_hours.clear()
+        base = _rfc3339_hours[prefix] = _rfc3339_hour_epoch(prefix)
+    if base is None:
+        return None
+    try:
+        minute = int(s[14:16])
+        second = int(s[17:19])
+        i = 19
+        frac = 0.0
+        if s[i] == '.':
+            j = i + 1
+            while j < len(s) and '0' <= s[j] <= '9':
+                j += 1
+            frac = float(s[i:j])
+            i = j
+        tz = s[i:]
+        if tz == 'Z' or tz == 'z':
+            offset = 0
+        elif len(tz) == 6 and tz[0] in '+-' and tz[3] == ':':
+            offset = int(tz[1:3]) * 3600 + int(tz[4:6]) * 60
+            if tz[0] == '-':
+                offset = -offset
+        else:
+            return None
+    except (ValueError, IndexError):
+        return None
+    if not (0 <= minute < 60 and 0 <= second < 61):
+        return None
+    return (base + minute * 60 + second - offset) + frac
+
 
 def _parse_ts(ts_value):
     """Parse a Caddy log timestamp to a Unix epoch float.
@@ -35,8 +199,11 @@ def _parse_ts(ts_value):
     if isinstance(ts_value, (int, float)):
         return float(ts_value) if ts_value > 0 else 0.0
     if isinstance(ts_value, str) and ts_value:
+        epoch = _parse_rfc3339(ts_value)
+        if epoch is not None:
+            return epoch if epoch > 0 else 0.0
         try:
-            # Try ISO 8601 / RFC3339
+            # Other ISO 8601 shapes
             # Python 3.7+ supports datetime.fromisoformat for most formats
             s = ts_value.replace('Z', '+00:00')
             dt = datetime.fromisoformat(s)
@@ -44,18 +211,34 @@ def _parse_ts(ts_value):
         except (ValueError, OverflowError):
             pass
     return 0.0
+
 from collections import deque
 
 # --- Optional GeoIP ---
 _geoip_reader = None
+_geoip_path = None
+_geoip_mtime = None
+
+# LRU cache in front of the reader: ip string or network prefix ('1.2.3.0/24') -> country.
+# 'Unknown' entries are the negative cache (private, reserved or not in the database).
+GEOIP_CACHE_SIZE = 65536
+_geoip_cache = OrderedDict()
+_geoip_counters = {'hits': 0, 'prefix_hits': 0, 'misses': 0}
 
 
 def configure_geoip(db_path):
     """Configure the GeoIP resolver. Call with the path to a GeoLite2-Country.mmdb file.
     If the file doesn't exist or can't be read, GeoIP will be disabled (countries = 'Unknown')."""
-    global _geoip_reader
+    global _geoip_reader, _geoip_path, _geoip_mtime
     _geoip_reader = None
+    _clear_geoip_cache()
+    _geoip_path = str(db_path) if db_path else None
+    _geoip_mtime = None
     if db_path:
+        try:
+            _geoip_mtime = os.stat(db_path).st_mtime
+        except OSError:
+            pass
         try:
             import geoip2.database
             _geoip_reader = geoip2.database.Reader(db_path)
@@ -64,16 +247,93 @@ def configure_geoip(db_path):
             print(f"GeoIP: could not load database from {db_path}: {e}")
 
 
+def _clear_geoip_cache():
+    _geoip_cache.clear()
+    for k in _geoip_counters:
+        _geoip_counters[k] = 0
+
+
+def _geoip_cache_put(key, country):
+    _geoip_cache[key] = country
+    if len(_geoip_cache) > GEOIP_CACHE_SIZE:
+        _geoip_cache.popitem(last=False)
+
+
+def _prefix_key(ip_str):
+    """The /24 (IPv4) or /48 (IPv6) network key for an address, or None if it isn't one."""
+    if ':' not in ip_str:
+        head, dot, _ = ip_str.rpartition('.')
+        return head + '.0/24' if dot else None
+    try:
+        return str(ipaddress.IPv6Network((ip_str.split('%')[0], 48), strict=False))
+    except ValueError:
+        return None
+
+
+def _covers_prefix(network):
+    """True if a database network is at least as wide as our /24 or /48 cache key,
+    i.e. every address of the prefix resolves to the same answer."""
+    if network is None:
+        return False
+    return network.prefixlen <= (24 if network.version == 4 else 48)
+
+
+def _lookup_country(ip_str):
+    """Uncached lookup. Returns (country, network the answer holds for, or None)."""
+    try:
+        addr = ipaddress.ip_address(ip_str.split('%')[0])
+    except ValueError:
+        return 'Unknown', None
+    if not addr.is_global:
+        # Private/CGNAT/loopback ranges are all wider than a /24, so the
+        # negative answer can usually be cached for the whole prefix.
+        net = ipaddress.ip_network((addr, 24 if addr.version == 4 else 48), strict=False)
+        if net.network_address.is_global or net.broadcast_address.is_global:
+            net = None
+        return 'Unknown', net
+    try:
+        resp = _geoip_reader.country(ip_str)
+    except Exception as e:
+        # geoip2.errors.AddressNotFoundError carries the empty network (geoip2 >= 4.1)
+        return 'Unknown', getattr(e, 'network', None)
+    return resp.country.iso_code or 'Unknown', getattr(resp.traits, 'network', None)
+
+
 def _resolve_country(ip_str):
     """Resolve an IP address string to an ISO 3166-1 alpha-2 country code.
     Returns 'Unknown' if GeoIP is not configured or resolution fails."""
     if not _geoip_reader or not ip_str:
         return 'Unknown'
-    try:
-        resp = _geoip_reader.country(ip_str)
-        return resp.country.iso_code or 'Unknown'
-    except Exception:
-        return 'Unknown'
+    cache = _geoip_cache
+    country = cache.get(ip_str)
+    if country is not None:
+        cache.move_to_end(ip_str)
+        _geoip_counters['hits'] += 1
+        return country
+
+    prefix = _prefix_key(ip_str)
+    country = cache.get(prefix) if prefix else None
+    if country is not None:
+        cache.move_to_end(prefix)
+        _geoip_counters['prefix_hits'] += 1
+        return country
+
+    _geoip_counters['misses'] += 1
+    country, network = _lookup_country(ip_str)
+    if prefix and _covers_prefix(network):
+        _geoip_cache_put(prefix, country)
+    else:
+        _geoip_cache_put(ip_str, country)
+    return country
+
+
+def geoip_cache_stats():
+    """Counters for the GeoIP lookup cache of this process."""
+    lookups = sum(_geoip_counters.values())
+    stats = dict(_geoip_counters)
+    stats['entries'] = len(_geoip_cache)
+    stats['hit_rate'] = round((lookups - _geoip_counters['misses']) / lookups, 4) if lookups else None
+    return stats
 
 
 def is_geoip_available():
@@ -81,92 +341,634 @@ def is_geoip_available():
     return _geoip_reader is not None
 
 
+def _maybe_reload_geoip(db_path):
+    """Reload the GeoIP database if the .mmdb file appeared or changed on disk.
+    The web app downloads/uploads the database; the ingester picks it up here."""
+    if not db_path:
+        return
+    try:
+        mtime = os.stat(db_path).st_mtime
+    except OSError:
+        return
+    if str(db_path) != _geoip_path or mtime != _geoip_mtime or _geoip_reader is None:
+        configure_geoip(db_path)
+
+
 _db_path = None
+_live_path = None  # stats_live ring file, next to stats.db
+_live_writer = None  # set while run_ingester() runs in this process
+_live_reader = None
+_live_latest = None  # ((seq, published_at), snapshot) last read by this process
+_live_lock = threading.Lock()  # one LiveRingReader shared by the threads of a web worker
+_query_cache = None  # stats_cache.QueryCache of get_stats results, next to stats.db
+_generation_path = None  # "<db_id>:<generation>" of stats.db, for ETags without SQLite
+_generation_dirty = False  # a generation bump not yet written to _generation_path
 
 VALID_PERIODS = ('24h', '7d', '30d', '90d', '1y')
+LIVE_STREAM_POLL_SECONDS = 0.5
+LIVE_STREAM_HEARTBEAT_SECONDS = 15
+LIVE_STREAM_MAX_SECONDS = 600  # then the client reconnects, so no stream holds a thread for good
 HOURLY_RETENTION_DAYS = 7
 DAILY_RETENTION_DAYS = 365
 MAX_INITIAL_LINES = 500000
 MAX_INITIAL_BYTES = 50 * 1024 * 1024  # 50 MB
-TOP_N_PATHS = 20
+CHECKPOINT_LINES = 20000
+BACKFILL_CHUNK_BYTES = 32 * 1024 * 1024  # 32 MB per worker task
+FINGERPRINT_MAX_BYTES = 4096
+INGEST_INTERVAL_SECONDS = 2
+ROLLUP_INTERVAL_SECONDS = 6 * 3600  # between top_keys prunes
+PRUNE_BATCH = 5000  # top_keys rows deleted per transaction
+ROLLUP_STEP_SECONDS = 0.5  # rollup work per ingester loop, between ingests
+HEARTBEAT_INTERVAL_SECONDS = 15
+TOP_N_PATHS = 20  # top-N per bucket
 TOP_N_UAS = 10
 TOP_N_COUNTRIES = 20
+TOP_SKETCH_FACTOR = 5  # per-bucket Space-Saving sketches keep this many times TOP_N_* counters
+MIGRATION_BUSY_TIMEOUT_MS = 600000  # other processes wait this long for a VACUUM
+LAYOUT_MIGRATION_BATCH_ROWS = 2000  # old bucket rows converted per transaction
+ALL_HOSTS_ID = 0  # host_id of the all-hosts rows
+ALL_HOSTS_TOP_FACTOR = 5  # all-hosts top-N sketches keep this many times TOP_N_* counters
+HOST_TOTALS_INTERVAL_SECONDS = 60
+MAX_TIMESERIES_POINTS = 2000  # per get_stats() range query
+MAX_COMPARE_HOSTS = 20
+MMAP_BYTES = 256 * 1024 * 1024  # per connection; pages are shared through the OS page cache
+CACHE_KIB = 16 * 1024  # per connection, on top of mmap (WAL pages, temp b-trees)
+READ_POOL_SIZE = 4  # read connections per process, shared by its threads
+STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+WAL_CHECKPOINT_INTERVAL_SECONDS = 300
+_BUSY_TIMEOUT_SECONDS = 10
+WAL_CHECKPOINT_BUSY_MS = 1000  # how long the ingester waits for readers to let go of the WAL
+ETAG_TTL_SECONDS = 60  # stats_etag() also changes this often (ingest status, moving periods)
+
+_COUNTER_DDL = """
+    total INTEGER DEFAULT 0,
+    status_1xx INTEGER DEFAULT 0,
+    status_2xx INTEGER DEFAULT 0,
+    status_3xx INTEGER DEFAULT 0,
+    status_4xx INTEGER DEFAULT 0,
+    status_5xx INTEGER DEFAULT 0,
+    total_duration REAL DEFAULT 0,
+    total_size INTEGER DEFAULT 0,
+    error_count INTEGER DEFAULT 0,
+    visitors BLOB,
+    latency BLOB"""
+
+# One statement each: the layout migration runs them inside its transactions.
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS hosts (
+        host_id INTEGER PRIMARY KEY,
+        host TEXT NOT NULL UNIQUE
+    )""",
+    # hour: epoch hour (unix time // 3600)
+    f"""CREATE TABLE IF NOT EXISTS hourly_stats (
+        hour INTEGER NOT NULL,
+        host_id INTEGER NOT NULL,{_COUNTER_DDL},
+        PRIMARY KEY (hour, host_id)
+    )""",
+    # day: epoch day (unix time // 86400)
+    f"""CREATE TABLE IF NOT EXISTS daily_stats (
+        day INTEGER NOT NULL,
+        host_id INTEGER NOT NULL,{_COUNTER_DDL},
+        PRIMARY KEY (day, host_id)
+    )""",
+    # Requests per host for the whole period without reading the wide rows
+    "CREATE INDEX IF NOT EXISTS idx_hourly_host_total ON hourly_stats (hour, host_id, total)",
+    "CREATE INDEX IF NOT EXISTS idx_daily_host_total ON daily_stats (day, host_id, total)",
+    # Requests per host for each of VALID_PERIODS, see refresh_host_totals()
+    """CREATE TABLE IF NOT EXISTS host_totals (
+        period TEXT NOT NULL,
+        host_id INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (period, host_id)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    # Byte ranges of each log file already ingested. A row with start_offset
+    # _FILE_END_MARK records where the file ends once it was read to the end
+    # (gzip archives, whose decompressed size is not known up front).
+    """CREATE TABLE IF NOT EXISTS ingested_ranges (
+        fingerprint TEXT NOT NULL,
+        start_offset INTEGER NOT NULL,
+        end_offset INTEGER NOT NULL,
+        PRIMARY KEY (fingerprint, start_offset)
+    )""",
+    # Top-N paths / user agents / countries per bucket. Strings are stored once
+    # in top_keys; dim is DIM_PATH, DIM_UA or DIM_COUNTRY. Each (bucket, host,
+    # dim) holds a Space-Saving sketch: key_id 0 stores its floor, the other
+    # rows store count - floor and the counter's error.
+    """CREATE TABLE IF NOT EXISTS top_keys (
+        key_id INTEGER PRIMARY KEY,
+        dim INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        UNIQUE (dim, key)
+    )""",
+    """CREATE TABLE IF NOT EXISTS hourly_top (
+        hour INTEGER NOT NULL,
+        host_id INTEGER NOT NULL,
+        dim INTEGER NOT NULL,
+        key_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        err INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (host_id, dim, hour, key_id)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS daily_top (
+        day INTEGER NOT NULL,
+        host_id INTEGER NOT NULL,
+        dim INTEGER NOT NULL,
+        key_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        err INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (host_id, dim, day, key_id)
+    ) WITHOUT ROWID""",
+)
 
 
 def init_stats_db(db_path):
     """Initialize the stats database. Create tables if they don't exist.
-    Must be called before any other function."""
-    global _db_path
+    Must be called before any other function.
+
+    A database still in the text-keyed layout is left as it is: it is read
+    through TEMP views (_text_layout_views) until migrate_text_layout(), run by
+    the ingester or `python -m stats_aggregator migrate`, has converted it."""
+    global _db_path, _live_path, _query_cache, _generation_path, _conns_epoch
+    global _text_layout, _layout_migration_pending
     _db_path = str(db_path)
+    _conns_epoch += 1
+    _live_path = str(Path(_db_path).with_suffix('.live'))
+    _generation_path = str(Path(_db_path).with_suffix('.generation'))
+    _query_cache = stats_cache.QueryCache(Path(_db_path).with_suffix('.cache.db'))
 
-    conn = sqlite3.connect(_db_path)
+    _reset_id_caches()
+
+    conn = sqlite3.connect(_db_path, isolation_level=None)
     conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=10000")
-    conn.executescript("""
-        CREATE TABLE IF NOT EXISTS hourly_stats (
-            bucket_hour TEXT NOT NULL,
-            host TEXT NOT NULL,
-            total INTEGER DEFAULT 0,
-            status_1xx INTEGER DEFAULT 0,
-            status_2xx INTEGER DEFAULT 0,
-            status_3xx INTEGER DEFAULT 0,
-            status_4xx INTEGER DEFAULT 0,
-            status_5xx INTEGER DEFAULT 0,
-            total_duration REAL DEFAULT 0,
-            total_size INTEGER DEFAULT 0,
-            error_count INTEGER DEFAULT 0,
-            top_paths TEXT DEFAULT '{}',
-            top_uas TEXT DEFAULT '{}',
-            top_countries TEXT DEFAULT '{}',
-            PRIMARY KEY (bucket_hour, host)
-        );
-
-        CREATE TABLE IF NOT EXISTS daily_stats (
-            bucket_date TEXT NOT NULL,
-            host TEXT NOT NULL,
-            total INTEGER DEFAULT 0,
-            status_1xx INTEGER DEFAULT 0,
-            status_2xx INTEGER DEFAULT 0,
-            status_3xx INTEGER DEFAULT 0,
-            status_4xx INTEGER DEFAULT 0,
-            status_5xx INTEGER DEFAULT 0,
-            total_duration REAL DEFAULT 0,
-            total_size INTEGER DEFAULT 0,
-            error_count INTEGER DEFAULT 0,
-            top_paths TEXT DEFAULT '{}',
-            top_uas TEXT DEFAULT '{}',
-            top_countries TEXT DEFAULT '{}',
-            PRIMARY KEY (bucket_date, host)
-        );
-
-        CREATE TABLE IF NOT EXISTS meta (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_hourly_hour ON hourly_stats(bucket_hour);
-        CREATE INDEX IF NOT EXISTS idx_daily_date ON daily_stats(bucket_date);
-    """)
-    conn.commit()
-
-    # Migration: add top_countries column to existing tables
-    for table in ('hourly_stats', 'daily_stats'):
+    conn.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_SECONDS * 1000}")
+    _text_layout = 'bucket_hour' in _table_columns(conn, 'hourly_stats')
+    _layout_migration_pending = _text_layout or bool(_layout_leftovers(conn))
+    if _text_layout:
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('db_id', ?)", (os.urandom(8).hex(),))
+        # Text-keyed databases never had all-hosts rows
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('all_hosts_rows', 'hourly:-1')")
+        earliest_hour = conn.execute(
+            f"SELECT MIN({_TEXT_BUCKETS[0][3].format('bucket_hour')}) FROM hourly_stats"
+        ).fetchone()[0]
+        hourly_cutoff = _retention_cutoffs()[0]
+        conn.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES ('rollup_watermark_day', ?)",
+            (str(min(hourly_cutoff, hourly_cutoff if earliest_hour is None else earliest_hour // 24) - 1),),
+        )
+        print("Stats DB: text-keyed layout, read as is until the ingester (or "
+              "'python -m stats_aggregator migrate') has converted it.")
+        _write_generation_file(conn)
+        conn.close()
+        return
+
+    had_ranges_table = _has_table(conn, 'ingested_ranges')
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    _init_meta(conn, had_ranges_table)
+    _write_generation_file(conn)
+    conn.close()
+
+
+def _init_meta(conn, had_ranges_table):
+    """Meta rows a database of the current layout starts with (kept if present)."""
+    # Days before the earliest hourly bucket (or before the hourly retention) are
+    # in daily_stats; rollup_old_buckets advances this as it rolls days up.
+    earliest_hour = conn.execute("SELECT MIN(hour) FROM hourly_stats").fetchone()[0]
+    hourly_cutoff = _retention_cutoffs()[0]
+    conn.execute(
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('rollup_watermark_day', ?)",
+        (str(min(hourly_cutoff, hourly_cutoff if earliest_hour is None else earliest_hour // 24) - 1),),
+    )
+
+    # Identifies this database in query cache versions (see _stats_version)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('db_id', ?)", (os.urandom(8).hex(),))
+
+    # Migration: databases filled before all-hosts rows existed get them from
+    # build_all_hosts_rows(), hourly_stats first
+    has_rows = conn.execute(
+        "SELECT EXISTS (SELECT 1 FROM hourly_stats) OR EXISTS (SELECT 1 FROM daily_stats)"
+    ).fetchone()[0]
+    conn.execute(
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('all_hosts_rows', ?)",
+        ('hourly:-1' if has_rows else 'done',),
+    )
+
+    # Migration: databases filled before byte ranges were tracked cannot tell which
+    # log lines they already contain. Backfill skips anything at or after their
+    # earliest bucket so those lines are never counted twice.
+    if not had_ranges_table:
         try:
-            cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
-            if 'top_countries' not in cols:
-                conn.execute(f"ALTER TABLE {table} ADD COLUMN top_countries TEXT DEFAULT '{{}}'")
-                print(f"Stats DB migration: added top_countries to {table}")
+            earliest = [
+                row[0] for row in (
+                    conn.execute("SELECT MIN(hour) * 3600 FROM hourly_stats").fetchone(),
+                    conn.execute("SELECT MIN(day) * 86400 FROM daily_stats").fetchone(),
+                ) if row[0] is not None
+            ]
+            if earliest:
+                cutoff = min(earliest)
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('backfill_legacy_cutoff_ts', ?)",
+                    (str(float(cutoff)),),
+                )
+                print(f"Stats DB migration: backfill will only import entries before "
+                      f"{datetime.fromtimestamp(cutoff, tz=timezone.utc):%Y-%m-%d %H:%M} UTC")
         except Exception as e:
-            print(f"Stats DB migration check for {table}: {e}")
+            print(f"Stats DB migration check for ingested_ranges: {e}")
+
+
+def _table_columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA main.table_info({table})").fetchall()]
+
+
+def _has_table(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+# Text-keyed layout: (table, text bucket column, integer bucket column, SQL
+# turning the text bucket {0} into the integer one, NULL if malformed)
+_TEXT_BUCKETS = (
+    ('hourly_stats', 'bucket_hour', 'hour',
+     "CAST(strftime('%s', substr({0}, 1, 10) || ' ' || substr({0}, 12, 2) || ':00') AS INTEGER) / 3600"),
+    ('daily_stats', 'bucket_date', 'day', "CAST(strftime('%s', {0}) AS INTEGER) / 86400"),
+)
+# The layout migration fills these copies of the bucket tables and swaps them in
+# at the end; the old tables are then renamed *_text and dropped one at a time.
+_LAYOUT_STAGING = {'hourly_stats': 'hourly_stats_new', 'daily_stats': 'daily_stats_new',
+                   'hourly_top': 'hourly_top_new', 'daily_top': 'daily_top_new'}
+
+
+def _layout_leftovers(conn):
+    """Old tables a finished layout migration has still to drop."""
+    return [row[0] for row in conn.execute(
+        f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN "
+        f"({','.join('?' * len(_LAYOUT_STAGING))})",
+        [f"{table}_text" for table in _LAYOUT_STAGING],
+    )]
+
+
+def _text_layout_views(conn):
+    """Let the queries read a database still in the text-keyed layout on `conn`:
+    TEMP views, which shadow the main tables for this connection only, present
+    its tables in the current shape, with the host name as host_id and top-N key
+    strings as key_ids (see _query_top). Every query scans the old tables, so this
+    only bridges the time until migrate_text_layout() is done."""
+    views = {
+        'hosts': "SELECT host, host AS host_id FROM main.hourly_stats "
+                 "UNION SELECT host, host FROM main.daily_stats",
+        'top_keys': "SELECT NULL AS key_id, NULL AS dim, NULL AS key WHERE 0",
+        'host_totals': "SELECT NULL AS period, NULL AS host_id, NULL AS total WHERE 0",
+    }
+    for table, old_col, new_col, to_int in _TEXT_BUCKETS:
+        cols = _table_columns(conn, table)
+        blobs = ', '.join(f"{c if c in cols else 'NULL'} AS {c}" for c in ('visitors', 'latency'))
+        views[table] = (f"SELECT {to_int.format(old_col)} AS {new_col}, host AS host_id, "
+                        f"{', '.join(_COUNTER_COLUMNS)}, {blobs} FROM main.{table}")
+        top_table = _TOP_TABLES[table]
+        parts = []
+        if _has_table(conn, top_table):
+            err = 't.err' if 'err' in _table_columns(conn, top_table) else '0'
+            parts.append(
+                f"SELECT {to_int.format('t.' + old_col)} AS {new_col}, t.host AS host_id, t.dim, "
+                f"CASE WHEN t.key_id = 0 THEN 0 ELSE k.key END AS key_id, t.count, {err} AS err "
+                f"FROM main.{top_table} t LEFT JOIN main.top_keys k ON k.key_id = t.key_id"
+            )
+        for dim, (column, _) in enumerate(_TOP_COLUMNS):
+            if column in cols:
+                parts.append(
+                    f"SELECT {to_int.format('o.' + old_col)} AS {new_col}, o.host AS host_id, {dim} AS dim, "
+                    f"j.key AS key_id, j.value AS count, 0 AS err "
+                    f"FROM main.{table} o, json_each(o.{column}) j "
+                    f"WHERE o.{column} IS NOT NULL AND json_valid(o.{column})"
+                )
+        views[top_table] = ' UNION ALL '.join(parts) or (
+            f"SELECT NULL AS {new_col}, NULL AS host_id, NULL AS dim, NULL AS key_id, "
+            f"NULL AS count, NULL AS err WHERE 0")
+    for name, sql in views.items():
+        conn.execute(f"CREATE TEMP VIEW {name} AS {sql}")
+
+
+def migrate_text_layout(max_seconds=None, batch_rows=LAYOUT_MIGRATION_BATCH_ROWS):
+    """Convert a database of the text-keyed layout ('YYYY-mm-ddTHH' / 'YYYY-mm-dd'
+    buckets and the host name in every row, maybe top-N JSON columns or no
+    visitors/latency columns yet) into the current one, `batch_rows` old rows per
+    transaction, so the write lock is never held for long. Progress is meta
+    'layout_migration' ('<table>:<last rowid>', then 'done'): a killed run resumes
+    where it stopped. Rows go into staging copies of the tables, which replace
+    the old ones in one last short transaction; the old tables are then dropped
+    one per transaction. Web workers read the old tables until then.
+
+    Run by the ingester (which ingests nothing until it is done) and by
+    `python -m stats_aggregator migrate`. max_seconds: stop after the step that
+    exceeds it. Returns True when nothing is left to do."""
+    global _layout_migration_pending
+    if _db_path is None:
+        raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
+    started = time_module.monotonic()
+    conn = _write_conn()
+    try:
+        while True:
+            done = _write_transaction(conn, lambda: _layout_migration_step(conn, batch_rows))
+            if _text_layout and _read_meta(conn, 'layout_migration', str, '') == 'done':
+                _use_current_layout()  # the old tables are only left to drop
+            if done:
+                break
+            if max_seconds is not None and time_module.monotonic() - started >= max_seconds:
+                return False
+    finally:
+        _release_conn(conn)
+    _layout_migration_pending = False
+    return True
+
+
+def _use_current_layout():
+    """The layout migration has swapped the tables: reopen this process's
+    connections without the TEMP views of _text_layout_views()."""
+    global _text_layout, _conns_epoch
+    _text_layout = False
+    _conns_epoch += 1
+    _reset_id_caches()
+
+
+def _layout_migration_step(conn, batch_rows):
+    """One transaction of migrate_text_layout(). Returns True once there is
+    nothing left to do."""
+    if 'bucket_hour' not in _table_columns(conn, 'hourly_stats'):
+        leftovers = _layout_leftovers(conn)
+        if leftovers:
+            conn.execute(f"DROP TABLE {leftovers[0]}")
+        return len(leftovers) <= 1
+
+    progress = _read_meta(conn, 'layout_migration', str, '')
+    if not progress:
+        for statement in _SCHEMA:
+            if not any(f" {table} (" in statement for table in _LAYOUT_STAGING):
+                if 'hosts' in statement or 'top_keys' in statement:
+                    conn.execute(statement)
+                continue
+            for table, staged in _LAYOUT_STAGING.items():
+                statement = statement.replace(f" {table} (", f" {staged} (")
+            conn.execute(statement)  # the text layout's indexes have other names
+        _set_layout_progress(conn, f"{_TEXT_BUCKETS[0][0]}:0")
+        return False
 
-    conn.close()
+    table, last = progress.rsplit(':', 1)
+    if table == 'swap':
+        _swap_layout_tables(conn)
+        return False
+    _, old_col, new_col, to_int = next(b for b in _TEXT_BUCKETS if b[0] == table)
+    upper = conn.execute(
+        f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+        (int(last), batch_rows),
+    ).fetchone()[0]
+    if upper is None:
+        tables = [b[0] for b in _TEXT_BUCKETS]
+        following = tables[tables.index(table) + 1:]
+        _set_layout_progress(conn, f"{following[0]}:0" if following else "swap:0")
+        return False
+    _convert_text_rows(conn, table, old_col, new_col, to_int, int(last), upper)
+    _set_layout_progress(conn, f"{table}:{upper}")
+    return False
 
 
-def _get_conn(timeout=10):
-    """Get a connection to the stats database."""
+def _set_layout_progress(conn, progress):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('layout_migration', ?)", (progress,))
+
+
+def _convert_text_rows(conn, table, old_col, new_col, to_int, after, upper):
+    """Copy the rows of text-keyed `table` with rowid in (after, upper] and
+    their top-N (child rows and JSON columns) into the staging tables."""
+    staged = _LAYOUT_STAGING[table]
+    cols = _table_columns(conn, table)
+    bucket = to_int.format(f"o.{old_col}")
+    conn.execute(f"INSERT OR IGNORE INTO hosts (host) SELECT DISTINCT host FROM {table} "
+                 f"WHERE rowid > ? AND rowid <= ?", (after, upper))
+    conn.execute(
+        f"INSERT INTO {staged} ({new_col}, host_id, {', '.join(_COUNTER_COLUMNS)}, visitors, latency) "
+        f"SELECT {bucket} AS b, h.host_id, {', '.join('o.' + c for c in _COUNTER_COLUMNS)}, "
+        f"{'o.visitors' if 'visitors' in cols else 'NULL'}, {'o.latency' if 'latency' in cols else 'NULL'} "
+        f"FROM {table} o JOIN hosts h ON h.host = o.host WHERE o.rowid > ? AND o.rowid <= ? AND b IS NOT NULL",
+        (after, upper),
+    )
+
+    top_table = _TOP_TABLES[table]
+    if _has_table(conn, top_table):
+        err = 't.err' if 'err' in _table_columns(conn, top_table) else '0'
+        conn.execute(
+            f"INSERT INTO {_LAYOUT_STAGING[top_table]} ({new_col}, host_id, dim, key_id, count, err) "
+            f"SELECT {bucket} AS b, h.host_id, t.dim, t.key_id, t.count, {err} "
+            f"FROM {table} o JOIN hosts h ON h.host = o.host "
+            f"JOIN {top_table} t ON t.host = o.host AND t.{_ALL_DIMS} AND t.{old_col} = o.{old_col} "
+            f"WHERE o.rowid > ? AND o.rowid <= ? AND b IS NOT NULL",
+            (after, upper),
+        )
+
+    # Top-N not yet moved out of the JSON columns
+    if 'top_paths' in cols:
+        countries = 'o.top_countries' if 'top_countries' in cols else 'NULL'
+        legacy = conn.execute(
+            f"SELECT {bucket} AS b, h.host_id, o.top_paths, o.top_uas, {countries} "
+            f"FROM {table} o JOIN hosts h ON h.host = o.host "
+            f"WHERE o.rowid > ? AND o.rowid <= ? AND b IS NOT NULL AND (COALESCE(o.top_paths, '{{}}') != '{{}}' "
+            f"OR COALESCE(o.top_uas, '{{}}') != '{{}}' OR COALESCE({countries}, '{{}}') != '{{}}')",
+            (after, upper),
+        ).fetchall()
+        if legacy:
+            tops = _read_tops(conn, staged, new_col, {(r[0], r[1]) for r in legacy})
+            for bucket_key, host_id, paths, uas, top_countries in legacy:
+                _add_legacy_tops(tops.setdefault((bucket_key, host_id), _new_tops(host_id)),
+                                 paths, uas, top_countries)
+            _write_tops(conn, staged, new_col, tops)
+
+
+def _swap_layout_tables(conn):
+    """Last step of the layout migration: the staging tables take the place of
+    the old ones (renamed *_text, dropped afterwards) and the meta rows of the
+    current layout are added. Readers switch over when they see 'done'."""
+    had_ranges_table = _has_table(conn, 'ingested_ranges')
+    for table, staged in _LAYOUT_STAGING.items():
+        if _has_table(conn, table):
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_text")
+        conn.execute(f"ALTER TABLE {staged} RENAME TO {table}")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    _init_meta(conn, had_ranges_table)
+    conn.execute("DELETE FROM meta WHERE key = 'top_tables_migrated' OR key LIKE 'top_migration_rowid_%'")
+    _set_layout_progress(conn, 'done')
+    _bump_generation(conn)
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+              for table in ('hourly_stats', 'daily_stats')}
+    print(f"Stats DB migration: converted {', '.join(f'{n} {t} rows' for t, n in counts.items())} "
+          f"to integer buckets and host ids. Run 'python -m stats_aggregator migrate' to reclaim the space.")
+
+
+def compact_stats_db():
+    """VACUUM stats.db, e.g. after a layout migration freed many pages.
+    Returns (bytes before, bytes after)."""
     if _db_path is None:
         raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
-    return sqlite3.connect(_db_path, timeout=timeout)
+    conn = sqlite3.connect(_db_path, timeout=MIGRATION_BUSY_TIMEOUT_MS / 1000)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        before = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        conn.execute("VACUUM")
+        after = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return before, after
+
+
+def _day_label(day):
+    """'YYYY-mm-dd' of an epoch day (daily_stats.day)."""
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+# Connections to stats.db stay open, so a request does not pay for connect(),
+# the pragmas and re-preparing its statements each time. Web workers only use
+# _read_conn(): a process's threads share READ_POOL_SIZE of them (gthread runs
+# every request on its own thread, and each connection holds up to CACHE_KIB of
+# cache). The ingester does its transactions on its thread's _write_conn().
+# Both are re-opened after a fork or another init_stats_db().
+_conns = threading.local()  # .write: ((pid, db path, epoch), connection)
+_conns_epoch = 0
+_text_layout = False  # stats.db is still in the text-keyed layout, see _text_layout_views()
+_layout_migration_pending = False  # ... or the migration still has old tables to drop
+_read_pool = None  # (pid, idle ((pid, db path, epoch), connection) LifoQueue, BoundedSemaphore of READ_POOL_SIZE)
+_read_pool_lock = threading.Lock()
+_read_lent = {}  # read connection -> its (pid, db path, epoch), while lent out
+
+_READ_PRAGMAS = (
+    f"PRAGMA mmap_size={MMAP_BYTES}",
+    f"PRAGMA cache_size=-{CACHE_KIB}",
+    "PRAGMA temp_store=MEMORY",
+)
+# In WAL mode synchronous=NORMAL only skips the fsync per commit: a power loss
+# can undo the last commits, but each one still has its buckets and log offset
+# together, so the lines are read again.
+_WRITE_PRAGMAS = _READ_PRAGMAS + ("PRAGMA synchronous=NORMAL",)
+
+
+def _conn_key():
+    if _db_path is None:
+        raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
+    return os.getpid(), _db_path, _conns_epoch
+
+
+def _connect(pragmas, **kwargs):
+    conn = sqlite3.connect(_db_path, timeout=_BUSY_TIMEOUT_SECONDS, cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
+
+def _process_read_pool():
+    """This process's _read_pool; a fresh one after a fork."""
+    global _read_pool
+    with _read_pool_lock:
+        if _read_pool is None or _read_pool[0] != os.getpid():
+            _read_pool = (os.getpid(), queue.LifoQueue(), threading.BoundedSemaphore(READ_POOL_SIZE))
+        return _read_pool
+
+
+def _read_conn():
+    """A connection for queries from the process's pool, waiting while all
+    READ_POOL_SIZE are lent out. Hand it back with _release_conn(), don't close it."""
+    key = _conn_key()
+    _, idle, slots = _process_read_pool()
+    slots.acquire()
+    try:
+        while True:
+            try:
+                conn_key, conn = idle.get_nowait()
+            except queue.Empty:
+                conn = _connect(_READ_PRAGMAS, check_same_thread=False)
+                if _text_layout:
+                    _text_layout_views(conn)
+                conn_key = key
+            if conn_key == key and _text_layout and \
+                    _read_meta(conn, 'layout_migration', str, '') == 'done':
+                _use_current_layout()  # the ingester has converted stats.db
+                key = _conn_key()
+            if conn_key == key:
+                break
+            conn.close()  # from before the last init_stats_db() or layout switch
+    except BaseException:
+        slots.release()
+        raise
+    _read_lent[conn] = key
+    return conn
+
+
+def _write_conn():
+    """This thread's connection for write transactions (one writer per ingester).
+    Hand it back with _release_conn(), don't close it."""
+    key = _conn_key()
+    cached = getattr(_conns, 'write', None)
+    if cached is not None:
+        if cached[0] == key:
+            return cached[1]
+        if cached[0][0] == key[0]:  # not inherited from the parent process
+            cached[1].close()
+    conn = _connect(_WRITE_PRAGMAS)
+    _conns.write = (key, conn)
+    return conn
+
+
+def _release_conn(conn):
+    """Done with a _read_conn() / _write_conn() connection: roll back whatever an
+    error left uncommitted, so the next user does not inherit a transaction, and
+    return a read connection to the pool."""
+    if conn.in_transaction:
+        conn.rollback()
+    key = _read_lent.pop(conn, None)
+    if key is None:
+        return
+    pid, idle, slots = _process_read_pool()
+    if key[0] == pid:
+        if key[1:] == (_db_path, _conns_epoch):
+            idle.put((key, conn))
+        else:
+            conn.close()
+        slots.release()
+
+
+def close_connections():
+    """Close this thread's write connection and the process's idle read
+    connections (they are re-opened on demand)."""
+    cached = getattr(_conns, 'write', None)
+    if cached is not None:
+        if cached[0][0] == os.getpid():
+            cached[1].close()
+        _conns.write = None
+    _, idle, _ = _process_read_pool()
+    while True:
+        try:
+            _, conn = idle.get_nowait()
+        except queue.Empty:
+            break
+        conn.close()
+
+
+def checkpoint_wal():
+    """Copy the WAL into stats.db and truncate it to zero bytes. SQLite's automatic
+    checkpoints only recycle the WAL and never shrink it, so after a burst (a
+    backfill, a rollup catching up) the file would otherwise keep its peak size.
+    Waits up to WAL_CHECKPOINT_BUSY_MS for readers. Returns True if it completed."""
+    conn = _write_conn()
+    try:
+        conn.execute(f"PRAGMA busy_timeout={WAL_CHECKPOINT_BUSY_MS}")
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_SECONDS * 1000}")
+        _release_conn(conn)
+    return not busy
 
 
 def _top_n_from_dict(d, n):
@@ -176,434 +978,1606 @@ def _top_n_from_dict(d, n):
     return dict(sorted(d.items(), key=lambda x: x[1], reverse=True)[:n])
 
 
-def _merge_top_json(existing_json, new_counts, n):
-    """Merge new count dict into an existing JSON top-N dict.
+# ---------------------------------------------------------------------------
+# Log decoding
+# ---------------------------------------------------------------------------
+
+# The only fields the aggregator reads from a Caddy access log entry.
+# `ip` is remote_ip, else client_ip; the header fields hold the first value only.
+LogRecord = namedtuple(
+    'LogRecord',
+    'ts host uri status duration size ip user_agent forwarded_for real_ip',
+)
+
+DECODER_BACKENDS = ('msgspec', 'orjson', 'json')
+
+
+def _first(values):
+    """First element of a Caddy header value list, or None."""
+    if isinstance(values, list) and values:
+        return values[0]
+    return None
+
+
+def _record_from_dict(entry):
+    """Build a LogRecord from a fully decoded log entry dict."""
+    if not isinstance(entry, dict):
+        return None
+    request = entry.get('request', {})
+    if not isinstance(request, dict):
+        request = {}
+    headers = request.get('headers', {})
+    if not isinstance(headers, dict):
+        headers = {}
+    return LogRecord(
+        entry.get('ts', 0),
+        request.get('host', entry.get('host', 'Unknown')),
+        request.get('uri', '/'),
+        entry.get('status', 0),
+        entry.get('duration', 0),
+        entry.get('size', 0),
+        request.get('remote_ip') or request.get('client_ip', ''),
+        _first(headers.get('User-Agent')),
+        _first(headers.get('X-Forwarded-For')),
+        _first(headers.get('X-Real-Ip')),
+    )
+
 
-    existing_json: str (JSON dict like {"path": count, ...})
-    new_counts: dict ({"path": count, ...})
-    n: keep top N entries after merge
+def _decode_json(line):
+    """Stdlib decoder: always available."""
+    return _record_from_dict(json.loads(line))
 
-    Returns: str (JSON dict)
-    """
-    merged = {}
-    if existing_json:
+
+def _make_orjson_decoder():
+    import orjson
+
+    def _decode_orjson(line):
         try:
-            merged = json.loads(existing_json)
-        except (json.JSONDecodeError, TypeError):
-            merged = {}
-    for k, v in new_counts.items():
-        merged[k] = merged.get(k, 0) + v
-    return json.dumps(_top_n_from_dict(merged, n))
+            return _record_from_dict(orjson.loads(line))
+        except orjson.JSONDecodeError as e:
+            raise ValueError(str(e)) from None
+
+    return _decode_orjson
+
+
+def _make_msgspec_decoder():
+    """Typed schema decoder: msgspec skips every field not declared here
+    (TLS info, response headers, other request headers) without building it."""
+    import msgspec
+
+    class _Headers(msgspec.Struct, rename={
+        'user_agent': 'User-Agent', 'forwarded_for': 'X-Forwarded-For', 'real_ip': 'X-Real-Ip',
+    }):
+        user_agent: list = []
+        forwarded_for: list = []
+        real_ip: list = []
+
+    class _Request(msgspec.Struct):
+        host: str = 'Unknown'
+        uri: str = '/'
+        remote_ip: str = ''
+        client_ip: str = ''
+        headers: _Headers = msgspec.field(default_factory=_Headers)
+
+    class _Entry(msgspec.Struct):
+        ts: float | str = 0
+        request: _Request | None = None
+        host: str = 'Unknown'
+        status: int = 0
+        duration: float = 0.0
+        size: int = 0
+
+    decoder = msgspec.json.Decoder(_Entry)
+    empty_request = _Request()
+
+    def _decode_msgspec(line):
+        try:
+            e = decoder.decode(line)
+        except msgspec.ValidationError:
+            # Valid JSON with unexpected types: let the lenient path decide.
+            return _decode_json(line)
+        except msgspec.DecodeError as err:
+            raise ValueError(str(err)) from None
+        r = e.request if e.request is not None else empty_request
+        h = r.headers
+        return LogRecord(
+            e.ts,
+            r.host if e.request is not None else e.host,
+            r.uri,
+            e.status,
+            e.duration,
+            e.size,
+            r.remote_ip or r.client_ip,
+            h.user_agent[0] if h.user_agent else None,
+            h.forwarded_for[0] if h.forwarded_for else None,
+            h.real_ip[0] if h.real_ip else None,
+        )
+
+    return _decode_msgspec
+
+
+def get_decoder(name=None):
+    """Return (backend_name, decode) where decode(bytes) -> LogRecord or None.
+
+    name: 'msgspec', 'orjson', 'json', or None/'auto' for the fastest one
+    installed. Decoders raise ValueError (or UnicodeDecodeError) on bad JSON."""
+    factories = {'msgspec': _make_msgspec_decoder, 'orjson': _make_orjson_decoder}
+    if name in (None, '', 'auto'):
+        for candidate in DECODER_BACKENDS[:-1]:
+            try:
+                return candidate, factories[candidate]()
+            except ImportError:
+                continue
+        return 'json', _decode_json
+    if name == 'json':
+        return 'json', _decode_json
+    if name not in factories:
+        raise ValueError(f"Unknown decoder backend '{name}' (expected one of {', '.join(DECODER_BACKENDS)})")
+    return name, factories[name]()
+
+
+def configure_decoder(name=None):
+    """Select the log decoder backend used by ingestion and backfill.
+    Falls back to the stdlib decoder if the requested backend is not installed."""
+    global _decoder_name, _decode_record
+    try:
+        _decoder_name, _decode_record = get_decoder(name)
+    except ImportError:
+        print(f"Stats: decoder backend '{name}' is not installed, using json.")
+        _decoder_name, _decode_record = 'json', _decode_json
+    return _decoder_name
+
+
+_decoder_name, _decode_record = 'json', _decode_json
+configure_decoder(os.environ.get('STATS_LOG_DECODER'))
+
+
+# Caddy writes TLS, admin, pki... lines to the same stream as the access log.
+# They are recognised from the raw bytes, before any JSON decoding.
+DEFAULT_LOGGER_INCLUDE = ('http.log.access',)
+_LOGGER_FIELD = b'"logger":'
+_logger_include = DEFAULT_LOGGER_INCLUDE
+_logger_exclude = ()
+_logger_decisions = {}  # logger name (bytes) -> accepted?
+
+
+def _split_names(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(n.strip() for n in value or () if n and n.strip())
+
+
+def configure_logger_filter(include=None, exclude=None):
+    """Set which Caddy loggers are ingested. Names match themselves and their
+    children ('http.log.access' matches 'http.log.access.log0'); exclude wins.
+    include/exclude: iterables or comma separated strings. An empty include
+    accepts every logger not excluded."""
+    global _logger_include, _logger_exclude
+    _logger_include = _split_names(include) if include is not None else DEFAULT_LOGGER_INCLUDE
+    _logger_exclude = _split_names(exclude)
+    _logger_decisions.clear()
+
+
+def _logger_matches(name, patterns):
+    return any(name == p or name.startswith(p + '.') for p in patterns)
+
+
+def _rejected_logger(line):
+    """Return the logger name (str) if this raw line must be skipped, else None.
+    Lines without a "logger" field are kept (custom log formats, tests)."""
+    i = line.find(_LOGGER_FIELD)
+    if i < 0:
+        return None
+    i += len(_LOGGER_FIELD)
+    while line[i:i + 1] == b' ':
+        i += 1
+    if line[i:i + 1] != b'"':
+        return None
+    i += 1
+    name = line[i:line.find(b'"', i)]
+    accepted = _logger_decisions.get(name)
+    if accepted is None:
+        text = name.decode('utf-8', 'replace')
+        accepted = ((not _logger_include or _logger_matches(text, _logger_include))
+                    and not _logger_matches(text, _logger_exclude))
+        if len(_logger_decisions) < 1024:
+            _logger_decisions[name] = accepted
+    if accepted:
+        return None
+    return name.decode('utf-8', 'replace')
+
+
+configure_logger_filter(os.environ.get('STATS_LOGGER_INCLUDE'), os.environ.get('STATS_LOGGER_EXCLUDE'))
 
 
 # ---------------------------------------------------------------------------
 # Log processing
 # ---------------------------------------------------------------------------
 
+def _new_bucket():
+    """Return an empty per-(bucket, host) accumulator."""
+    return {
+        'total': 0, 'status_1xx': 0, 'status_2xx': 0, 'status_3xx': 0,
+        'status_4xx': 0, 'status_5xx': 0, 'total_duration': 0.0,
+        'total_size': 0, 'error_count': 0,
+        'top_paths': {}, 'top_uas': {}, 'top_countries': {},
+        'visitors': HyperLogLog(), 'latency': LatencyHistogram(),
+    }
+
+
+def _fold_entry(buckets, rec, ts):
+    """Fold one decoded LogRecord into the per-(epoch hour, host) accumulators."""
+    hour = int(ts) // 3600
+
+    host = rec.host
+    status = int(rec.status)
+    duration = float(rec.duration)
+    size = int(rec.size)
+
+    uri = rec.uri
+    path = uri.split('?')[0] if isinstance(uri, str) and uri else '/'
+
+    ua_full = rec.user_agent if isinstance(rec.user_agent, str) else 'Unknown'
+    ua_simple = ua_full.split('/')[0].split('(')[0].strip() or 'Unknown'
+
+    key = (hour, host)
+    b = buckets.get(key)
+    if b is None:
+        b = buckets[key] = _new_bucket()
+
+    b['total'] += 1
+    if 100 <= status <= 199:
+        b['status_1xx'] += 1
+    elif 200 <= status <= 299:
+        b['status_2xx'] += 1
+    elif 300 <= status <= 399:
+        b['status_3xx'] += 1
+    elif 400 <= status <= 499:
+        b['status_4xx'] += 1
+    elif 500 <= status <= 599:
+        b['status_5xx'] += 1
+        b['error_count'] += 1
+    b['total_duration'] += duration
+    b['latency'].add(duration)
+    b['total_size'] += size
+    if _live_writer is not None:
+        _live_writer.add(ts, host, status, duration, size)
+    b['top_paths'][path] = b['top_paths'].get(path, 0) + 1
+    b['top_uas'][ua_simple] = b['top_uas'].get(ua_simple, 0) + 1
+
+    # GeoIP: resolve client IP to country
+    client_ip = rec.ip
+    if not client_ip:
+        # Fallback: check X-Forwarded-For or X-Real-IP headers
+        if rec.forwarded_for:
+            client_ip = rec.forwarded_for.split(',')[0].strip()
+        elif rec.real_ip:
+            client_ip = rec.real_ip
+    if client_ip:
+        b['visitors'].add(client_ip)
+    country = _resolve_country(client_ip)
+    if country != 'Unknown':
+        b['top_countries'][country] = b['top_countries'].get(country, 0) + 1
+
+
+def _decode_and_fold(buckets, raw, ts_limit=None, skipped=None):
+    """Decode one raw log line (bytes, newline included) and fold it into buckets.
+    Entries at or after `ts_limit` (if given) are skipped, as are lines from
+    loggers rejected by the logger filter (counted per logger in `skipped`).
+    Returns the entry's epoch timestamp, or 0.0 if the line was skipped."""
+    line = raw.strip()
+    if not line:
+        return 0.0
+    logger = _rejected_logger(line)
+    if logger is not None:
+        if skipped is not None:
+            skipped[logger] = skipped.get(logger, 0) + 1
+        return 0.0
+    try:
+        rec = _decode_record(line)
+        if rec is None:
+            return 0.0
+        ts = _parse_ts(rec.ts)
+        if ts <= 0 or (ts_limit and ts >= ts_limit):
+            return 0.0
+        _fold_entry(buckets, rec, ts)
+    except (ValueError, TypeError, AttributeError):
+        # json.JSONDecodeError and UnicodeDecodeError are ValueErrors
+        return 0.0
+    return ts
+
+
+def _merge_bucket(dst, src):
+    """Add the counters and sketches of bucket `src` into bucket `dst`."""
+    for field in ('total', 'status_1xx', 'status_2xx', 'status_3xx', 'status_4xx',
+                  'status_5xx', 'total_duration', 'total_size', 'error_count'):
+        dst[field] += src[field]
+    for field in ('top_paths', 'top_uas', 'top_countries'):
+        _fold_top(dst[field], src[field])
+    dst['visitors'].merge(src['visitors'])
+    dst['latency'].merge(src['latency'])
+
+
+def _visitors_blob(sketch):
+    """Serialized visitors HyperLogLog; None when no client IP was seen."""
+    return sketch.to_bytes() if any(sketch.registers) else None
+
+
+def _latency_blob(histogram):
+    """Serialized latency histogram; None for a bucket without requests."""
+    return histogram.to_bytes() if histogram.count else None
+
+
+def _fold_top(sketch, value):
+    """Add a bucket's top-N field, exact counts (dict) or a SpaceSaving, to `sketch`."""
+    if isinstance(value, SpaceSaving):
+        sketch.merge(value)
+    else:
+        sketch.update(value)
+
+
+def _pack_bucket_sketches(bucket):
+    """Replace a bucket's exact top-N dicts, visitors and latency histogram with
+    serialized sketches (backfill IPC)."""
+    for field, capacity in _TOP_COLUMNS:
+        bucket[field] = SpaceSaving.from_counts(bucket[field], capacity).to_bytes()
+    bucket['visitors'] = bucket['visitors'].to_bytes()
+    bucket['latency'] = bucket['latency'].to_bytes()
+
+
+def _unpack_bucket_sketches(bucket):
+    for field, _ in _TOP_COLUMNS:
+        bucket[field] = SpaceSaving.from_bytes(bucket[field])
+    bucket['visitors'] = HyperLogLog.from_bytes(bucket['visitors'])
+    bucket['latency'] = LatencyHistogram.from_bytes(bucket['latency'])
+
+
+# Columns summed on conflict. Top-N data lives in the child tables (hourly_top,
+# daily_top); the bucket field names below are those of the old JSON columns.
+_COUNTER_COLUMNS = ('total', 'status_1xx', 'status_2xx', 'status_3xx', 'status_4xx', 'status_5xx',
+                    'total_duration', 'total_size', 'error_count')
+# (bucket field, Space-Saving capacity): keys just below the top-N of every hour
+# stay in the sketches and add up across the period
+_TOP_COLUMNS = tuple((field, n * TOP_SKETCH_FACTOR) for field, n in (
+    ('top_paths', TOP_N_PATHS), ('top_uas', TOP_N_UAS), ('top_countries', TOP_N_COUNTRIES)))
+DIM_PATH, DIM_UA, DIM_COUNTRY = 0, 1, 2  # top_keys.dim: index into _TOP_COLUMNS
+_TOP_TABLES = {'hourly_stats': 'hourly_top', 'daily_stats': 'daily_top',
+               'hourly_stats_new': 'hourly_top_new', 'daily_stats_new': 'daily_top_new'}  # layout migration
+_BUCKET_SECONDS = {'hourly_stats': ('hour', 3600), 'daily_stats': ('day', 86400)}
+_ALL_DIMS = "dim IN (0, 1, 2)"  # lets SQLite seek the (host_id, dim, bucket) primary key
+_SQL_IN_CHUNK = 500
+_KEY_ID_CACHE_MAX = 200000
+
+# Ids of interned strings, so a flush only touches `hosts` / `top_keys` for new
+# ones. Hosts are never deleted. Top keys are pruned by the rollup, which bumps
+# meta 'top_keys_generation'; writers compare it once per transaction. Both
+# caches are reset whenever a write transaction that may have added ids rolls back.
+_host_ids = {}  # host -> host_id
+_key_id_cache = {}  # (dim, key) -> key_id
+_key_id_generation = None
+
+
+def _reset_id_caches():
+    global _key_id_generation
+    _host_ids.clear()
+    _key_id_cache.clear()
+    _key_id_generation = None
+
+
+def _chunks(items, size=_SQL_IN_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _new_tops(host_id=None):
+    """Empty [paths, uas, countries] sketches for a bucket of `host_id`."""
+    factor = ALL_HOSTS_TOP_FACTOR if host_id == ALL_HOSTS_ID else 1
+    return [SpaceSaving(capacity * factor) for _, capacity in _TOP_COLUMNS]
+
+
+def _add_legacy_tops(tops, paths, uas, countries):
+    """Add not yet migrated JSON top-N blobs into [paths, uas, countries] sketches.
+    The blobs carry no floor: they are taken as exact counts."""
+    for sketch, blob in zip(tops, (paths, uas, countries)):
+        try:
+            sketch.update(json.loads(blob or '{}'))
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            pass
+
+
+def _key_chunks(keys):
+    """(bucket chunk, host_id chunk) pairs covering the (bucket, host_id) `keys`,
+    for `IN (...)` lookups of at most _SQL_IN_CHUNK parameters."""
+    half = _SQL_IN_CHUNK // 2
+    host_ids = sorted({h for _, h in keys})
+    for bucket_chunk in _chunks(sorted({k for k, _ in keys}), half):
+        for host_chunk in _chunks(host_ids, half):
+            yield bucket_chunk, host_chunk
+
+
+def _read_tops(conn, table, key_col, keys):
+    """Stored top-N sketches of the (bucket, host_id) `keys` of `table`:
+    {(bucket, host_id): [paths, uas, countries]}."""
+    top_table = _TOP_TABLES[table]
+    tops = {}
+    for bucket_chunk, host_chunk in _key_chunks(keys):
+        for bucket_key, host_id, dim, key, count, err in conn.execute(
+            f"SELECT t.{key_col}, t.host_id, t.dim, k.key, t.count, t.err FROM {top_table} t "
+            f"LEFT JOIN top_keys k ON k.key_id = t.key_id WHERE t.{_ALL_DIMS} "
+            f"AND t.{key_col} IN ({','.join('?' * len(bucket_chunk))}) "
+            f"AND t.host_id IN ({','.join('?' * len(host_chunk))})",
+            bucket_chunk + host_chunk,
+        ):
+            if (bucket_key, host_id) not in keys:
+                continue
+            sketch = tops.setdefault((bucket_key, host_id), _new_tops(host_id))[dim]
+            if key is None:
+                sketch.floor = count  # key_id 0
+            else:
+                sketch.counts[key] = count
+                sketch.errors[key] = err
+    for sketches in tops.values():
+        for sketch in sketches:
+            if sketch.floor:
+                for key in sketch.counts:
+                    sketch.counts[key] += sketch.floor
+    return tops
+
+
+def _read_sketch_blobs(conn, table, key_col, keys):
+    """Stored (visitors, latency) blobs of the (bucket, host_id) `keys` of `table`
+    that have a row."""
+    stored = {}
+    for bucket_chunk, host_chunk in _key_chunks(keys):
+        for bucket_key, host_id, visitors, latency in conn.execute(
+            f"SELECT {key_col}, host_id, visitors, latency FROM {table} "
+            f"WHERE {key_col} IN ({','.join('?' * len(bucket_chunk))}) "
+            f"AND host_id IN ({','.join('?' * len(host_chunk))})",
+            bucket_chunk + host_chunk,
+        ):
+            if (bucket_key, host_id) in keys:
+                stored[(bucket_key, host_id)] = (visitors, latency)
+    return stored
+
+
+def _intern(conn, table, id_col, lookup_cols, values):
+    """INSERT OR IGNORE `values` (tuples of `lookup_cols`) into `table` and return
+    {value: id} for them."""
+    ids = {}
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table} ({', '.join(lookup_cols)}) VALUES ({', '.join('?' * len(lookup_cols))})",
+        values,
+    )
+    *group_cols, col = lookup_cols
+    groups = {}
+    for value in values:
+        groups.setdefault(value[:-1], []).append(value[-1])
+    for group, members in groups.items():
+        for chunk in _chunks(members):
+            where = ''.join(f"{c} = ? AND " for c in group_cols)
+            for row in conn.execute(
+                f"SELECT {id_col}, {', '.join(lookup_cols)} FROM {table} "
+                f"WHERE {where}{col} IN ({','.join('?' * len(chunk))})",
+                list(group) + chunk,
+            ):
+                ids[tuple(row[1:])] = row[0]
+    return ids
+
+
+def _host_id_map(conn, hosts):
+    """{host: host_id} for `hosts`, interning new ones: in the caller's write
+    transaction if there is one, else in a short one of their own (hosts are
+    never deleted, so the ids stay valid whatever the caller does next)."""
+    missing = [(h,) for h in hosts if h not in _host_ids]
+    if missing:
+        def intern():
+            for (host,), host_id in _intern(conn, 'hosts', 'host_id', ('host',), missing).items():
+                _host_ids[host] = host_id
+
+        if conn.in_transaction:
+            intern()
+        else:
+            _write_transaction(conn, intern)
+    return {h: _host_ids[h] for h in hosts}
+
+
+def _key_ids(conn, dim_keys):
+    """Intern (dim, key) strings into top_keys; returns {(dim, key): key_id}.
+    Inside the caller's write transaction; cached ids are dropped when the rollup
+    pruned top_keys since they were read."""
+    global _key_id_generation
+    generation = _read_meta(conn, 'top_keys_generation', int, 0)
+    if generation != _key_id_generation or len(_key_id_cache) > _KEY_ID_CACHE_MAX:
+        _key_id_cache.clear()
+        _key_id_generation = generation
+    missing = [k for k in dim_keys if k not in _key_id_cache]
+    if missing:
+        _key_id_cache.update(_intern(conn, 'top_keys', 'key_id', ('dim', 'key'), missing))
+    return {k: _key_id_cache[k] for k in dim_keys}
+
+
+def _delete_tops(conn, table, key_col, keys):
+    """Delete the child rows of the (bucket, host_id) `keys` of `table`."""
+    conn.executemany(
+        f"DELETE FROM {_TOP_TABLES[table]} WHERE host_id = ? AND {_ALL_DIMS} AND {key_col} = ?",
+        [(host_id, bucket_key) for bucket_key, host_id in keys],
+    )
+
+
+def _top_rows(tops):
+    """Child table rows of the [paths, uas, countries] sketches of each
+    (bucket, host_id) in `tops`: (bucket, host_id, dim, key, count, err), where
+    key None is the sketch's floor (key_id 0)."""
+    rows = []
+    for (bucket_key, host_id), sketches in tops.items():
+        for dim, sketch in enumerate(sketches):
+            floor = sketch.floor
+            if floor:
+                rows.append((bucket_key, host_id, dim, None, floor, 0))
+            for key, count, err in sketch.top():
+                rows.append((bucket_key, host_id, dim, key, count - floor, err))
+    return rows
+
+
+def _replace_tops(conn, table, key_col, keys, rows):
+    """Replace the child rows of the (bucket, host_id) `keys` of `table` with
+    `rows` (see _top_rows), interning their keys. Caller owns the transaction."""
+    ids = _key_ids(conn, list({(dim, key) for _, _, dim, key, _, _ in rows if key is not None}))
+    _delete_tops(conn, table, key_col, keys)
+    conn.executemany(
+        f"INSERT INTO {_TOP_TABLES[table]} ({key_col}, host_id, dim, key_id, count, err) VALUES (?, ?, ?, ?, ?, ?)",
+        [(b, h, dim, 0 if key is None else ids[(dim, key)], count, err) for b, h, dim, key, count, err in rows],
+    )
+
+
+def _write_tops(conn, table, key_col, tops):
+    """Replace the child rows of each (bucket, host_id) in `tops` with its
+    [paths, uas, countries] sketches."""
+    _replace_tops(conn, table, key_col, list(tops), _top_rows(tops))
+
+
+# Buckets merged with what hourly_stats/daily_stats already holds for them:
+# `rows` for one executemany upsert, `top_keys` and `top_rows` for the child
+# table (see _prepare_upsert).
+_Upsert = namedtuple('_Upsert', 'table key_col rows top_keys top_rows')
+
+
+def _prepare_upsert(conn, table, key_col, buckets):
+    """Merge accumulated buckets, keyed (bucket, host_id), with the visitors,
+    latency and top-N sketches `table` (hourly_stats/daily_stats) holds for them
+    (read once for all keys) and serialize the results. Only reads, so it can
+    run before the write lock is taken; see _write_upsert(). Returns an _Upsert."""
+    tops = _read_tops(conn, table, key_col, buckets)
+    stored = _read_sketch_blobs(conn, table, key_col, buckets)
+    rows = []
+    for key, data in buckets.items():
+        merged = tops.setdefault(key, _new_tops(key[1]))
+        for sketch, (col, _) in zip(merged, _TOP_COLUMNS):
+            _fold_top(sketch, data[col])
+        visitors, latency = data['visitors'], data['latency']
+        stored_visitors, stored_latency = stored.get(key, (None, None))
+        if stored_visitors:
+            visitors = HyperLogLog.from_bytes(stored_visitors)
+            visitors.merge(data['visitors'])
+        if stored_latency:
+            latency = LatencyHistogram.from_bytes(stored_latency)
+            latency.merge(data['latency'])
+        rows.append((key[0], key[1], *(data[c] for c in _COUNTER_COLUMNS),
+                     _visitors_blob(visitors), _latency_blob(latency)))
+    return _Upsert(table, key_col, rows, list(tops), _top_rows(tops))
+
+
+def _write_upsert(conn, upsert):
+    """Write an _Upsert: counters added, visitors and latency replaced by the
+    merged sketches, the top-N child rows replaced. Caller owns the write transaction, and no
+    other writer may have changed the rows since _prepare_upsert() read them."""
+    if not upsert.rows:
+        return
+    columns = (upsert.key_col, 'host_id') + _COUNTER_COLUMNS + ('visitors', 'latency')
+    updates = [f"{c} = {c} + excluded.{c}" for c in _COUNTER_COLUMNS]
+    updates += ["visitors = excluded.visitors", "latency = excluded.latency"]
+    conn.executemany(
+        f"INSERT INTO {upsert.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT({upsert.key_col}, host_id) DO UPDATE SET {', '.join(updates)}",
+        upsert.rows,
+    )
+    _replace_tops(conn, upsert.table, upsert.key_col, upsert.top_keys, upsert.top_rows)
+
+
+def _upsert_buckets(conn, table, key_col, buckets):
+    """Add accumulated buckets, keyed (bucket, host_id), to `table`
+    (hourly_stats/daily_stats). Caller owns the write transaction."""
+    if buckets:
+        _write_upsert(conn, _prepare_upsert(conn, table, key_col, buckets))
+
+
+def _by_host_id(conn, buckets):
+    """Re-key ingest accumulators from (bucket, host name) to (bucket, host_id)."""
+    ids = _host_id_map(conn, {host for _, host in buckets})
+    return {(bucket_key, ids[host]): b for (bucket_key, host), b in buckets.items()}
+
+
+def _new_sketch_bucket(host_id=None):
+    """An empty bucket with top-N sketches sized for `host_id`, to merge others into."""
+    bucket = _new_bucket()
+    for (field, _), sketch in zip(_TOP_COLUMNS, _new_tops(host_id)):
+        bucket[field] = sketch
+    return bucket
+
+
+def _with_all_hosts(buckets):
+    """`buckets`, keyed (bucket, host_id), plus their sum per bucket under ALL_HOSTS_ID."""
+    result = dict(buckets)
+    for (bucket_key, _), b in buckets.items():
+        key = (bucket_key, ALL_HOSTS_ID)
+        if key not in result:
+            result[key] = _new_sketch_bucket(ALL_HOSTS_ID)
+        _merge_bucket(result[key], b)
+    return result
+
+
+def _flush_hourly_buckets(conn, buckets):
+    """Merge accumulated (hour, host) buckets into hourly_stats. Caller owns the transaction."""
+    _upsert_buckets(conn, 'hourly_stats', 'hour', _with_all_hosts(_by_host_id(conn, buckets)))
+
+
+def _read_snapshot(conn, fn):
+    """Run fn() in one read transaction on `conn`, without the write lock.
+    Returns (the snapshot's meta 'generation', fn()'s result): every bucket
+    writer bumps the generation, so a caller that takes the write lock later
+    can tell whether what fn() read is still current."""
+    conn.execute("BEGIN")
+    try:
+        return _read_meta(conn, 'generation', int, 0), fn()
+    finally:
+        conn.rollback()
+
+
+def _prepare_hourly(conn, buckets):
+    """Everything of merging (hour, host) buckets into hourly_stats that needs no
+    write lock: host ids (new hosts are interned in their own short
+    transaction), the all-hosts rows and _prepare_upsert() in a read snapshot.
+    Returns (buckets keyed (hour, host_id) with their all-hosts rows, the
+    snapshot's meta 'generation', _Upsert)."""
+    keyed = _with_all_hosts(_by_host_id(conn, buckets))
+    generation, upsert = _read_snapshot(conn, lambda: _prepare_upsert(conn, 'hourly_stats', 'hour', keyed))
+    return keyed, generation, upsert
+
+
+def _split_backfill(buckets, watermark, daily_cutoff):
+    """Split merged backfill buckets, keyed (hour, host_id): days the rollup has
+    already finalised (up to `watermark`) are summed per (day, host_id) for
+    daily_stats, the others stay hourly (the rollup moves them on when they are
+    old enough), days before `daily_cutoff` are dropped. `buckets` is left as is.
+    Returns (hourly buckets, daily buckets)."""
+    hourly_buckets = {}
+    daily_buckets = {}
+    for (hour, host_id), b in buckets.items():
+        day = hour // 24
+        if day > watermark:
+            hourly_buckets[(hour, host_id)] = b
+        elif day >= daily_cutoff:
+            key = (day, host_id)
+            if key not in daily_buckets:
+                daily_buckets[key] = _new_sketch_bucket(host_id)
+            _merge_bucket(daily_buckets[key], b)
+    return hourly_buckets, daily_buckets
+
+
+def _prepare_backfill(conn, buckets, daily_cutoff):
+    """Split backfill buckets, keyed (hour, host_id), at the current rollup
+    watermark and _prepare_upsert() them, with their all-hosts rows, for
+    hourly_stats and daily_stats. Only reads. Returns (hourly buckets, daily
+    buckets, [_Upsert])."""
+    hourly_buckets, daily_buckets = _split_backfill(buckets, _rollup_watermark(conn), daily_cutoff)
+    return hourly_buckets, daily_buckets, [
+        _prepare_upsert(conn, 'hourly_stats', 'hour', _with_all_hosts(hourly_buckets)),
+        _prepare_upsert(conn, 'daily_stats', 'day', _with_all_hosts(daily_buckets)),
+    ]
+
+
+def _file_fingerprint(path):
+    """Identify a log file by a hash of its first line. The first line survives
+    renames (caddy_access.json.log -> .1) and gzip, unlike the inode or the name.
+    Returns None while the file has no complete first line."""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            first = f.readline(FINGERPRINT_MAX_BYTES)
+    except (OSError, EOFError):
+        return None
+    if not first.endswith(b'\n') and len(first) < FINGERPRINT_MAX_BYTES:
+        return None
+    return hashlib.sha1(first).hexdigest()
+
+
+_FILE_END_MARK = -1  # ingested_ranges.start_offset of a file's end marker
+
+
+def _record_range(conn, fingerprint, start, end):
+    """Mark bytes [start, end) of a log file as ingested, coalescing with
+    overlapping or adjacent ranges. Caller owns the transaction."""
+    if not fingerprint or end <= start:
+        return
+    rows = conn.execute(
+        "SELECT start_offset, end_offset FROM ingested_ranges "
+        "WHERE fingerprint = ? AND end_offset >= ? AND start_offset <= ? AND start_offset >= 0",
+        (fingerprint, start, end),
+    ).fetchall()
+    for r_start, r_end in rows:
+        start = min(start, r_start)
+        end = max(end, r_end)
+    conn.execute(
+        "DELETE FROM ingested_ranges WHERE fingerprint = ? AND end_offset >= ? AND start_offset <= ? "
+        "AND start_offset >= 0",
+        (fingerprint, start, end),
+    )
+    conn.execute(
+        "INSERT INTO ingested_ranges (fingerprint, start_offset, end_offset) VALUES (?, ?, ?)",
+        (fingerprint, start, end),
+    )
+
+
+def _record_file_end(conn, fingerprint, size):
+    """Record that a log file (a gzip archive) ends at `size`: once its ranges
+    cover [0, size), _missing_ranges() has nothing left to read in it."""
+    conn.execute(
+        "INSERT OR REPLACE INTO ingested_ranges (fingerprint, start_offset, end_offset) VALUES (?, ?, ?)",
+        (fingerprint, _FILE_END_MARK, size),
+    )
+
+
+def _read_meta(conn, key, cast, default):
+    """Read one value from the meta table, cast it, fall back to default."""
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    if row:
+        try:
+            return cast(row[0])
+        except (ValueError, TypeError):
+            pass
+    return default
+
+
+def _bump_generation(conn):
+    """Count a write that changes what get_stats returns (meta 'generation');
+    cached results of older generations are no longer used. In the caller's
+    transaction, which calls _publish_generation() once committed."""
+    global _generation_dirty
+    _generation_dirty = True
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES ('generation', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+
+
+def _write_generation_file(conn):
+    """Copy stats.db's db_id and committed generation to _generation_path."""
+    meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('db_id', 'generation')"))
+    tmp = f"{_generation_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(f"{meta.get('db_id')}:{meta.get('generation', 0)}")
+        os.replace(tmp, _generation_path)
+    except OSError as e:
+        print(f"Stats: could not write {_generation_path}: {e}")
+
+
+def _publish_generation(conn):
+    """After a commit: update the generation file if the transaction bumped the
+    generation (reading the committed value, so a rolled back bump is harmless)."""
+    global _generation_dirty
+    if _generation_dirty:
+        _generation_dirty = False
+        _write_generation_file(conn)
+
+
+def stats_etag(*parts):
+    """ETag of a stats API response built from stats.db and `parts` (the request
+    path and arguments), without opening SQLite: it hashes the generation file
+    the writers update after every commit that changes results, and changes at
+    least every ETAG_TTL_SECONDS. None if there is no generation file."""
+    try:
+        with open(_generation_path) as f:
+            generation = f.read()
+    except (OSError, TypeError):
+        return None
+    if not generation:
+        return None
+    window = int(time_module.time()) // ETAG_TTL_SECONDS
+    return hashlib.blake2b(repr((generation, window, parts)).encode(), digest_size=12).hexdigest()
+
+
+def _add_skipped_loggers(conn, skipped):
+    """Add per-logger counts of filtered lines to meta 'skipped_loggers'. In the caller's transaction."""
+    if not skipped:
+        return
+    totals = _read_meta(conn, 'skipped_loggers', json.loads, {})
+    for name, count in skipped.items():
+        totals[name] = totals.get(name, 0) + count
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('skipped_loggers', ?)", (json.dumps(totals),))
+
+
+def _checkpoint(conn, buckets, expected_offset, range_start, new_offset, max_ts, log_info, skipped=None):
+    """Commit accumulated buckets together with the new byte offset and the
+    identity of the file it refers to, and record bytes [range_start, new_offset)
+    of that file as ingested. `skipped` holds the filtered-out lines per logger.
+
+    The write lock is only taken here, never while reading or decoding, and
+    only for writing rows merged beforehand (_prepare_hourly); they are merged
+    again under the lock only if another writer, e.g. a backfill, committed in
+    between. Returns False (and writes nothing) if another process moved the
+    offset since we read it, so the same lines can never be counted twice. The
+    live ring is published or rolled back along with the transaction."""
+    try:
+        if buckets:
+            keyed, generation, upsert = _prepare_hourly(conn, buckets)
+        conn.execute("BEGIN IMMEDIATE")
+        stored_offset = _read_meta(conn, 'last_processed_offset', int, 0)
+        if stored_offset != expected_offset:
+            conn.execute("ROLLBACK")
+            print(f"Stats: offset moved by another ingester ({expected_offset} -> {stored_offset}), stopping.")
+            if _live_writer is not None:
+                _live_writer.discard()
+            return False
+        if buckets:
+            if _read_meta(conn, 'generation', int, 0) != generation:
+                upsert = _prepare_upsert(conn, 'hourly_stats', 'hour', keyed)
+            _write_upsert(conn, upsert)
+            _bump_generation(conn)
+        _add_skipped_loggers(conn, skipped)
+        _record_range(conn, log_info['fingerprint'], range_start, new_offset)
+        stored_ts = _read_meta(conn, 'last_processed_ts', float, 0.0)
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [
+                ('last_processed_ts', str(max(stored_ts, max_ts))),
+                ('last_processed_offset', str(new_offset)),
+                ('last_file_size', str(log_info['size'])),
+                ('last_processed_fingerprint', log_info['fingerprint'] or ''),
+                ('last_processed_inode', str(log_info['inode'])),
+                ('last_processed_device', str(log_info['device'])),
+            ] + ([('last_ingest_ts', str(time_module.time()))] if buckets else []),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _reset_id_caches()
+        if _live_writer is not None:
+            _live_writer.discard()
+        raise
+    _publish_generation(conn)
+    if _live_writer is not None:
+        _live_writer.publish()
+    return True
+
+
+def _open_log(path):
+    """Open a plain log file and describe it from the opened descriptor, so the
+    identity always matches the bytes we read even if the name is rotated away
+    in between. Returns (file, info); raises OSError if it cannot be opened."""
+    f = open(path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        first = os.pread(f.fileno(), FINGERPRINT_MAX_BYTES, 0)
+    except OSError:
+        f.close()
+        raise
+    newline = first.find(b'\n')
+    if newline >= 0:
+        fingerprint = hashlib.sha1(first[:newline + 1]).hexdigest()
+    elif len(first) >= FINGERPRINT_MAX_BYTES:
+        fingerprint = hashlib.sha1(first).hexdigest()
+    else:
+        fingerprint = None
+    return f, {
+        'path': Path(path), 'fingerprint': fingerprint,
+        'inode': st.st_ino, 'device': st.st_dev, 'size': st.st_size,
+    }
+
+
+def _rotated_backups(log_path):
+    """Plain rotated backups of the access log, newest first (name.1, name.2, ...)."""
+    return sorted(
+        (p for p in log_path.parent.glob(log_path.name + '.*')
+         if p.suffix != '.gz' and p.is_file()),
+        key=lambda p: (len(p.name), p.name),
+    )
+
+
+def _find_rotated_log(log_path, fingerprint, inode, device):
+    """Find the renamed predecessor of the access log (name.1, name.2, ...).
+    Prefers a same-inode match (rename), falls back to the first-line
+    fingerprint (copy). Returns an open (file, info) or None."""
+    fallback = None
+    for candidate in _rotated_backups(log_path):
+        try:
+            f, info = _open_log(candidate)
+        except OSError:
+            continue
+        if (info['inode'], info['device']) == (inode, device) and info['fingerprint'] == fingerprint:
+            if fallback:
+                fallback[0].close()
+            return f, info
+        if fallback is None and info['fingerprint'] == fingerprint:
+            fallback = (f, info)
+        else:
+            f.close()
+    return fallback
+
+
+def _ingest_stream(conn, f, log_info, start_offset, expected_offset, tail_only=False, max_lines=None):
+    """Stream complete lines of an open log file from `start_offset` to its
+    current end, checkpointing every CHECKPOINT_LINES lines.
+
+    tail_only: skip to the last MAX_INITIAL_BYTES first (first run).
+    Returns (entries processed, offset now stored in meta), or
+    (entries processed, None) if another process took over the file."""
+    processed = 0
+    pending = 0
+    buckets = {}
+    skipped = {}
+    max_ts = 0.0
+    committed_offset = expected_offset
+
+    if tail_only and log_info['size'] > MAX_INITIAL_BYTES:
+        f.seek(log_info['size'] - MAX_INITIAL_BYTES)
+        f.readline()  # discard partial first line
+    else:
+        f.seek(start_offset)
+    offset = range_start = f.tell()
+
+    try:
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break  # incomplete last line, re-read next time
+            offset += len(raw)
+            ts = _decode_and_fold(buckets, raw, skipped=skipped)
+            if not ts:
+                continue
+            max_ts = max(max_ts, ts)
+            processed += 1
+            pending += 1
+
+            if pending >= CHECKPOINT_LINES:
+                if not _checkpoint(conn, buckets, committed_offset, range_start, offset, max_ts, log_info, skipped):
+                    return processed - pending, None
+                committed_offset = range_start = offset
+                buckets = {}
+                skipped = {}
+                pending = 0
+            if max_lines is not None and processed >= max_lines:
+                break
+    except IOError as e:
+        print(f"Error reading log file {log_info['path']}: {e}")
+        return processed - pending, committed_offset
+
+    if offset != committed_offset or buckets or range_start != offset:
+        if not _checkpoint(conn, buckets, committed_offset, range_start, offset, max_ts, log_info, skipped):
+            return processed - pending, None
+        committed_offset = offset
+    return processed, committed_offset
+
+
 def process_new_logs(log_file_path):
     """Process new Caddy access log entries since last processing.
 
+    Streams the log: each line is decoded, folded straight into the
+    per-(hour, host) accumulators and discarded, so memory depends on the
+    number of buckets, not the number of lines. Every CHECKPOINT_LINES lines
+    the buckets and the byte offset are committed together, so a crash during
+    a long catch-up resumes from the last checkpoint. A trailing line without
+    its newline is left for the next call (Caddy may still be writing it).
+
     Uses byte offset tracking for efficiency. On first run (no offset stored),
     reads only the tail of the log file to avoid processing huge history.
 
+    Rotation: the file identity (inode/device and a fingerprint of the first
+    line) is stored with the offset. When the log was rotated, the renamed
+    file (name.1) is first read from the stored offset to its end, then the
+    new file is read from the start, so nothing is skipped or read twice.
+
     Returns the number of new entries processed.
     """
-    if _db_path is None:
+    if _db_path is None or _text_layout:  # see migrate_text_layout()
         return 0
 
     log_path = Path(log_file_path) if not isinstance(log_file_path, Path) else log_file_path
-    if not log_path.exists():
+    try:
+        f, info = _open_log(log_path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        print(f"Error reading log file {log_path}: {e}")
         return 0
 
-    current_size = log_path.stat().st_size
+    conn = _write_conn()
+    try:
+        with f:
+            if info['fingerprint'] is None:
+                return 0  # not even one complete line yet
+
+            last_ts = _read_meta(conn, 'last_processed_ts', float, 0.0)
+            last_offset = _read_meta(conn, 'last_processed_offset', int, 0)
+            last_fingerprint = _read_meta(conn, 'last_processed_fingerprint', str, '')
+            last_inode = _read_meta(conn, 'last_processed_inode', int, None)
+            last_device = _read_meta(conn, 'last_processed_device', int, None)
+            expected_offset = last_offset
+            processed = 0
+            tail_only = (last_offset == 0 and last_ts == 0.0 and not last_fingerprint)
+
+            if last_fingerprint and info['fingerprint'] != last_fingerprint:
+                # Rotated: finish the old file before starting on the new one.
+                old = _find_rotated_log(log_path, last_fingerprint, last_inode, last_device)
+                if old is None:
+                    print(f"Stats: {log_path} was rotated but its previous file was not found; "
+                          f"entries after offset {last_offset} of it are lost "
+                          f"(recoverable with 'python -m stats_aggregator backfill').")
+                else:
+                    old_f, old_info = old
+                    with old_f:
+                        count, expected_offset = _ingest_stream(conn, old_f, old_info, last_offset, last_offset)
+                    processed += count
+                    if expected_offset is None:
+                        return processed
+                    if count:
+                        print(f"Stats: finished rotated log {old_info['path']} ({count} entries).")
+
+                    # Rotated more than once since the last poll: the backups newer
+                    # than the old file were never seen, read them in full, oldest first.
+                    backups = _rotated_backups(log_path)
+                    newer = backups[:backups.index(old_info['path'])] if old_info['path'] in backups else []
+                    for backup in reversed(newer):
+                        try:
+                            backup_f, backup_info = _open_log(backup)
+                        except OSError:
+                            continue
+                        with backup_f:
+                            if backup_info['fingerprint'] is None or conn.execute(
+                                "SELECT 1 FROM ingested_ranges WHERE fingerprint = ?",
+                                (backup_info['fingerprint'],),
+                            ).fetchone():
+                                continue
+                            count, expected_offset = _ingest_stream(conn, backup_f, backup_info, 0, expected_offset)
+                        processed += count
+                        if expected_offset is None:
+                            return processed
+                        print(f"Stats: read intermediate rotated log {backup} ({count} entries).")
+                last_offset = 0
+            elif info['size'] < last_offset:
+                # Same file, but smaller: truncated in place. Start over.
+                print(f"Stats: {log_path} was truncated, reading it from the start.")
+                last_offset = 0
+
+            if info['size'] <= last_offset:
+                return processed
+
+            count, _ = _ingest_stream(
+                conn, f, info, last_offset, expected_offset,
+                tail_only=tail_only, max_lines=MAX_INITIAL_LINES if tail_only else None,
+            )
+            processed += count
+    finally:
+        _release_conn(conn)
 
-    conn = _get_conn()
-    conn.execute("BEGIN IMMEDIATE")
+    return processed
 
-    # Read last processed state
-    last_ts = 0.0
-    last_offset = 0
-    row = conn.execute("SELECT value FROM meta WHERE key = 'last_processed_ts'").fetchone()
-    if row:
-        try:
-            last_ts = float(row[0])
-        except (ValueError, TypeError):
-            pass
-    row = conn.execute("SELECT value FROM meta WHERE key = 'last_processed_offset'").fetchone()
-    if row:
-        try:
-            last_offset = int(row[0])
-        except (ValueError, TypeError):
-            pass
 
-    # Detect log rotation (file got smaller than our last offset)
-    if current_size < last_offset:
-        last_offset = 0
-        last_ts = 0.0
+# ---------------------------------------------------------------------------
+# Rollup
+# ---------------------------------------------------------------------------
 
-    if current_size <= last_offset:
-        conn.execute("ROLLBACK")
-        conn.close()
-        return 0
+def _retention_cutoffs(now_ts=None):
+    """(first epoch day kept in hourly_stats, first epoch day kept in daily_stats)."""
+    if now_ts is None:
+        now_ts = time_module.time()
+    now_ts = int(now_ts)
+    return ((now_ts - HOURLY_RETENTION_DAYS * 86400) // 86400,
+            (now_ts - DAILY_RETENTION_DAYS * 86400) // 86400)
 
-    # Read new log entries
-    new_entries = []
-    max_ts = last_ts
-    new_offset = last_offset
-    is_first_run = (last_offset == 0 and last_ts == 0.0)
-
-    try:
-        with open(log_path, 'r', encoding='utf-8') as f:
-            if is_first_run:
-                # First run: seek near end of file to avoid reading huge history
-                if current_size > MAX_INITIAL_BYTES:
-                    f.seek(current_size - MAX_INITIAL_BYTES)
-                    f.readline()  # discard partial first line
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if len(new_entries) >= MAX_INITIAL_LINES:
-                        break
-                    try:
-                        entry = json.loads(line)
-                        ts = _parse_ts(entry.get('ts', 0))
-                        if ts > 0:
-                            entry['_ts_epoch'] = ts
-                            new_entries.append(entry)
-                            max_ts = max(max_ts, ts)
-                    except (json.JSONDecodeError, ValueError):
-                        continue
-                new_offset = f.tell()
-            else:
-                # Subsequent runs: read from last offset
-                f.seek(last_offset)
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        entry = json.loads(line)
-                        ts = _parse_ts(entry.get('ts', 0))
-                        if ts > 0:
-                            entry['_ts_epoch'] = ts
-                            new_entries.append(entry)
-                            max_ts = max(max_ts, ts)
-                    except (json.JSONDecodeError, ValueError):
-                        continue
-                new_offset = f.tell()
-    except IOError as e:
-        print(f"Error reading log file {log_path}: {e}")
-        conn.execute("ROLLBACK")
-        conn.close()
-        return 0
 
-    if not new_entries:
-        # No new processable entries, update offset anyway
-        conn.execute(
-            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_offset', ?)",
-            (str(new_offset),),
-        )
-        conn.execute(
-            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_file_size', ?)",
-            (str(current_size),),
-        )
+def _rollup_watermark(conn):
+    """Last epoch day whose hours are in daily_stats (set by init_stats_db, then
+    only advanced by the rollup)."""
+    return _read_meta(conn, 'rollup_watermark_day', int, _retention_cutoffs()[0] - 1)
+
+
+def rollup_old_buckets(max_seconds=None):
+    """Consolidate hourly_stats older than HOURLY_RETENTION_DAYS into daily_stats
+    and delete daily_stats older than DAILY_RETENTION_DAYS, one day per
+    transaction so the write lock is only held for one day's rows.
+
+    Checking for work is two index seeks without a write lock; the ingester calls
+    this after every batch. max_seconds: stop after the step that exceeds it
+    (catching up after downtime is spread over several calls). Strings no bucket
+    refers to any more are pruned from top_keys at most every ROLLUP_INTERVAL_SECONDS.
+    Returns True when nothing is left to do."""
+    if _db_path is None:
+        return True
+
+    started = time_module.monotonic()
+    conn = _write_conn()
+    try:
+        while True:
+            hourly_cutoff, daily_cutoff = _retention_cutoffs()
+            hour = conn.execute(
+                "SELECT MIN(hour) FROM hourly_stats WHERE hour < ?", (hourly_cutoff * 24,)
+            ).fetchone()[0]
+            day = conn.execute(
+                "SELECT MIN(day) FROM daily_stats WHERE day < ?", (daily_cutoff,)
+            ).fetchone()[0]
+            if hour is None and day is None:
+                break
+            _rollup_step(conn, hourly_cutoff, daily_cutoff)
+            if max_seconds is not None and time_module.monotonic() - started >= max_seconds:
+                return False
+
+        if time_module.time() - _read_meta(conn, 'last_rollup_ts', float, 0.0) >= ROLLUP_INTERVAL_SECONDS:
+            _prune_top_keys(conn)
+    finally:
+        _release_conn(conn)
+    return True
+
+
+def _write_transaction(conn, fn):
+    """Run fn() in a BEGIN IMMEDIATE transaction on `conn`; returns its result."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn()
         conn.commit()
-        conn.close()
-        return 0
+        _publish_generation(conn)
+        return result
+    except Exception:
+        conn.rollback()
+        _reset_id_caches()
+        raise
+
+
+def _rollup_step(conn, hourly_cutoff, daily_cutoff):
+    """Roll up the oldest day of hourly_stats before `hourly_cutoff`, or else
+    delete the oldest day of daily_stats before `daily_cutoff`, in one transaction."""
+    def step():
+        hour = conn.execute(
+            "SELECT MIN(hour) FROM hourly_stats WHERE hour < ?", (hourly_cutoff * 24,)
+        ).fetchone()[0]
+        if hour is not None:
+            _rollup_day(conn, hour // 24)
+            _bump_generation(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_watermark_day', ?)",
+                (str(max(_rollup_watermark(conn), hour // 24)),),
+            )
+            return
+        day = conn.execute(
+            "SELECT MIN(day) FROM daily_stats WHERE day < ?", (daily_cutoff,)
+        ).fetchone()[0]
+        if day is not None:
+            _delete_tops(conn, 'daily_stats', 'day', conn.execute(
+                "SELECT day, host_id FROM daily_stats WHERE day = ?", (day,)
+            ).fetchall())
+            conn.execute("DELETE FROM daily_stats WHERE day = ?", (day,))
+            _bump_generation(conn)
+            print(f"Stats: pruned daily_stats of {_day_label(day)}.")
+
+    _write_transaction(conn, step)
+
+
+def _read_buckets(conn, table, key_col, where, params, rekey):
+    """Read the rows of `table` matching `where` with their top-N sketches and
+    merge them into buckets keyed rekey(bucket, host_id).
+    Returns (buckets, [(bucket, host_id) of the rows read])."""
+    rows = conn.execute(
+        f"SELECT {key_col}, host_id, total, status_1xx, status_2xx, status_3xx, status_4xx, "
+        f"status_5xx, total_duration, total_size, error_count, visitors, latency "
+        f"FROM {table} WHERE {where}",
+        params,
+    ).fetchall()
 
-    # Aggregate new entries by (bucket_hour, host)
+    tops = _read_tops(conn, table, key_col, {(r[0], r[1]) for r in rows})
     buckets = {}
-    for entry in new_entries:
-        ts = entry.get('_ts_epoch', _parse_ts(entry.get('ts', 0)))
-        dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-        bucket_hour = dt.strftime('%Y-%m-%dT%H')
-
-        request = entry.get('request', {})
-        if not isinstance(request, dict):
-            request = {}
-        host = request.get('host', entry.get('host', 'Unknown'))
-        status = int(entry.get('status', 0))
-        duration = float(entry.get('duration', 0))
-        size = int(entry.get('size', 0))
-
-        uri = request.get('uri', '/')
-        path = uri.split('?')[0] if isinstance(uri, str) and uri else '/'
-
-        headers = request.get('headers', {})
-        if not isinstance(headers, dict):
-            headers = {}
-        ua_list = headers.get('User-Agent', ['Unknown'])
-        if not isinstance(ua_list, list):
-            ua_list = ['Unknown']
-        ua_full = ua_list[0] if ua_list else 'Unknown'
-        ua_simple = ua_full.split('/')[0].split('(')[0].strip() or 'Unknown'
-
-        key = (bucket_hour, host)
+    for row in rows:
+        key = rekey(row[0], row[1])
+
         if key not in buckets:
-            buckets[key] = {
-                'total': 0, 'status_1xx': 0, 'status_2xx': 0, 'status_3xx': 0,
-                'status_4xx': 0, 'status_5xx': 0, 'total_duration': 0.0,
-                'total_size': 0, 'error_count': 0,
-                'top_paths': {}, 'top_uas': {}, 'top_countries': {},
-            }
+            buckets[key] = _new_bucket()
+            for (field, _), sketch in zip(_TOP_COLUMNS, _new_tops(key[1])):
+                buckets[key][field] = sketch
 
         b = buckets[key]
-        b['total'] += 1
-        if 100 <= status <= 199:
-            b['status_1xx'] += 1
-        elif 200 <= status <= 299:
-            b['status_2xx'] += 1
-        elif 300 <= status <= 399:
-            b['status_3xx'] += 1
-        elif 400 <= status <= 499:
-            b['status_4xx'] += 1
-        elif 500 <= status <= 599:
-            b['status_5xx'] += 1
-            b['error_count'] += 1
-        b['total_duration'] += duration
-        b['total_size'] += size
-        b['top_paths'][path] = b['top_paths'].get(path, 0) + 1
-        b['top_uas'][ua_simple] = b['top_uas'].get(ua_simple, 0) + 1
-
-        # GeoIP: resolve client IP to country
-        client_ip = request.get('remote_ip', request.get('client_ip', ''))
-        if not client_ip and isinstance(headers, dict):
-            # Fallback: check X-Forwarded-For or X-Real-IP headers
-            xff = headers.get('X-Forwarded-For', [])
-            if xff and isinstance(xff, list) and xff[0]:
-                client_ip = xff[0].split(',')[0].strip()
-            else:
-                xri = headers.get('X-Real-Ip', [])
-                if xri and isinstance(xri, list) and xri[0]:
-                    client_ip = xri[0]
-        country = _resolve_country(client_ip)
-        if country != 'Unknown':
-            b['top_countries'][country] = b['top_countries'].get(country, 0) + 1
-
-    # Truncate top paths/UAs/countries per bucket to limit stored size
-    for b in buckets.values():
-        b['top_paths'] = _top_n_from_dict(b['top_paths'], TOP_N_PATHS)
-        b['top_uas'] = _top_n_from_dict(b['top_uas'], TOP_N_UAS)
-        b['top_countries'] = _top_n_from_dict(b['top_countries'], TOP_N_COUNTRIES)
-
-    # Upsert into hourly_stats
-    for (bucket_hour, host), data in buckets.items():
-        existing = conn.execute(
-            "SELECT top_paths, top_uas, top_countries FROM hourly_stats WHERE bucket_hour = ? AND host = ?",
-            (bucket_hour, host),
-        ).fetchone()
-
-        if existing:
-            merged_paths = _merge_top_json(existing[0], data['top_paths'], TOP_N_PATHS)
-            merged_uas = _merge_top_json(existing[1], data['top_uas'], TOP_N_UAS)
-            merged_countries = _merge_top_json(existing[2], data['top_countries'], TOP_N_COUNTRIES)
+        b['total'] += row[2]
+        b['status_1xx'] += row[3]
+        b['status_2xx'] += row[4]
+        b['status_3xx'] += row[5]
+        b['status_4xx'] += row[6]
+        b['status_5xx'] += row[7]
+        b['total_duration'] += row[8]
+        b['total_size'] += row[9]
+        b['error_count'] += row[10]
+        if row[11]:
+            b['visitors'].merge(HyperLogLog.from_bytes(row[11]))
+        if row[12]:
+            b['latency'].merge(LatencyHistogram.from_bytes(row[12]))
+
+        for (field, _), sketch in zip(_TOP_COLUMNS, tops.get((row[0], row[1]), ())):
+            b[field].merge(sketch)
+    return buckets, [(r[0], r[1]) for r in rows]
+
+
+def _rollup_day(conn, day):
+    """Move the hourly_stats rows of epoch day `day`, all-hosts rows included,
+    into daily_stats. Caller owns the transaction."""
+    daily_buckets, hourly_keys = _read_buckets(
+        conn, 'hourly_stats', 'hour', "hour >= ? AND hour < ?", (day * 24, day * 24 + 24),
+        lambda hour, host_id: (day, host_id),
+    )
 
-            conn.execute(
-                """UPDATE hourly_stats SET
-                    total = total + ?, status_1xx = status_1xx + ?,
-                    status_2xx = status_2xx + ?, status_3xx = status_3xx + ?,
-                    status_4xx = status_4xx + ?, status_5xx = status_5xx + ?,
-                    total_duration = total_duration + ?, total_size = total_size + ?,
-                    error_count = error_count + ?, top_paths = ?, top_uas = ?,
-                    top_countries = ?
-                WHERE bucket_hour = ? AND host = ?""",
-                (
-                    data['total'], data['status_1xx'], data['status_2xx'],
-                    data['status_3xx'], data['status_4xx'], data['status_5xx'],
-                    data['total_duration'], data['total_size'], data['error_count'],
-                    merged_paths, merged_uas, merged_countries, bucket_hour, host,
-                ),
-            )
-        else:
-            conn.execute(
-                """INSERT INTO hourly_stats
-                    (bucket_hour, host, total, status_1xx, status_2xx,
-                     status_3xx, status_4xx, status_5xx, total_duration,
-                     total_size, error_count, top_paths, top_uas, top_countries)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (
-                    bucket_hour, host, data['total'], data['status_1xx'],
-                    data['status_2xx'], data['status_3xx'], data['status_4xx'],
-                    data['status_5xx'], data['total_duration'], data['total_size'],
-                    data['error_count'],
-                    json.dumps(data['top_paths']),
-                    json.dumps(data['top_uas']),
-                    json.dumps(data['top_countries']),
-                ),
-            )
+    # Add to daily_stats. Additive is safe: the hourly rows are deleted in the
+    # same transaction, and a backfill may already have written part of the day.
+    _upsert_buckets(conn, 'daily_stats', 'day', daily_buckets)
 
-    # Update meta
-    conn.execute(
-        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_ts', ?)",
-        (str(max_ts),),
-    )
-    conn.execute(
-        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_processed_offset', ?)",
-        (str(new_offset),),
-    )
-    conn.execute(
-        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_file_size', ?)",
-        (str(current_size),),
-    )
+    # Delete rolled-up hourly data
+    conn.execute("DELETE FROM hourly_stats WHERE hour >= ? AND hour < ?", (day * 24, day * 24 + 24))
+    _delete_tops(conn, 'hourly_stats', 'hour', hourly_keys)
+    print(f"Stats: rolled up hourly data of {_day_label(day)} into daily_stats.")
 
-    conn.commit()
-    conn.close()
 
-    print(f"Stats: processed {len(new_entries)} new log entries.")
-    return len(new_entries)
+def _prune_top_keys(conn):
+    """Forget strings no bucket refers to any more. The unreferenced key ids are
+    found without the write lock, then deleted PRUNE_BATCH at a time, each batch
+    in its own short transaction. A batch whose generation differs from the scan's
+    ends the prune (a writer may have referenced the keys since); the rest waits
+    for the next one. Writers cache key ids, so each batch tells them
+    (top_keys_generation) that some are gone."""
+    conn.execute("BEGIN")
+    try:
+        generation = _read_meta(conn, 'generation', int, 0)
+        unused = [row[0] for row in conn.execute(
+            "SELECT key_id FROM top_keys WHERE key_id NOT IN "
+            "(SELECT key_id FROM hourly_top UNION SELECT key_id FROM daily_top)"
+        )]
+    finally:
+        conn.rollback()
 
+    def delete(batch):
+        if _read_meta(conn, 'generation', int, 0) != generation:
+            return False
+        conn.executemany("DELETE FROM top_keys WHERE key_id = ?", [(key_id,) for key_id in batch])
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('top_keys_generation', ?)",
+            (str(_read_meta(conn, 'top_keys_generation', int, 0) + 1),),
+        )
+        return True
 
-# ---------------------------------------------------------------------------
-# Rollup
-# ---------------------------------------------------------------------------
+    for batch in _chunks(unused, PRUNE_BATCH):
+        if not _write_transaction(conn, lambda: delete(batch)):
+            break
+    _write_transaction(conn, lambda: conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_rollup_ts', ?)",
+        (str(time_module.time()),),
+    ))
 
-def rollup_old_buckets():
-    """Consolidate hourly_stats older than HOURLY_RETENTION_DAYS into daily_stats.
-    Delete daily_stats older than DAILY_RETENTION_DAYS.
-    Throttled: only runs once every 6 hours."""
+
+def build_all_hosts_rows(max_seconds=None):
+    """Give a database from before all-hosts rows existed its ALL_HOSTS_ID rows:
+    one day of hourly_stats, then of daily_stats, per transaction, oldest first.
+    Each day's all-hosts rows are rebuilt from its per-host rows, replacing the
+    ones ingest added meanwhile. Progress is meta 'all_hosts_rows'
+    ('hourly:<last hour done>', 'daily:<last day done>', 'done').
+    max_seconds: stop after the step that exceeds it. Returns True when done."""
+    if _db_path is None:
+        return True
+
+    started = time_module.monotonic()
+    conn = _write_conn()
+    try:
+        while _read_meta(conn, 'all_hosts_rows', str, 'done') != 'done':
+            _write_transaction(conn, lambda: _all_hosts_step(conn))
+            if max_seconds is not None and time_module.monotonic() - started >= max_seconds:
+                return False
+    finally:
+        _release_conn(conn)
+    return True
+
+
+def _all_hosts_step(conn):
+    state = _read_meta(conn, 'all_hosts_rows', str, 'done')
+    if state == 'done':
+        return  # another process finished it
+    table_kind, done_to = state.split(':')
+    table, key_col, span = {'hourly': ('hourly_stats', 'hour', 24), 'daily': ('daily_stats', 'day', 1)}[table_kind]
+    start = conn.execute(
+        f"SELECT MIN({key_col}) FROM {table} WHERE {key_col} > ?", (int(done_to),)
+    ).fetchone()[0]
+    if start is None:
+        state = 'daily:-1' if table_kind == 'hourly' else 'done'
+    else:
+        end = start - start % span + span
+        buckets, _ = _read_buckets(
+            conn, table, key_col, f"{key_col} >= ? AND {key_col} < ? AND host_id != ?",
+            (start, end, ALL_HOSTS_ID), lambda bucket_key, host_id: (bucket_key, ALL_HOSTS_ID),
+        )
+        stale = conn.execute(
+            f"SELECT {key_col}, host_id FROM {table} WHERE {key_col} >= ? AND {key_col} < ? AND host_id = ?",
+            (start, end, ALL_HOSTS_ID),
+        ).fetchall()
+        _delete_tops(conn, table, key_col, stale)
+        conn.execute(
+            f"DELETE FROM {table} WHERE {key_col} >= ? AND {key_col} < ? AND host_id = ?",
+            (start, end, ALL_HOSTS_ID),
+        )
+        _upsert_buckets(conn, table, key_col, buckets)
+        state = f"{table_kind}:{end - 1}"
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('all_hosts_rows', ?)", (state,))
+    _bump_generation(conn)
+    if state == 'done':
+        print("Stats DB migration: all-hosts rows built.")
+
+
+def _host_totals_query(segments):
+    """SQL and params of (host_id, requests) over the period's segments, from
+    the (bucket, host_id, total) indexes."""
+    parts = []
+    params = []
+    for table, cond, cond_params in segments:
+        parts.append(f"SELECT host_id, total FROM {table} WHERE {cond} AND host_id != ?")
+        params += cond_params + [ALL_HOSTS_ID]
+    return f"SELECT host_id, SUM(total) AS total FROM ({' UNION ALL '.join(parts)}) GROUP BY host_id", params
+
+
+def refresh_host_totals(force=False):
+    """Recompute host_totals, the requests per host of each period, if the last
+    refresh is HOST_TOTALS_INTERVAL_SECONDS old (or `force`). Run by the ingester."""
     if _db_path is None:
         return
+    conn = _write_conn()
+    try:
+        now = time_module.time()
+        if not force and now - _read_meta(conn, 'host_totals_ts', float, 0.0) < HOST_TOTALS_INTERVAL_SECONDS:
+            return
+
+        def refresh():
+            watermark = _rollup_watermark(conn)
+            before = set(conn.execute("SELECT period, host_id, total FROM host_totals"))
+            conn.execute("DELETE FROM host_totals")
+            for period in VALID_PERIODS:
+                sql, params = _host_totals_query(_window_segments(_preset_window(period, int(now)), None, watermark))
+                conn.execute(f"INSERT INTO host_totals (period, host_id, total) SELECT ?, * FROM ({sql})",
+                             [period] + params)
+            if set(conn.execute("SELECT period, host_id, total FROM host_totals")) != before:
+                _bump_generation(conn)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('host_totals_ts', ?)", (str(now),))
+
+        _write_transaction(conn, refresh)
+    finally:
+        _release_conn(conn)
 
-    conn = _get_conn()
 
-    # Check throttle
-    last_rollup = 0.0
-    row = conn.execute("SELECT value FROM meta WHERE key = 'last_rollup_ts'").fetchone()
-    if row:
-        try:
-            last_rollup = float(row[0])
-        except (ValueError, TypeError):
-            pass
+# ---------------------------------------------------------------------------
+# Backfill
+# ---------------------------------------------------------------------------
 
-    if (time_module.time() - last_rollup) < 6 * 3600:
-        conn.close()
-        return
+def _backfill_worker_init(geoip_db_path):
+    """Process pool initializer: each worker opens its own GeoIP reader."""
+    if geoip_db_path and Path(geoip_db_path).is_file():
+        configure_geoip(geoip_db_path)
 
-    conn.execute("BEGIN IMMEDIATE")
-    now = datetime.now(timezone.utc)
 
-    # 1. Hourly -> Daily rollup (only complete days older than retention)
-    cutoff_date = (now - timedelta(days=HOURLY_RETENTION_DAYS)).strftime('%Y-%m-%d')
+def _aggregate_range(path, start, end, ts_limit):
+    """Aggregate the lines of `path` that start in [start, end) into hourly buckets.
+
+    Runs in a worker process. `end` may be None (read to the end of the file).
+    A range that does not begin at a line start skips to the next line; the
+    line straddling `end` belongs to this range. Entries with ts >= ts_limit
+    (when set) are skipped. Returns a dict with the partial buckets (top-N,
+    visitors and latency as serialized sketches), the number of lines
+    aggregated, the lines dropped by the logger filter, and the offset just
+    past the last complete line read."""
+    buckets = {}
+    skipped = {}
+    lines = 0
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                f.readline()  # mid-line: this line belongs to the previous range
+        pos = f.tell()
+        while end is None or pos < end:
+            raw = f.readline()
+            if not raw.endswith(b'\n'):
+                break  # EOF or a line still being written
+            pos += len(raw)
+            if not _decode_and_fold(buckets, raw, ts_limit, skipped):
+                continue
+            lines += 1
+
+    for b in buckets.values():
+        _pack_bucket_sketches(b)
+    return {'buckets': buckets, 'lines': lines, 'skipped': skipped, 'end': pos}
+
 
-    hourly_rows = conn.execute(
-        "SELECT * FROM hourly_stats WHERE substr(bucket_hour, 1, 10) < ?",
-        (cutoff_date,),
+def _missing_ranges(conn, fingerprint, size):
+    """Return the [start, end) byte ranges of a file not yet ingested.
+    `size` None means unknown (gzip): the file's end marker if it was read to
+    the end before, else the last range is open-ended."""
+    covered = conn.execute(
+        "SELECT start_offset, end_offset FROM ingested_ranges WHERE fingerprint = ? ORDER BY start_offset",
+        (fingerprint,),
     ).fetchall()
+    if covered and covered[0][0] == _FILE_END_MARK:
+        if size is None:
+            size = covered[0][1]
+        covered = covered[1:]
+    missing = []
+    pos = 0
+    for r_start, r_end in covered:
+        if size is not None and r_start >= size:
+            break
+        if r_start > pos:
+            missing.append((pos, r_start))
+        pos = max(pos, r_end)
+    if size is None:
+        missing.append((pos, None))
+    elif pos < size:
+        missing.append((pos, size))
+    return missing
+
+
+def _default_backfill_files(log_file_path):
+    """The access log plus its rotated backups and archives (name.1, name.2.gz, ...)."""
+    log_path = Path(log_file_path)
+    if not log_path.parent.is_dir():
+        return []
+    return sorted(p for p in log_path.parent.glob(log_path.name + '*') if p.is_file())
 
-    if hourly_rows:
-        daily_buckets = {}
-        for row in hourly_rows:
-            bucket_date = row[0][:10]  # '2026-04-17T08' -> '2026-04-17'
-            host = row[1]
-            key = (bucket_date, host)
 
-            if key not in daily_buckets:
-                daily_buckets[key] = {
-                    'total': 0, 'status_1xx': 0, 'status_2xx': 0, 'status_3xx': 0,
-                    'status_4xx': 0, 'status_5xx': 0, 'total_duration': 0.0,
-                    'total_size': 0, 'error_count': 0,
-                    'top_paths': {}, 'top_uas': {}, 'top_countries': {},
-                }
-
-            b = daily_buckets[key]
-            b['total'] += row[2]
-            b['status_1xx'] += row[3]
-            b['status_2xx'] += row[4]
-            b['status_3xx'] += row[5]
-            b['status_4xx'] += row[6]
-            b['status_5xx'] += row[7]
-            b['total_duration'] += row[8]
-            b['total_size'] += row[9]
-            b['error_count'] += row[10]
-
-            # Merge top_paths / top_uas from JSON
-            try:
-                for path, count in json.loads(row[11] or '{}').items():
-                    b['top_paths'][path] = b['top_paths'].get(path, 0) + count
-            except (json.JSONDecodeError, TypeError):
-                pass
-            try:
-                for ua, count in json.loads(row[12] or '{}').items():
-                    b['top_uas'][ua] = b['top_uas'].get(ua, 0) + count
-            except (json.JSONDecodeError, TypeError):
-                pass
-            try:
-                for country, count in json.loads(row[13] or '{}').items():
-                    b['top_countries'][country] = b['top_countries'].get(country, 0) + count
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-        # Upsert daily_stats (REPLACE with freshly computed totals for idempotency)
-        for (bucket_date, host), data in daily_buckets.items():
-            top_paths_json = json.dumps(_top_n_from_dict(data['top_paths'], TOP_N_PATHS))
-            top_uas_json = json.dumps(_top_n_from_dict(data['top_uas'], TOP_N_UAS))
-            top_countries_json = json.dumps(_top_n_from_dict(data['top_countries'], TOP_N_COUNTRIES))
-
-            existing = conn.execute(
-                "SELECT total FROM daily_stats WHERE bucket_date = ? AND host = ?",
-                (bucket_date, host),
-            ).fetchone()
-
-            if existing:
-                conn.execute(
-                    """UPDATE daily_stats SET
-                        total = ?, status_1xx = ?, status_2xx = ?, status_3xx = ?,
-                        status_4xx = ?, status_5xx = ?, total_duration = ?,
-                        total_size = ?, error_count = ?, top_paths = ?, top_uas = ?,
-                        top_countries = ?
-                    WHERE bucket_date = ? AND host = ?""",
-                    (
-                        data['total'], data['status_1xx'], data['status_2xx'],
-                        data['status_3xx'], data['status_4xx'], data['status_5xx'],
-                        data['total_duration'], data['total_size'], data['error_count'],
-                        top_paths_json, top_uas_json, top_countries_json, bucket_date, host,
-                    ),
-                )
-            else:
-                conn.execute(
-                    """INSERT INTO daily_stats
-                        (bucket_date, host, total, status_1xx, status_2xx,
-                         status_3xx, status_4xx, status_5xx, total_duration,
-                         total_size, error_count, top_paths, top_uas, top_countries)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        bucket_date, host, data['total'], data['status_1xx'],
-                        data['status_2xx'], data['status_3xx'], data['status_4xx'],
-                        data['status_5xx'], data['total_duration'], data['total_size'],
-                        data['error_count'], top_paths_json, top_uas_json, top_countries_json,
-                    ),
-                )
+def backfill(paths, workers=None, chunk_bytes=BACKFILL_CHUNK_BYTES, geoip_db_path=None):
+    """Import historical log data from `paths` (plain or .gz Caddy JSON logs).
 
-        # Delete rolled-up hourly data
-        conn.execute(
-            "DELETE FROM hourly_stats WHERE substr(bucket_hour, 1, 10) < ?",
-            (cutoff_date,),
-        )
-        print(f"Stats: rolled up hourly data before {cutoff_date} into daily_stats.")
+    Each file's not-yet-ingested byte ranges are split into newline-aligned
+    chunks and aggregated in a process pool. The partial hourly buckets are
+    merged and prepared without the write lock, then written in one transaction:
+    hours inside the hourly retention go to hourly_stats, older days to
+    daily_stats, anything beyond daily retention is dropped. The imported ranges are recorded in the same transaction, so
+    re-running a backfill over the same files adds nothing. Gzip archives can
+    not be split and are read by one worker each; once read to the end they are
+    marked complete, so later runs do not decompress them again.
 
-    # 2. Delete old daily data
-    daily_cutoff = (now - timedelta(days=DAILY_RETENTION_DAYS)).strftime('%Y-%m-%d')
-    deleted = conn.execute(
-        "DELETE FROM daily_stats WHERE bucket_date < ?", (daily_cutoff,)
-    ).rowcount
-    if deleted:
-        print(f"Stats: pruned {deleted} daily_stats rows before {daily_cutoff}.")
+    The file currently being tailed is only backfilled up to the live ingester's
+    offset; everything after it belongs to the live ingester.
 
-    # Update last_rollup_ts
-    conn.execute(
-        "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_rollup_ts', ?)",
-        (str(time_module.time()),),
-    )
+    Returns the number of log entries imported.
+    """
+    from concurrent.futures import ProcessPoolExecutor
 
-    conn.commit()
-    conn.close()
+    if _db_path is None:
+        raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
+    if _text_layout:
+        raise RuntimeError("stats.db is in the old layout: run 'python -m stats_aggregator migrate' first.")
+
+    conn = _write_conn()
+    try:
+        ts_limit = _read_meta(conn, 'backfill_legacy_cutoff_ts', float, 0.0)
+        live_fingerprint = _read_meta(conn, 'last_processed_fingerprint', str, '')
+        live_offset = _read_meta(conn, 'last_processed_offset', int, 0)
+
+        tasks = []  # (path, fingerprint, start, end)
+        seen = set()
+        for path in paths:
+            path = Path(path)
+            fingerprint = _file_fingerprint(path)
+            if fingerprint is None:
+                print(f"Backfill: skipping {path} (empty or unreadable)")
+                continue
+            if fingerprint in seen:
+                # e.g. name.1 and an archived name.1.gz of the same content
+                print(f"Backfill: skipping {path} (same content as another input)")
+                continue
+            seen.add(fingerprint)
+
+            is_gzip = path.suffix == '.gz'
+            size = None if is_gzip else path.stat().st_size
+            if fingerprint == live_fingerprint and size is not None:
+                size = min(size, live_offset)
+            for start, end in _missing_ranges(conn, fingerprint, size):
+                if is_gzip or end is None:
+                    tasks.append((path, fingerprint, start, end))
+                    continue
+                for chunk_start in range(start, end, chunk_bytes):
+                    tasks.append((path, fingerprint, chunk_start, min(chunk_start + chunk_bytes, end)))
+    finally:
+        _release_conn(conn)
+
+    if not tasks:
+        print("Backfill: nothing to import.")
+        return 0
+
+    print(f"Backfill: aggregating {len(tasks)} range(s) from {len(seen)} file(s)...")
+    buckets = {}
+    skipped = {}
+    covered = {}  # (fingerprint, range start) -> furthest offset read
+    file_ends = {}  # fingerprint -> size of the gzip archives read to the end
+    lines = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_backfill_worker_init,
+                             initargs=(geoip_db_path,)) as pool:
+        futures = [
+            (task, pool.submit(_aggregate_range, str(task[0]), task[2], task[3], ts_limit))
+            for task in tasks
+        ]
+        for (path, fingerprint, start, end), future in futures:
+            result = future.result()
+            lines += result['lines']
+            for name, count in result['skipped'].items():
+                skipped[name] = skipped.get(name, 0) + count
+            for key, b in result['buckets'].items():
+                _unpack_bucket_sketches(b)
+                if key in buckets:
+                    _merge_bucket(buckets[key], b)
+                else:
+                    buckets[key] = b
+            covered[(fingerprint, start)] = (start, result['end'])
+            if end is None:  # read to the end of the archive (a partial last line is never completed)
+                file_ends[fingerprint] = result['end']
+
+    _, daily_cutoff = _retention_cutoffs()
+    conn = _write_conn()
+    try:
+        # Merged and serialized before the write lock; again under it only if
+        # another writer (e.g. the rollup moving its watermark) committed meanwhile.
+        keyed = _by_host_id(conn, buckets)
+        generation, (hourly_buckets, daily_buckets, upserts) = _read_snapshot(
+            conn, lambda: _prepare_backfill(conn, keyed, daily_cutoff))
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Another backfill may have committed an overlapping range meanwhile.
+        for (fingerprint, _), (start, end) in covered.items():
+            if end > start and conn.execute(
+                "SELECT 1 FROM ingested_ranges WHERE fingerprint = ? AND start_offset < ? AND end_offset > ? "
+                "AND start_offset >= 0",
+                (fingerprint, end, start),
+            ).fetchone():
+                conn.execute("ROLLBACK")
+                print("Backfill: ranges were ingested concurrently, nothing written. Re-run to import the rest.")
+                return 0
+        if _read_meta(conn, 'generation', int, 0) != generation:
+            hourly_buckets, daily_buckets, upserts = _prepare_backfill(conn, keyed, daily_cutoff)
+        for upsert in upserts:
+            _write_upsert(conn, upsert)
+        _bump_generation(conn)
+        _add_skipped_loggers(conn, skipped)
+        for (fingerprint, _), (start, end) in covered.items():
+            _record_range(conn, fingerprint, start, end)
+        for fingerprint, size in file_ends.items():
+            _record_file_end(conn, fingerprint, size)
+        conn.commit()
+        _publish_generation(conn)
+    except Exception:
+        conn.rollback()
+        _reset_id_caches()
+        raise
+    finally:
+        _release_conn(conn)
+
+    print(f"Backfill: imported {lines} log entries "
+          f"({len(hourly_buckets)} hourly and {len(daily_buckets)} daily buckets, "
+          f"{sum(skipped.values())} non-access lines skipped).")
+    return lines
 
 
 # ---------------------------------------------------------------------------
 # Query helpers
 # ---------------------------------------------------------------------------
 
+def _range_info(window):
+    """The "range" of a get_stats() result: the window actually served."""
+    if window is None:
+        return None
+    return {
+        "from_utc": datetime.fromtimestamp(window.start, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC'),
+        "to_utc": datetime.fromtimestamp(window.end, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC'),
+        "step_seconds": window.step,
+    }
+
+
 def _empty_stats(period, host):
     """Return an empty stats dict with the correct structure."""
     return {
@@ -613,282 +2587,564 @@ def _empty_stats(period, host):
         "top_paths": [],
         "top_user_agents": [],
         "top_countries": [],
+        "unique_visitors": 0,
         "geoip_available": is_geoip_available(),
         "avg_response_time_ms": 0.0,
+        "latency_ms": LatencyHistogram().percentiles_ms(),
         "avg_response_size_kb": 0.0,
         "error_rate_percent": 0.0,
-        "requests_timeseries": [],
+        "timeseries": {'time': [], **{name: [] for name, _ in TIMESERIES_COLUMNS}},
+        "latency_timeseries": {name: [] for name in LatencyHistogram().percentiles_ms()},
         "data_from_utc": "N/A",
         "data_to_utc": "N/A",
         "period": period,
+        "range": None,
         "host": host,
         "log_read_error": None,
     }
 
 
-def _build_hourly_timeseries(data, period, now):
-    """Build a complete hourly timeseries with gap-filling."""
-    hours = 24 if period == '24h' else 168
-    start = now - timedelta(hours=hours)
-    current = start.replace(minute=0, second=0, microsecond=0)
-
-    result = []
-    while current <= now:
-        key = current.strftime('%Y-%m-%dT%H')
-        result.append({
-            'time': current.strftime('%Y-%m-%d %H:%M'),
-            'count': data.get(key, 0),
-        })
-        current += timedelta(hours=1)
-
-    return result
-
-
-def _build_daily_timeseries(data, period, now):
-    """Build a complete daily timeseries with gap-filling."""
-    days_map = {'30d': 30, '90d': 90, '1y': 365}
-    days = days_map.get(period, 30)
-    start = now - timedelta(days=days)
-    current = start.replace(hour=0, minute=0, second=0, microsecond=0)
-
-    result = []
-    while current <= now:
-        key = current.strftime('%Y-%m-%d')
-        result.append({
-            'time': key,
-            'count': data.get(key, 0),
-        })
-        current += timedelta(days=1)
-
-    return result
+# get_stats() "timeseries" columns (besides "time") and the counters they sum
+TIMESERIES_COLUMNS = (
+    ('total', 'total'),
+    ('status_1xx', 'status_1xx'),
+    ('status_2xx', 'status_2xx'),
+    ('status_3xx', 'status_3xx'),
+    ('status_4xx', 'status_4xx'),
+    ('status_5xx', 'status_5xx'),
+    ('bytes', 'total_size'),
+    ('total_duration', 'total_duration'),
+    ('errors', 'error_count'),
+)
+
+# A get_stats() time range: epoch seconds, end exclusive. Timeseries points
+# start at `start` and are `step` apart; all three are whole hours, and whole
+# days when any of the range comes from daily_stats.
+Window = namedtuple('Window', 'start end step')
+
+_STEP_UNITS = {'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_time_arg(value):
+    """Epoch seconds of a from/to query argument: epoch seconds, or ISO 8601
+    ('2026-03-03T14:00', '2026-03-03', with or without an offset; UTC if none).
+    Raises ValueError."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00').replace('z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"invalid time {value!r}: use ISO 8601 or epoch seconds") from None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def parse_step_arg(value):
+    """Seconds of a step query argument: '1h', '6h', '1d', '1w' or seconds, in
+    whole hours. Raises ValueError."""
+    value = value.strip().lower()
+    match = _re.fullmatch(r'(\d+)([hdw]?)', value)
+    seconds = int(match.group(1)) * _STEP_UNITS.get(match.group(2), 1) if match else 0
+    if seconds <= 0 or seconds % 3600:
+        raise ValueError(f"invalid step {value!r}: use whole hours, e.g. 1h, 6h, 1d, 1w")
+    return seconds
+
+
+def _preset_window(period, now_ts):
+    """Window of a VALID_PERIODS period, up to the current hour or day included:
+    hourly points for '24h'/'7d', daily points for the longer periods."""
+    if period in ('24h', '7d'):
+        hours = 24 if period == '24h' else 168
+        return Window((now_ts - hours * 3600) // 3600 * 3600, (now_ts // 3600 + 1) * 3600, 3600)
+    days = {'30d': 30, '90d': 90, '1y': 365}[period]
+    return Window((now_ts - days * 86400) // 86400 * 86400, (now_ts // 86400 + 1) * 86400, 86400)
+
+
+def _range_window(start, end, step, watermark):
+    """Window of an arbitrary [start, end) range. Hours after the rollup
+    watermark can be read hour by hour, earlier ones only by day: a range that
+    reaches back into those is widened to whole days and its step rounded up to
+    whole days; so is a range with a step of whole days. Without a step, points
+    are as fine as the data.
+    Raises ValueError for empty, too long or too finely stepped ranges."""
+    if end <= start:
+        raise ValueError("'to' must be after 'from'")
+    if end - start > (DAILY_RETENTION_DAYS + 1) * 86400:
+        raise ValueError(f"the range is longer than the {DAILY_RETENTION_DAYS} days kept")
+    unit = 86400 if start < (watermark + 1) * 86400 else 3600
+    step = unit if step is None else -(-step // unit) * unit
+    if step % 86400 == 0:
+        unit = 86400  # points of whole days start at midnight, as their labels say
+    start = start // unit * unit
+    end = -(-end // unit) * unit
+    if -(-(end - start) // step) > MAX_TIMESERIES_POINTS:
+        raise ValueError(f"more than {MAX_TIMESERIES_POINTS} points: use a larger step")
+    return Window(start, end, step)
+
+
+def _window_labels(window):
+    """Label of every point of the window, gaps included: 'YYYY-mm-dd HH:MM'
+    for steps under a day, else 'YYYY-mm-dd' (the first day of the point)."""
+    day_labels = {}
+    labels = []
+    for ts in range(window.start, window.end, window.step):
+        day = ts // 86400
+        label = day_labels.get(day)
+        if label is None:
+            label = day_labels[day] = _day_label(day)
+        labels.append(label if window.step % 86400 == 0 else f"{label} {ts % 86400 // 3600:02d}:00")
+    return labels
+
+
+def _query_top(conn, segments, dim, limit):
+    """Rank the keys of one top-N dimension over the period's segments with a
+    single GROUP BY in SQLite. Returns [(key, count), ...] best first.
+
+    This is the Space-Saving merge of all the period's sketches: a key's count
+    is its counters plus the floors of the buckets it is missing from. Counters
+    are stored relative to their bucket's floor, so that is SUM(count) per key
+    plus the sum of all floors (the key_id 0 group)."""
+    parts = []
+    params = []
+    for table, cond, cond_params in segments:
+        parts.append(f"SELECT key_id, count FROM {_TOP_TABLES[table]} WHERE dim = ? AND {cond}")
+        params += [dim] + cond_params
+    # Aggregate on key ids first; only the winners are joined to their strings.
+    sql = (f"SELECT key_id, SUM(count) AS c FROM ({' UNION ALL '.join(parts)}) GROUP BY key_id "
+           f"ORDER BY key_id = 0 DESC, c DESC LIMIT ?")
+    params.append(limit + 1)
+    sql = f"SELECT g.key_id, k.key, g.c FROM ({sql}) g LEFT JOIN top_keys k ON k.key_id = g.key_id"
+
+    floor = 0
+    counts = {}
+    for key_id, key, c in conn.execute(sql, params):
+        if key_id == 0:
+            floor = c
+        else:
+            # The text layout's views (_text_layout_views) have the strings as ids
+            counts[key if key is not None else key_id] = c
+    return sorted(((k, c + floor) for k, c in counts.items()), key=lambda x: (-x[1], x[0]))[:limit]
+
+
+def _window_segments(window, host, watermark):
+    """(table, condition, params) ranges that make up the window, on the integer
+    hour/day keys. Days up to the rollup watermark come from daily_stats."""
+    hourly_from = (watermark + 1) * 86400
+    segments = []
+    if window.start < hourly_from:
+        segments.append(('daily_stats', "day >= ? AND day < ?",
+                         [window.start // 86400, min(window.end, hourly_from) // 86400]))
+    if window.end > hourly_from:
+        segments.append(('hourly_stats', "hour >= ? AND hour < ?",
+                         [max(window.start, hourly_from) // 3600, window.end // 3600]))
+    if host:
+        # An unknown host makes the subquery NULL, which matches no row.
+        segments = [(table, cond + " AND host_id = (SELECT host_id FROM hosts WHERE host = ?)", params + [host])
+                    for table, cond, params in segments]
+    return segments
+
+
+def _requests_by_host(conn, period, segments, limit=7):
+    """{host: requests} of the period's `limit` busiest hosts, from host_totals while
+    the ingester keeps it fresh, else (and for custom ranges) summed from the
+    (bucket, host_id, total) indexes."""
+    if period in VALID_PERIODS and \
+            time_module.time() - _read_meta(conn, 'host_totals_ts', float, 0.0) < 2 * HOST_TOTALS_INTERVAL_SECONDS:
+        sql, params = "SELECT host_id, total FROM host_totals WHERE period = ?", [period]
+    else:
+        sql, params = _host_totals_query(segments)
+    return dict(conn.execute(
+        f"SELECT h.host, t.total FROM ({sql}) t JOIN hosts h USING (host_id) "
+        f"ORDER BY t.total DESC, h.host LIMIT ?",
+        params + [limit],
+    ).fetchall())
+
+
+def _stats_version(conn, now):
+    """Version of get_stats results in the query cache: the database, its write
+    generation and the current hour (period windows move with the clock)."""
+    meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('db_id', 'generation')"))
+    return f"{meta.get('db_id')}:{meta.get('generation', 0)}:{int(now.timestamp()) // 3600}"
+
+
+def _query_period(period, start, end):
+    """The period of a get_stats() style query: 'custom' for a from/to range,
+    else `period`, or '7d' if it is not one of VALID_PERIODS."""
+    if start is not None or end is not None:
+        return 'custom'
+    return period if period in VALID_PERIODS else '7d'
+
+
+def _query_window(period, start, end, step, now):
+    """(window, query cache version or None) of a get_stats() style query (see
+    there for start, end and step). Raises ValueError (_range_window)."""
+    now_ts = int(now.timestamp())
+    version = None
+    watermark = _retention_cutoffs(now_ts)[0] - 1
+    try:
+        conn = _read_conn()
+        try:
+            version = _stats_version(conn, now)
+            watermark = _rollup_watermark(conn)
+        finally:
+            _release_conn(conn)
+    except sqlite3.Error as e:
+        print(f"Error reading the stats generation: {e}")
+    if period == 'custom':
+        end = now_ts if end is None else int(end)
+        start = end - 7 * 86400 if start is None else int(start)
+        return _range_window(start, end, step, watermark), version
+    window = _preset_window(period, now_ts)
+    if step is not None:
+        window = _range_window(window.start, window.end, step, watermark)
+    return window, version
+
+
+def _new_columns(points):
+    """Zeroed TIMESERIES_COLUMNS for `points` points."""
+    return {name: [0] * points for name, _ in TIMESERIES_COLUMNS}
+
+
+def _summarize(columns, latency):
+    """The headline figures of get_stats() from timeseries columns and the
+    period's LatencyHistogram."""
+    total_requests = sum(columns['total'])
+    status_codes_dist = {f"{n}xx": sum(columns[f"status_{n}xx"]) for n in range(1, 6)}
+    status_codes_dist["other"] = 0
+    return {
+        "total_requests": total_requests,
+        "status_codes_dist": status_codes_dist,
+        "avg_response_time_ms": (sum(columns['total_duration']) / total_requests * 1000) if total_requests else 0,
+        "latency_ms": latency.percentiles_ms(),
+        "avg_response_size_kb": (sum(columns['bytes']) / total_requests / 1024) if total_requests else 0,
+        "error_rate_percent": (sum(columns['errors']) / total_requests * 100) if total_requests else 0,
+    }
 
 
-def get_stats(period='7d', host=None):
+def get_stats(period='7d', host=None, start=None, end=None, step=None):
     """Get aggregated statistics for a given time period.
 
     period: '24h', '7d', '30d', '90d', '1y'
     host: optional host name to filter by (None = all hosts)
+    start, end, step: an arbitrary range instead of `period` (epoch seconds,
+      end exclusive; see parse_time_arg / parse_step_arg). `end` defaults to now,
+      `start` to 7 days before `end`, `step` to hours where the range has hourly
+      data, else days. period is then 'custom'. A step alone re-steps the
+      period. Raises ValueError for ranges that cannot be served (_range_window).
+
+    Results are shared by all processes through the query cache until the next
+    write to stats.db or the next hour; a hit costs a few small reads.
 
     Returns: dict with stats data suitable for JSON API response.
     """
+    period = _query_period(period, start, end)
     if _db_path is None:
         return _empty_stats(period, host)
 
-    if period not in VALID_PERIODS:
-        period = '7d'
-
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
     now = datetime.now(timezone.utc)
-
-    rows = []
-    timeseries_key_type = 'hourly'
-
-    try:
-        if period in ('24h', '7d'):
-            hours = 24 if period == '24h' else 168
-            cutoff = (now - timedelta(hours=hours)).strftime('%Y-%m-%dT%H')
-
-            query = "SELECT * FROM hourly_stats WHERE bucket_hour >= ?"
-            params = [cutoff]
-            if host:
-                query += " AND host = ?"
-                params.append(host)
-            rows = conn.execute(query, params).fetchall()
-            timeseries_key_type = 'hourly'
-
-        elif period in ('30d', '90d'):
-            days = 30 if period == '30d' else 90
-            period_start = (now - timedelta(days=days)).strftime('%Y-%m-%d')
-            boundary_date = (now - timedelta(days=HOURLY_RETENTION_DAYS)).strftime('%Y-%m-%d')
-            boundary_hour = boundary_date + 'T00'
-
-            # Daily stats for dates before the hourly boundary
-            query = "SELECT * FROM daily_stats WHERE bucket_date >= ? AND bucket_date < ?"
-            params = [period_start, boundary_date]
-            if host:
-                query += " AND host = ?"
-                params.append(host)
-            rows = list(conn.execute(query, params).fetchall())
-
-            # Hourly stats for the recent part (not yet rolled up)
-            query = "SELECT * FROM hourly_stats WHERE bucket_hour >= ?"
-            params = [boundary_hour]
-            if host:
-                query += " AND host = ?"
-                params.append(host)
-            rows.extend(conn.execute(query, params).fetchall())
-
-            timeseries_key_type = 'daily'
-
-        elif period == '1y':
-            period_start = (now - timedelta(days=365)).strftime('%Y-%m-%d')
-            boundary_date = (now - timedelta(days=HOURLY_RETENTION_DAYS)).strftime('%Y-%m-%d')
-            boundary_hour = boundary_date + 'T00'
-
-            # Daily stats for the full period
-            query = "SELECT * FROM daily_stats WHERE bucket_date >= ?"
-            params = [period_start]
-            if host:
-                query += " AND host = ?"
-                params.append(host)
-            rows = list(conn.execute(query, params).fetchall())
-
-            # Hourly stats for the recent part
-            query = "SELECT * FROM hourly_stats WHERE bucket_hour >= ?"
-            params = [boundary_hour]
-            if host:
-                query += " AND host = ?"
-                params.append(host)
-            rows.extend(conn.execute(query, params).fetchall())
-
-            timeseries_key_type = 'daily'
-
-    except Exception as e:
-        print(f"Error querying stats for period={period}, host={host}: {e}")
-        conn.close()
+    window, version = _query_window(period, start, end, step, now)
+    key = json.dumps([period, host, *window])
+    if version is not None:
+        cached = _query_cache.get(key, version)
+        if cached is not None:
+            cached['data_to_utc'] = now.strftime('%Y-%m-%d %H:%M:%S UTC')
+            cached['geoip_available'] = is_geoip_available()
+            return cached
+
+    stats = _compute_stats(period, host, now, window)
+    if stats is None:
         return _empty_stats(period, host)
+    if version is not None:
+        _query_cache.put(key, version, stats)
+    return stats
 
-    conn.close()
 
-    # Aggregate all rows into the final stats dict
-    total_requests = 0
+def _compute_stats(period, host, now, window=None):
+    """get_stats() without the cache, over `window` (default: the period's).
+    None if stats.db could not be queried."""
+    if window is None:
+        window = _preset_window(period, int(now.timestamp()))
     requests_by_host = {}
-    status_codes_dist = {"1xx": 0, "2xx": 0, "3xx": 0, "4xx": 0, "5xx": 0, "other": 0}
-    path_counts = {}
-    ua_counts = {}
-    country_counts = {}
-    total_duration = 0.0
-    total_size = 0
-    error_count = 0
-
-    ts_hourly = {}
-    ts_daily = {}
-    earliest_bucket = None
-
-    for row in rows:
-        r = dict(row)
-        row_total = r['total']
-        total_requests += row_total
-
+    conn = _read_conn()
+    try:
+        segments = _window_segments(window, host, _rollup_watermark(conn))
         if not host:
-            h = r['host']
-            requests_by_host[h] = requests_by_host.get(h, 0) + row_total
-
-        status_codes_dist['1xx'] += r['status_1xx']
-        status_codes_dist['2xx'] += r['status_2xx']
-        status_codes_dist['3xx'] += r['status_3xx']
-        status_codes_dist['4xx'] += r['status_4xx']
-        status_codes_dist['5xx'] += r['status_5xx']
-        total_duration += r['total_duration']
-        total_size += r['total_size']
-        error_count += r['error_count']
-
-        # Merge top paths/UAs
-        try:
-            for p, c in json.loads(r['top_paths'] or '{}').items():
-                path_counts[p] = path_counts.get(p, 0) + c
-        except (json.JSONDecodeError, TypeError):
-            pass
-        try:
-            for u, c in json.loads(r['top_uas'] or '{}').items():
-                ua_counts[u] = ua_counts.get(u, 0) + c
-        except (json.JSONDecodeError, TypeError):
-            pass
-        try:
-            for country, c in json.loads(r.get('top_countries') or '{}').items():
-                country_counts[country] = country_counts.get(country, 0) + c
-        except (json.JSONDecodeError, TypeError):
-            pass
-
-        # Timeseries bucket key
-        if 'bucket_hour' in r and r['bucket_hour']:
-            key = r['bucket_hour']
-            if timeseries_key_type == 'daily':
-                daily_key = key[:10]
-                ts_daily[daily_key] = ts_daily.get(daily_key, 0) + row_total
-            else:
-                ts_hourly[key] = ts_hourly.get(key, 0) + row_total
-            if earliest_bucket is None or key < earliest_bucket:
-                earliest_bucket = key
-        elif 'bucket_date' in r and r['bucket_date']:
-            key = r['bucket_date']
-            ts_daily[key] = ts_daily.get(key, 0) + row_total
-            if earliest_bucket is None or key < earliest_bucket:
-                earliest_bucket = key
-
-    # Build timeseries
-    if timeseries_key_type == 'hourly':
-        timeseries = _build_hourly_timeseries(ts_hourly, period, now)
-    else:
-        timeseries = _build_daily_timeseries(ts_daily, period, now)
+            requests_by_host = _requests_by_host(conn, period, segments)
+            # One all-hosts row per bucket, or the per-host rows until they are built
+            op = '=' if _read_meta(conn, 'all_hosts_rows', str, 'done') == 'done' else '!='
+            segments = [(table, f"{cond} AND host_id {op} ?", params + [ALL_HOSTS_ID])
+                        for table, cond, params in segments]
+        # (bucket epoch, visitors, latency, *TIMESERIES_COLUMNS counters)
+        counters = ', '.join(column for _, column in TIMESERIES_COLUMNS)
+        rows = []
+        for table, cond, params in segments:
+            key_col, seconds = _BUCKET_SECONDS[table]
+            rows.extend(conn.execute(
+                f"SELECT {key_col} * {seconds}, visitors, latency, {counters} FROM {table} WHERE {cond}", params
+            ).fetchall())
+        tops = [
+            _query_top(conn, segments, DIM_PATH, 10),
+            _query_top(conn, segments, DIM_UA, 5),
+            _query_top(conn, segments, DIM_COUNTRY, 10),
+        ]
+    except Exception as e:
+        print(f"Error querying stats for period={period}, host={host}: {e}")
+        return None
+    finally:
+        _release_conn(conn)
+
+    # One pass over the rows into preallocated per-point columns; the period's
+    # totals are the columns' sums.
+    labels = _window_labels(window)
+    columns = _new_columns(len(labels))
+    column_lists = [columns[name] for name, _ in TIMESERIES_COLUMNS]
+    ts_latency = {}  # point index -> latency blobs
+    earliest_ts = None
+
+    for bucket_ts, _, latency_blob, *counters in rows:
+        # The window's segments only cover [start, end)
+        point = (bucket_ts - window.start) // window.step
+        for values, counter in zip(column_lists, counters):
+            values[point] += counter
+        ts_latency.setdefault(point, []).append(latency_blob)
+        if earliest_ts is None or bucket_ts < earliest_ts:
+            earliest_ts = bucket_ts
+
+    timeseries = {'time': labels, **columns}
+
+    unique_visitors = HyperLogLog.merge_bytes(row[1] for row in rows).estimate()
+
+    # Latency: one histogram per timeseries point; the period's is their sum
+    latency_histograms = {key: LatencyHistogram.merge_bytes(blobs) for key, blobs in ts_latency.items()}
+    latency = LatencyHistogram()
+    for histogram in latency_histograms.values():
+        latency.merge(histogram)
+    # Columns keyed by percentile, aligned on timeseries["time"]; None where a point has no data
+    empty_latency = LatencyHistogram().percentiles_ms()
+    latency_timeseries = {name: [None] * len(labels) for name in empty_latency}
+    for point, histogram in latency_histograms.items():
+        for name, value in histogram.percentiles_ms().items():
+            latency_timeseries[name][point] = value
 
     # Top paths and UAs
-    top_paths = [
-        {"path": p, "count": c}
-        for p, c in sorted(path_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-    ]
-    top_user_agents = [
-        {"agent": u, "count": c}
-        for u, c in sorted(ua_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-    ]
-    top_countries = [
-        {"country": country, "count": c}
-        for country, c in sorted(country_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-    ]
+    top_paths = [{"path": p, "count": c} for p, c in tops[DIM_PATH]]
+    top_user_agents = [{"agent": u, "count": c} for u, c in tops[DIM_UA]]
+    top_countries = [{"country": country, "count": c} for country, c in tops[DIM_COUNTRY]]
 
     # Data period label
-    if earliest_bucket:
-        if 'T' in earliest_bucket:
-            dt_from = datetime.strptime(earliest_bucket, '%Y-%m-%dT%H').replace(
-                tzinfo=timezone.utc
-            )
-        else:
-            dt_from = datetime.strptime(earliest_bucket, '%Y-%m-%d').replace(
-                tzinfo=timezone.utc
-            )
+    if earliest_ts is not None:
+        dt_from = datetime.fromtimestamp(earliest_ts, tz=timezone.utc)
         data_from_utc = dt_from.strftime('%Y-%m-%d %H:%M:%S UTC')
     else:
         data_from_utc = "N/A"
 
+    summary = _summarize(columns, latency)
     return {
-        "total_requests": total_requests,
-        "requests_by_host": dict(
-            sorted(requests_by_host.items(), key=lambda x: x[1], reverse=True)[:7]
-        ),
-        "status_codes_dist": status_codes_dist,
+        "total_requests": summary["total_requests"],
+        "requests_by_host": requests_by_host,
+        "status_codes_dist": summary["status_codes_dist"],
         "top_paths": top_paths,
         "top_user_agents": top_user_agents,
         "top_countries": top_countries,
+        "unique_visitors": unique_visitors,
         "geoip_available": is_geoip_available(),
-        "avg_response_time_ms": (total_duration / total_requests * 1000) if total_requests else 0,
-        "avg_response_size_kb": (total_size / total_requests / 1024) if total_requests else 0,
-        "error_rate_percent": (error_count / total_requests * 100) if total_requests else 0,
-        "requests_timeseries": timeseries,
+        "avg_response_time_ms": summary["avg_response_time_ms"],
+        "latency_ms": summary["latency_ms"],
+        "avg_response_size_kb": summary["avg_response_size_kb"],
+        "error_rate_percent": summary["error_rate_percent"],
+        "timeseries": timeseries,
+        "latency_timeseries": latency_timeseries,
         "data_from_utc": data_from_utc,
         "data_to_utc": now.strftime('%Y-%m-%d %H:%M:%S UTC'),
         "period": period,
+        "range": _range_info(window),
         "host": host,
         "log_read_error": None,
     }
 
 
+def compare_hosts(hosts=None, period='7d', start=None, end=None, step=None):
+    """Stats of several hosts side by side, from one scan of their buckets: per
+    host the headline figures of get_stats() (requests, status mix, response
+    times and sizes, error rate) and timeseries columns aligned on the shared
+    "time" points. No top-N, visitors or per-host request split.
+
+    hosts: host names, at most MAX_COMPARE_HOSTS (None = the period's 10 busiest)
+    period, start, end, step: as for get_stats(). Raises ValueError.
+
+    Returns: dict with "hosts" (a list, in the order asked for or by requests)
+    and "unknown_hosts" (asked for but never seen in the logs). Cached like get_stats().
+    """
+    if hosts is not None:
+        hosts = list(dict.fromkeys(h for h in hosts if h))
+        if len(hosts) > MAX_COMPARE_HOSTS:
+            raise ValueError(f"at most {MAX_COMPARE_HOSTS} hosts can be compared")
+    period = _query_period(period, start, end)
+    if _db_path is None:
+        return _empty_comparison(period, hosts)
+
+    now = datetime.now(timezone.utc)
+    window, version = _query_window(period, start, end, step, now)
+    key = json.dumps(['compare', hosts, period, *window])
+    if version is not None:
+        cached = _query_cache.get(key, version)
+        if cached is not None:
+            cached['data_to_utc'] = now.strftime('%Y-%m-%d %H:%M:%S UTC')
+            return cached
+
+    comparison = _compute_comparison(hosts, period, now, window)
+    if comparison is None:
+        return _empty_comparison(period, hosts)
+    if version is not None:
+        _query_cache.put(key, version, comparison)
+    return comparison
+
+
+def _empty_comparison(period, hosts):
+    return {
+        "period": period,
+        "range": None,
+        "time": [],
+        "hosts": [],
+        "unknown_hosts": hosts or [],
+        "data_to_utc": "N/A",
+    }
+
+
+def _compute_comparison(hosts, period, now, window):
+    """compare_hosts() without the cache. None if stats.db could not be queried."""
+    conn = _read_conn()
+    try:
+        segments = _window_segments(window, None, _rollup_watermark(conn))
+        if hosts is None:
+            hosts = list(_requests_by_host(conn, period, segments, limit=10))
+        host_ids = dict(conn.execute(
+            f"SELECT host, host_id FROM hosts WHERE host IN ({','.join('?' * len(hosts))})", hosts
+        ).fetchall())
+        ids = list(host_ids.values())
+        # (host_id, bucket epoch, latency, *TIMESERIES_COLUMNS counters) of the
+        # selected hosts only: the (bucket, host_id) keys find their rows.
+        counters = ', '.join(column for _, column in TIMESERIES_COLUMNS)
+        rows = []
+        if ids:
+            for table, cond, params in segments:
+                key_col, seconds = _BUCKET_SECONDS[table]
+                rows.extend(conn.execute(
+                    f"SELECT host_id, {key_col} * {seconds}, latency, {counters} FROM {table} "
+                    f"WHERE {cond} AND host_id IN ({','.join('?' * len(ids))})",
+                    params + ids,
+                ).fetchall())
+    except Exception as e:
+        print(f"Error querying the comparison of {hosts} for period={period}: {e}")
+        return None
+    finally:
+        _release_conn(conn)
+
+    labels = _window_labels(window)
+    columns = {host_id: _new_columns(len(labels)) for host_id in ids}
+    column_lists = {host_id: [c[name] for name, _ in TIMESERIES_COLUMNS] for host_id, c in columns.items()}
+    latency_blobs = {host_id: [] for host_id in ids}
+    for host_id, bucket_ts, latency_blob, *row_counters in rows:
+        point = (bucket_ts - window.start) // window.step
+        for values, counter in zip(column_lists[host_id], row_counters):
+            values[point] += counter
+        latency_blobs[host_id].append(latency_blob)
+
+    return {
+        "period": period,
+        "range": _range_info(window),
+        "time": labels,
+        "hosts": [
+            {"host": host,
+             **_summarize(columns[host_ids[host]], LatencyHistogram.merge_bytes(latency_blobs[host_ids[host]])),
+             "timeseries": columns[host_ids[host]]}
+            for host in hosts if host in host_ids
+        ],
+        "unknown_hosts": [host for host in hosts if host not in host_ids],
+        "data_to_utc": now.strftime('%Y-%m-%d %H:%M:%S UTC'),
+    }
+
+
+def _live_snapshot():
+    """((seq, published_at), snapshot) of the live ring, or None while no ingester
+    has published one. The snapshot is only copied again once the writer has
+    published, and is shared by all the threads of this process."""
+    global _live_reader, _live_latest
+    if _live_path is None:
+        return None
+    with _live_lock:
+        if _live_reader is None or _live_reader.path != _live_path:
+            _live_reader = stats_live.LiveRingReader(_live_path)
+            _live_latest = None
+        version = _live_reader.version()
+        if version is None:
+            return None
+        if _live_latest is None or _live_latest[0] != version:
+            snapshot = _live_reader.snapshot()
+            _live_latest = (version, snapshot) if snapshot is not None else None
+        return _live_latest
+
+
+def get_live_stats(host=None, minutes=60):
+    """Per-minute stats of the last `minutes` minutes (at most stats_live.LIVE_MINUTES)
+    from the ingester's live ring; no SQLite query. See stats_live.summarize() for
+    the fields. Returns None while no ingester has published a ring."""
+    latest = _live_snapshot()
+    if latest is None:
+        return None
+    return stats_live.summarize(latest[1], host, minutes)
+
+
+def stream_live_deltas(host=None, max_seconds=LIVE_STREAM_MAX_SECONDS):
+    """Generator behind /api/stats/stream: yields (seq, delta) once the ingester
+    has published new entries since the last delta (see stats_live.delta()),
+    (None, None) after LIVE_STREAM_HEARTBEAT_SECONDS without any, and stops after
+    `max_seconds`. Entries published before the first call are not included.
+
+    Only the ring header is polled. A delta is computed when the consumer asks
+    for the next one, so a client that reads slowly gets fewer, larger deltas
+    and nothing queues up for it."""
+    deadline = time_module.monotonic() + max_seconds
+    latest = _live_snapshot()
+    previous = latest[1] if latest is not None else None
+    last_sent = time_module.monotonic()
+    while time_module.monotonic() < deadline:
+        latest = _live_snapshot()
+        if latest is not None and latest[1] is not previous:
+            if previous is None:
+                previous = latest[1]  # the ring just appeared: start from here
+            else:
+                changes = stats_live.delta(previous, latest[1], host)
+                previous = latest[1]
+                if changes['hosts']:
+                    yield latest[0][0], changes
+                    last_sent = time_module.monotonic()
+                    continue
+        if time_module.monotonic() - last_sent >= LIVE_STREAM_HEARTBEAT_SECONDS:
+            yield None, None
+            last_sent = time_module.monotonic()
+        time_module.sleep(LIVE_STREAM_POLL_SECONDS)
+
+
 def get_available_hosts():
     """Return a sorted list of all hosts that have stats data."""
     if _db_path is None:
         return []
 
-    conn = _get_conn()
+    conn = _read_conn()
     hosts = set()
     try:
-        for row in conn.execute("SELECT DISTINCT host FROM hourly_stats"):
-            hosts.add(row[0])
-        for row in conn.execute("SELECT DISTINCT host FROM daily_stats"):
+        for row in conn.execute(
+            "SELECT host FROM hosts WHERE host_id IN "
+            "(SELECT host_id FROM hourly_stats UNION SELECT host_id FROM daily_stats)"
+        ):
             hosts.add(row[0])
     except Exception:
         pass
     finally:
-        conn.close()
+        _release_conn(conn)
 
     return sorted(hosts)
 
@@ -898,12 +3154,277 @@ def has_data():
     if _db_path is None:
         return False
 
-    conn = _get_conn()
+    conn = _read_conn()
     try:
-        count = conn.execute("SELECT COALESCE(SUM(total), 0) FROM hourly_stats").fetchone()[0]
-        count += conn.execute("SELECT COALESCE(SUM(total), 0) FROM daily_stats").fetchone()[0]
-        return count > 0
+        # Stops at the first such row instead of summing the tables on every request
+        return bool(conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM hourly_stats WHERE total > 0) "
+            "OR EXISTS (SELECT 1 FROM daily_stats WHERE total > 0)"
+        ).fetchone()[0])
     except Exception:
         return False
     finally:
-        conn.close()
\ No newline at end of file
+        _release_conn(conn)
+
+# ---------------------------------------------------------------------------
+# Ingester (standalone process)
+# ---------------------------------------------------------------------------
+
+def _write_heartbeat():
+    """Record that the ingester is alive, so readers can tell stale data from idle logs."""
+    conn = _write_conn()
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [('ingester_heartbeat_ts', str(time_module.time())),
+             ('geoip_cache', json.dumps(geoip_cache_stats()))],
+        )
+        conn.commit()
+    finally:
+        _release_conn(conn)
+
+
+def get_ingest_status(log_file_path=None):
+    """Report how fresh the stats database is.
+
+    Returns a dict with:
+      - ingester_running: heartbeat seen within the last few intervals
+      - last_ingest_utc / seconds_since_ingest: last time new entries were committed
+      - last_entry_utc: timestamp of the newest log entry ingested
+      - bytes_behind: unread bytes in the access log (None if unknown)
+      - geoip_cache: the ingester's GeoIP cache counters as of its last heartbeat
+      - skipped_loggers: lines dropped by the logger filter, per logger name
+    """
+    status = {
+        "ingester_running": False,
+        "last_ingest_utc": None,
+        "seconds_since_ingest": None,
+        "last_entry_utc": None,
+        "bytes_behind": None,
+        "geoip_cache": None,
+        "skipped_loggers": {},
+    }
+    if _db_path is None:
+        return status
+
+    conn = _read_conn()
+    try:
+        meta = dict(conn.execute(
+            "SELECT key, value FROM meta WHERE key IN "
+            "('ingester_heartbeat_ts', 'last_ingest_ts', 'last_processed_ts', 'last_processed_offset', "
+            "'last_processed_inode', 'geoip_cache', 'skipped_loggers')"
+        ).fetchall())
+    except Exception:
+        meta = {}
+    finally:
+        _release_conn(conn)
+
+    def _float(key):
+        try:
+            return float(meta[key])
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    now = time_module.time()
+    heartbeat = _float('ingester_heartbeat_ts')
+    if heartbeat is not None:
+        status["ingester_running"] = (now - heartbeat) < 3 * HEARTBEAT_INTERVAL_SECONDS
+    last_ingest = _float('last_ingest_ts')
+    if last_ingest is not None:
+        status["last_ingest_utc"] = datetime.fromtimestamp(last_ingest, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        status["seconds_since_ingest"] = max(0, int(now - last_ingest))
+    for key in ('geoip_cache', 'skipped_loggers'):
+        try:
+            status[key] = json.loads(meta[key])
+        except (KeyError, ValueError, TypeError):
+            pass
+    last_entry = _float('last_processed_ts')
+    if last_entry:
+        status["last_entry_utc"] = datetime.fromtimestamp(last_entry, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+    if log_file_path is not None:
+        offset = _float('last_processed_offset') or 0
+        inode = _float('last_processed_inode')
+        try:
+            st = Path(log_file_path).stat()
+            # A different or smaller file has been rotated in: all of it is pending.
+            rotated = (inode is not None and st.st_ino != int(inode)) or st.st_size < offset
+            status["bytes_behind"] = int(st.st_size) if rotated else int(st.st_size - offset)
+        except OSError:
+            pass
+
+    return status
+
+
+def run_ingester(log_file_path, interval=INGEST_INTERVAL_SECONDS, geoip_db_path=None, stop_event=None,
+                 batch_lines=stats_tailer.BATCH_LINES, batch_ms=stats_tailer.BATCH_MS, use_inotify=True):
+    """Tail the access log forever: ingest new entries as soon as Caddy writes
+    them and roll up old buckets on their own schedule. Meant to run as its own
+    process (supervisord program `statsingester`), never inside a web request.
+
+    The log is watched with inotify when available, else polled at most every
+    `interval` seconds (more often while it is busy). Writes are coalesced into
+    micro-batches of about `batch_lines` lines or `batch_ms` milliseconds.
+
+    Entries are also counted per minute in the live ring (get_live_stats).
+
+    stop_event: optional threading.Event; the loop exits once it is set."""
+    global _live_writer
+    if _db_path is None:
+        raise RuntimeError("Stats DB not initialized. Call init_stats_db() first.")
+
+    try:
+        _live_writer = stats_live.LiveRingWriter(_live_path)
+    except (OSError, ValueError) as e:
+        print(f"Stats ingester: live ring {_live_path} unavailable ({e}), continuing without it")
+    watcher = stats_tailer.LogWatcher(log_file_path, batch_lines=batch_lines, batch_ms=batch_ms,
+                                      max_poll=interval, use_inotify=use_inotify)
+    print(f"Stats ingester: watching {log_file_path} ({watcher.mode}, batches of {batch_lines} lines"
+          f" / {batch_ms} ms, db {_db_path})")
+    try:
+        _ingester_loop(watcher, log_file_path, geoip_db_path, stop_event)
+    finally:
+        watcher.close()
+        close_connections()
+        if _live_writer is not None:
+            _live_writer.close()
+            _live_writer = None
+
+
+def _ingester_loop(watcher, log_file_path, geoip_db_path, stop_event):
+    last_heartbeat = 0.0
+    last_wal_checkpoint = time_module.monotonic()
+    unreported = 0  # entries since the last log message; batches are too frequent to log each
+    while stop_event is None or not stop_event.is_set():
+        _maybe_reload_geoip(geoip_db_path)
+
+        caught_up = True
+        if _layout_migration_pending:
+            try:
+                caught_up = migrate_text_layout(max_seconds=ROLLUP_STEP_SECONDS)
+                if caught_up:
+                    print("Stats ingester: layout migration done.")
+            except Exception as e:
+                print(f"Stats ingester: error during layout migration: {e}")
+
+        # Nothing is ingested into the old layout: the log waits at its offset
+        if not _text_layout:
+            try:
+                processed = process_new_logs(log_file_path)
+                watcher.ingested(processed)
+                unreported += processed
+            except Exception as e:
+                print(f"Stats ingester: error processing new logs: {e}")
+
+            try:
+                caught_up = rollup_old_buckets(max_seconds=ROLLUP_STEP_SECONDS) and caught_up
+            except Exception as e:
+                print(f"Stats ingester: error during rollup: {e}")
+            try:
+                caught_up = build_all_hosts_rows(max_seconds=ROLLUP_STEP_SECONDS) and caught_up
+            except Exception as e:
+                print(f"Stats ingester: error building all-hosts rows: {e}")
+            try:
+                refresh_host_totals()  # throttled internally
+            except Exception as e:
+                print(f"Stats ingester: error refreshing host totals: {e}")
+
+        now = time_module.time()
+        if now - last_heartbeat >= HEARTBEAT_INTERVAL_SECONDS:
+            if unreported:
+                print(f"Stats: processed {unreported} new log entries.")
+                unreported = 0
+            try:
+                _write_heartbeat()
+                last_heartbeat = now
+            except Exception as e:
+                print(f"Stats ingester: could not write heartbeat: {e}")
+        if time_module.monotonic() - last_wal_checkpoint >= WAL_CHECKPOINT_INTERVAL_SECONDS:
+            try:
+                if not checkpoint_wal():
+                    print("Stats ingester: WAL checkpoint incomplete (readers busy), retrying next time.")
+                last_wal_checkpoint = time_module.monotonic()
+            except Exception as e:
+                print(f"Stats ingester: WAL checkpoint failed: {e}")
+
+        # Idle logs still wake us for the heartbeat, rollup and GeoIP reload;
+        # a rollup or migration that is catching up continues right away.
+        watcher.wait_for_data(HEARTBEAT_INTERVAL_SECONDS if caught_up else 0.05, stop_event)
+
+
+def _default_paths():
+    """Resolve the same default locations app.py uses, from the environment."""
+    app_data_dir = Path(os.environ.get('APP_DATA_DIR', '.')).resolve()
+    return {
+        'db': app_data_dir / 'stats.db',
+        'log_file': Path(os.environ.get('CADDY_ACCESS_LOG_FILE', '/var/log/caddy_panel/caddy_access.json.log')),
+        'geoip_db': os.environ.get('GEOIP_DB_PATH', str(app_data_dir / 'GeoLite2-Country.mmdb')),
+    }
+
+
+def main(argv=None):
+    """Command line entry point: python -m stats_aggregator {run,backfill,status}."""
+    import argparse
+
+    defaults = _default_paths()
+    parser = argparse.ArgumentParser(prog='python -m stats_aggregator', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=str(defaults['db']), help='Path to stats.db')
+    parser.add_argument('--log-file', default=str(defaults['log_file']), help='Caddy JSON access log to ingest')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='Continuously ingest the access log and roll up old buckets')
+    p_run.add_argument('--interval', type=float, default=INGEST_INTERVAL_SECONDS,
+                       help='Longest poll interval when inotify is not available')
+    p_run.add_argument('--batch-lines', type=int, default=stats_tailer.BATCH_LINES,
+                       help='Ingest once about this many new lines are waiting')
+    p_run.add_argument('--batch-ms', type=int, default=stats_tailer.BATCH_MS,
+                       help='... or once the first of them is this old')
+    p_run.add_argument('--poll', action='store_true', help='Poll the log instead of using inotify')
+    p_run.add_argument('--geoip-db', default=defaults['geoip_db'], help='GeoLite2-Country.mmdb to use if present')
+
+    p_backfill = sub.add_parser('backfill', help='Import history from the access log, its rotated backups and .gz archives')
+    p_backfill.add_argument('files', nargs='*', help='Log files to import (default: --log-file and its rotations)')
+    p_backfill.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    p_backfill.add_argument('--chunk-mb', type=int, default=BACKFILL_CHUNK_BYTES // (1024 * 1024),
+                            help='Size of the byte range handed to each worker')
+    p_backfill.add_argument('--geoip-db', default=defaults['geoip_db'], help='GeoLite2-Country.mmdb to use if present')
+
+    sub.add_parser('status', help='Print ingest lag as JSON')
+    sub.add_parser('migrate', help='Convert stats.db to the current layout now and VACUUM it')
+
+    args = parser.parse_args(argv)
+    init_stats_db(args.db)
+
+    if args.command == 'run':
+        stop_event = threading.Event()
+
+        def _stop(signum, frame):
+            print(f"Stats ingester: received signal {signum}, stopping.")
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+        run_ingester(args.log_file, interval=args.interval, geoip_db_path=args.geoip_db, stop_event=stop_event,
+                     batch_lines=args.batch_lines, batch_ms=args.batch_ms, use_inotify=not args.poll)
+        return 0
+
+    if args.command == 'backfill':
+        files = args.files or _default_backfill_files(args.log_file)
+        backfill(files, workers=args.workers, chunk_bytes=args.chunk_mb * 1024 * 1024, geoip_db_path=args.geoip_db)
+        return 0
+
+    if args.command == 'status':
+        print(json.dumps(get_ingest_status(args.log_file), indent=2))
+        return 0
+
+    if args.command == 'migrate':
+        migrate_text_layout()
+        before, after = compact_stats_db()
+        print(f"Stats DB: {before / 1048576:.1f} MiB -> {after / 1048576:.1f} MiB after VACUUM.")
+        return 0
+
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
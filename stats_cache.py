@@ -0,0 +1,93 @@
+"""
+CaddyPanel stats query cache
+
+get_stats() results shared by all web workers, so a page that several people
+keep open is aggregated once per change of stats.db instead of once per refresh.
+
+- One small SQLite file next to stats.db (not stats.db itself: the web workers
+  never take the ingester's write lock). One row per key, e.g. (period, host),
+  holding the JSON result and the version it was computed at.
+- A lookup is a hit only if the stored version equals the caller's current one
+  (stats_aggregator uses stats.db's write generation and the current hour), so
+  there is nothing to invalidate: a new version simply misses and overwrites.
+- At most `max_entries` rows; each put evicts the least recently written ones.
+- Each thread keeps its connection open (re-opened after a fork).
+- Errors (locked, corrupt or unwritable file) are reported and treated as a
+  miss. The cache can be deleted at any time.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time as time_module
+
+QUERY_CACHE_MAX_ENTRIES = 512
+_BUSY_TIMEOUT_SECONDS = 0.5
+
+
+class QueryCache:
+    """JSON values keyed by a string, each tagged with a version string."""
+
+    def __init__(self, path, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self._local = threading.local()  # .conn: (pid, connection)
+
+    def _connect(self):
+        cached = getattr(self._local, 'conn', None)
+        if cached is not None and cached[0] == os.getpid():
+            return cached[1]
+        conn = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT_SECONDS)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # losing the last writes only costs a recompute
+            conn.execute("""CREATE TABLE IF NOT EXISTS query_cache (
+                key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                written_at REAL NOT NULL,
+                value TEXT NOT NULL
+            )""")
+            conn.commit()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def _discard(self):
+        """Drop this thread's connection after an error; the next call reconnects."""
+        cached = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if cached is not None and cached[0] == os.getpid():
+            cached[1].close()
+
+    def get(self, key, version):
+        """The value stored for `key` at `version`, or None."""
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM query_cache WHERE key = ? AND version = ?", (key, version)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Stats query cache: read failed ({e}), not using it.")
+            self._discard()
+            return None
+
+    def put(self, key, version, value):
+        """Store `value` (JSON-serializable) for `key` at `version`."""
+        try:
+            conn = self._connect()
+            with conn:  # commits, or rolls back on error
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_cache (key, version, written_at, value) VALUES (?, ?, ?, ?)",
+                    (key, version, time_module.time(), json.dumps(value)),
+                )
+                conn.execute(
+                    "DELETE FROM query_cache WHERE key NOT IN "
+                    "(SELECT key FROM query_cache ORDER BY written_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Stats query cache: write failed ({e}), result not cached.")
+            self._discard()
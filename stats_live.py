@@ -0,0 +1,442 @@
+"""
+CaddyPanel live stats ring
+
+Per-minute counters for the last LIVE_MINUTES minutes, per host, so the
+dashboard can show a spike or a 5xx burst minutes after it started instead of
+once its hour is aggregated. Nothing here touches SQLite.
+
+- The ingester owns a LiveRingWriter: every ingested entry is added to an
+  in-process copy of the ring (one flat array of uint64, no dict per minute),
+  and publish() copies it into a small mmap'd file next to stats.db after each
+  ingest commit.
+- Web workers open the same file with a LiveRingReader and read a consistent
+  snapshot from the shared page cache: the header holds a sequence number that
+  is odd while a publish is in progress, and readers retry until it is even
+  and unchanged across their copy (a seqlock). One writer at a time.
+
+Layout (native byte order):
+- header: magic, minutes per host, host capacity, fields per cell, hosts in
+  use, sequence number, publish time
+- LIVE_MAX_HOSTS host name slots of _NAME_BYTES (STATS_LIVE_MAX_HOSTS in the
+  environment). A new host takes the slot of one with nothing left in the
+  ring; only when every slot is live is it counted under OTHER_HOST
+- per host, `minutes` cells of _FIELDS uint64: the epoch minute the cell holds
+  (0: empty), requests, status classes 1xx-5xx, bytes, summed duration in us,
+  and a _LATENCY_BINS-bin latency histogram (factor sqrt(2) per bin from 1 ms,
+  so percentiles are within about 20%). A cell is reset when its minute comes
+  round again.
+
+delta() turns two snapshots into what was added in between, per host, for the
+dashboard's event stream: the counters only grow between publishes, so the
+difference of two snapshots is exactly the entries ingested in between.
+"""
+
+import math
+import mmap
+import operator
+import os
+import struct
+import time as time_module
+from array import array
+
+LIVE_MINUTES = 180
+LIVE_MAX_HOSTS = int(os.environ.get('STATS_LIVE_MAX_HOSTS', 512))  # file pages of unused slots are never touched
+OTHER_HOST = '(other)'
+
+_MAGIC = b'CPLIVE01'
+_HEADER = struct.Struct('=8sIIIIQd')  # magic, minutes, max hosts, fields, hosts used, seq, published_at
+_SEQ_OFFSET = 24
+_HEADER_BYTES = 64
+_NAME_BYTES = 256
+
+# Cell fields
+_MINUTE, _TOTAL = 0, 1  # status class c (1-5) is field 1 + c
+_BYTES, _DURATION_US, _LATENCY = 7, 8, 9
+_LATENCY_BINS = 32  # bin i: (sqrt(2)^(i-1), sqrt(2)^i] ms; bin 0 also holds <= 1 ms
+_FIELDS = _LATENCY + _LATENCY_BINS
+_CELL_BYTES = _FIELDS * 8
+_READ_RETRIES = 100
+
+
+def _file_size(minutes, max_hosts):
+    return _HEADER_BYTES + max_hosts * (_NAME_BYTES + minutes * _CELL_BYTES)
+
+
+def _bin_ms(i):
+    """Representative duration of latency bin i: its geometric midpoint."""
+    return 2 ** ((i - 0.5) / 2) if i else 1.0
+
+
+class LiveRingWriter:
+    """Ingester side: add(...) per entry, publish() after each commit."""
+
+    def __init__(self, path, minutes=LIVE_MINUTES, max_hosts=LIVE_MAX_HOSTS):
+        self.path = str(path)
+        self.minutes = minutes
+        self.max_hosts = max_hosts
+        self._hosts = {}  # host name -> slot
+        self._cells = array('Q')
+        self._latest = 0  # newest minute added
+        self._last_minutes = []  # per slot, newest minute added
+        self._no_stale_until = 0  # no slot can be reclaimed before _latest reaches this
+        self._published_hosts = 0
+        self._renamed = set()  # reclaimed slots whose new name is not published yet
+        self._seq = 0
+        self._dirty = False
+        self._mm = None
+        self._open()
+
+    def _open(self):
+        size = _file_size(self.minutes, self.max_hosts)
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None:
+            if os.fstat(fd).st_size == size:
+                mm = mmap.mmap(fd, size)
+                os.close(fd)
+                if self._load(mm):
+                    self._mm = mm
+                    return
+                mm.close()
+            else:
+                os.close(fd)
+        # New file, or one with another layout: build it aside and swap it in,
+        # so readers never map a half-initialized file.
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, self.minutes, self.max_hosts, _FIELDS, 0, 0, 0.0))
+            f.truncate(size)
+        os.replace(tmp, self.path)
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _load(self, mm):
+        """Resume from a file with our layout (e.g. after an ingester restart)."""
+        magic, minutes, max_hosts, fields, used, seq, _ = _HEADER.unpack_from(mm)
+        if (magic, minutes, max_hosts, fields) != (_MAGIC, self.minutes, self.max_hosts, _FIELDS):
+            return False
+        if seq & 1:
+            seq += 1  # a writer died mid-publish: its cells are overwritten below anyway
+        for slot in range(used):
+            start = _HEADER_BYTES + slot * _NAME_BYTES
+            self._hosts[mm[start:start + _NAME_BYTES].rstrip(b'\0').decode('utf-8', 'replace')] = slot
+        start = _HEADER_BYTES + self.max_hosts * _NAME_BYTES
+        self._cells = array('Q', mm[start:start + used * self.minutes * _CELL_BYTES])
+        per_host = self.minutes * _FIELDS
+        self._last_minutes = [max(self._cells[i * per_host:(i + 1) * per_host:_FIELDS]) for i in range(used)]
+        self._latest = max(self._last_minutes, default=0)
+        self._no_stale_until = 0
+        self._renamed = set()
+        self._published_hosts = used
+        self._seq = seq
+        self._dirty = True
+        return True
+
+    def _slot(self, host):
+        """Slot for a host not seen yet; the last one is kept for OTHER_HOST.
+        Once all are taken, the host gets the slot of one with nothing left in
+        the ring, if any."""
+        if len(self._hosts) >= self.max_hosts - 1 and host != OTHER_HOST:
+            slot = self._reclaim(host)
+            if slot is not None:
+                return slot
+            slot = self._hosts.get(OTHER_HOST)
+            if slot is not None:
+                return slot
+            host = OTHER_HOST
+        slot = self._hosts[host] = len(self._hosts)
+        self._cells.frombytes(bytes(self.minutes * _CELL_BYTES))
+        self._last_minutes.append(0)
+        return slot
+
+    def _reclaim(self, host):
+        """Hand `host` the slot whose newest minute is older than the ring span,
+        or None if every slot still has minutes in the ring."""
+        if self._latest < self._no_stale_until:
+            return None
+        horizon = self._latest - self.minutes
+        other = self._hosts.get(OTHER_HOST)
+        oldest, slot = min(((m, i) for i, m in enumerate(self._last_minutes) if i != other), default=(None, None))
+        if slot is None:
+            return None
+        if oldest > horizon:
+            self._no_stale_until = oldest + self.minutes
+            return None
+        for name, i in self._hosts.items():
+            if i == slot:
+                del self._hosts[name]
+                break
+        self._hosts[host] = slot
+        per_host = self.minutes * _FIELDS
+        self._cells[slot * per_host:(slot + 1) * per_host] = array('Q', bytes(self.minutes * _CELL_BYTES))
+        self._last_minutes[slot] = 0
+        self._renamed.add(slot)
+        return slot
+
+    def add(self, ts, host, status, duration, size):
+        """Count one entry (epoch seconds, host, status code, duration in seconds, bytes)."""
+        minute = int(ts) // 60
+        minutes = self.minutes
+        if minute <= self._latest - minutes:
+            return  # older than the ring
+        slot = self._hosts.get(host)
+        if slot is None:
+            slot = self._slot(host)
+        cells = self._cells
+        base = (slot * minutes + minute % minutes) * _FIELDS
+        if cells[base] != minute:
+            if cells[base] > minute:
+                return  # the cell already holds a newer minute
+            cells[base:base + _FIELDS] = _EMPTY_CELL
+            cells[base] = minute
+            if minute > self._last_minutes[slot]:
+                self._last_minutes[slot] = minute
+                if minute > self._latest:
+                    self._latest = minute
+        cells[base + _TOTAL] += 1
+        if 100 <= status <= 599:
+            cells[base + 1 + status // 100] += 1
+        if size > 0:
+            cells[base + _BYTES] += size
+        if duration > 0.001:
+            cells[base + _DURATION_US] += int(duration * 1e6)
+            i = math.ceil(math.log2(duration * 1000) * 2)
+            cells[base + _LATENCY + (i if i < _LATENCY_BINS else _LATENCY_BINS - 1)] += 1
+        else:
+            if duration > 0:
+                cells[base + _DURATION_US] += int(duration * 1e6)
+            cells[base + _LATENCY] += 1
+        self._dirty = True
+
+    def publish(self):
+        """Copy the ring into the shared file (a no-op if nothing was added)."""
+        if not self._dirty:
+            return
+        mm = self._mm
+        used = len(self._hosts)
+        struct.pack_into('=Q', mm, _SEQ_OFFSET, self._seq + 1)  # odd: readers retry
+        for host, slot in self._hosts.items():
+            if slot >= self._published_hosts or slot in self._renamed:
+                start = _HEADER_BYTES + slot * _NAME_BYTES
+                mm[start:start + _NAME_BYTES] = host.encode('utf-8')[:_NAME_BYTES].ljust(_NAME_BYTES, b'\0')
+        start = _HEADER_BYTES + self.max_hosts * _NAME_BYTES
+        data = memoryview(self._cells).cast('B')
+        mm[start:start + len(data)] = data
+        self._seq += 2
+        _HEADER.pack_into(mm, 0, _MAGIC, self.minutes, self.max_hosts, _FIELDS, used, self._seq, time_module.time())
+        self._published_hosts = used
+        self._renamed = set()
+        self._dirty = False
+
+    def discard(self):
+        """Drop what was added since the last publish()."""
+        if self._dirty:
+            self._hosts = {}
+            self._cells = array('Q')
+            self._last_minutes = []
+            self._load(self._mm)
+            self._dirty = False
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+_EMPTY_CELL = array('Q', bytes(_CELL_BYTES))
+
+
+class LiveRingReader:
+    """Web worker side: snapshot() maps the ring file on first use and again
+    whenever the writer replaced it."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._mm = None
+        self._ino = None
+
+    def _map(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.close()
+            return None
+        if self._mm is None or st.st_ino != self._ino or len(self._mm) != st.st_size:
+            self.close()
+            if st.st_size < _HEADER_BYTES:
+                return None
+            with open(self.path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._ino = st.st_ino
+        return self._mm
+
+    def snapshot(self):
+        """({host: cells of that host}, minutes, publish time), or None if there is no ring yet."""
+        mm = self._map()
+        if mm is None:
+            return None
+        for _ in range(_READ_RETRIES):
+            magic, minutes, max_hosts, fields, used, seq, published_at = _HEADER.unpack_from(mm)
+            if magic != _MAGIC or fields != _FIELDS or len(mm) != _file_size(minutes, max_hosts):
+                return None
+            if seq & 1:
+                time_module.sleep(0.001)
+                continue
+            names = mm[_HEADER_BYTES:_HEADER_BYTES + used * _NAME_BYTES]
+            start = _HEADER_BYTES + max_hosts * _NAME_BYTES
+            cells = array('Q', mm[start:start + used * minutes * _CELL_BYTES])
+            if struct.unpack_from('=Q', mm, _SEQ_OFFSET)[0] != seq:
+                continue
+            per_host = minutes * _FIELDS
+            hosts = {
+                names[i * _NAME_BYTES:(i + 1) * _NAME_BYTES].rstrip(b'\0').decode('utf-8', 'replace'):
+                    cells[i * per_host:(i + 1) * per_host]
+                for i in range(used)
+            }
+            return hosts, minutes, published_at
+        return None
+
+    def version(self):
+        """(sequence number, publish time) of the ring without copying it, or
+        None if there is no ring yet. Changes whenever the writer publishes."""
+        mm = self._map()
+        if mm is None:
+            return None
+        magic, _, _, _, _, seq, published_at = _HEADER.unpack_from(mm)
+        return (seq, published_at) if magic == _MAGIC else None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            self._ino = None
+
+
+def _percentile_ms(histogram, total, q):
+    rank = q * (total - 1)
+    seen = 0
+    for i, c in enumerate(histogram):
+        seen += c
+        if seen > rank:
+            return round(_bin_ms(i), 1)
+    return None
+
+
+def summarize(snapshot, host=None, minutes=60, now=None):
+    """Per-minute series and totals of the last `minutes` minutes (up to and
+    including the current one) from a LiveRingReader snapshot, for one host or
+    all of them."""
+    hosts, ring_minutes, published_at = snapshot
+    minutes = max(1, min(minutes, ring_minutes))
+    now_minute = int(time_module.time() if now is None else now) // 60
+    first = now_minute - minutes + 1
+    window = [(i, minute, (minute % ring_minutes) * _FIELDS) for i, minute in enumerate(range(first, now_minute + 1))]
+
+    series = [[0] * _FIELDS for _ in range(minutes)]
+    requests_by_host = {}
+    for name, cells in hosts.items():
+        if host and name != host:
+            continue
+        host_total = 0
+        for i, minute, base in window:
+            if cells[base] == minute:
+                series[i] = list(map(operator.add, series[i], cells[base:base + _FIELDS]))
+                host_total += cells[base + _TOTAL]
+        if host_total:
+            requests_by_host[name] = host_total
+
+    totals = [sum(column) for column in zip(*series)]
+    timeseries = []
+    for i, row in enumerate(series):
+        total = row[_TOTAL]
+        histogram = row[_LATENCY:]
+        timeseries.append({
+            'time': time_module.strftime('%Y-%m-%d %H:%M', time_module.gmtime((first + i) * 60)),
+            'count': total,
+            'status_5xx': row[6],
+            'bytes': row[_BYTES],
+            'p50': _percentile_ms(histogram, total, 0.5) if total else None,
+            'p95': _percentile_ms(histogram, total, 0.95) if total else None,
+            'p99': _percentile_ms(histogram, total, 0.99) if total else None,
+        })
+
+    total = totals[_TOTAL]
+    histogram = totals[_LATENCY:]
+    return {
+        'minutes': minutes,
+        'host': host,
+        'total_requests': total,
+        'requests_by_host': dict(sorted(requests_by_host.items(), key=lambda x: x[1], reverse=True)[:7]),
+        'status_codes_dist': {f'{c}xx': totals[1 + c] for c in range(1, 6)},
+        'error_rate_percent': (totals[6] / total * 100) if total else 0,
+        'avg_response_time_ms': (totals[_DURATION_US] / total / 1000) if total else 0,
+        'latency_ms': {name: _percentile_ms(histogram, total, q) if total else None
+                       for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+        'bytes': totals[_BYTES],
+        'timeseries': timeseries,
+        'published_utc': (time_module.strftime('%Y-%m-%d %H:%M:%S UTC', time_module.gmtime(published_at))
+                          if published_at else None),
+    }
+
+
+def delta(previous, current, host=None):
+    """What the ingester added between two snapshots of the ring, for one host
+    or all of them:
+
+        {'published_utc': ..., 'hosts': {host: {'requests', 'status_codes_dist',
+         'bytes', 'avg_response_time_ms', 'latency_ms', 'minutes'}}}
+
+    'minutes' lists [epoch minute, requests, 1xx, 2xx, 3xx, 4xx, 5xx, bytes,
+    summed duration in ms] of each minute that changed, oldest first; hosts
+    without new entries are left out. A cell that went back (the ring file was
+    recreated) counts in full."""
+    hosts, ring_minutes, published_at = current
+    old_hosts = previous[0] if previous is not None and previous[1] == ring_minutes else {}
+    changes = {}
+    for name, cells in hosts.items():
+        if host and name != host:
+            continue
+        old = old_hosts.get(name)
+        if old is not None and old == cells:
+            continue
+        rows = []
+        histogram = [0] * _LATENCY_BINS
+        for base in range(0, ring_minutes * _FIELDS, _FIELDS):
+            minute = cells[base]
+            if not minute:
+                continue
+            if old is not None and old[base] == minute:
+                if old[base + _TOTAL] == cells[base + _TOTAL]:
+                    continue
+                diff = list(map(operator.sub, cells[base:base + _FIELDS], old[base:base + _FIELDS]))
+                if min(diff) < 0:
+                    diff = list(cells[base:base + _FIELDS])
+            else:
+                diff = list(cells[base:base + _FIELDS])
+            if not diff[_TOTAL]:
+                continue
+            rows.append([minute, *diff[_TOTAL:_DURATION_US], round(diff[_DURATION_US] / 1000, 1)])
+            histogram = list(map(operator.add, histogram, diff[_LATENCY:]))
+        if not rows:
+            continue
+        rows.sort()
+        total = sum(row[1] for row in rows)
+        changes[name] = {
+            'requests': total,
+            'status_codes_dist': {f'{c}xx': sum(row[1 + c] for row in rows) for c in range(1, 6)},
+            'bytes': sum(row[7] for row in rows),
+            'avg_response_time_ms': sum(row[8] for row in rows) / total,
+            'latency_ms': {label: _percentile_ms(histogram, total, q)
+                           for label, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+            'minutes': rows,
+        }
+    return {
+        'published_utc': (time_module.strftime('%Y-%m-%d %H:%M:%S UTC', time_module.gmtime(published_at))
+                          if published_at else None),
+        'hosts': changes,
+    }
@@ -0,0 +1,413 @@
+"""
+CaddyPanel stats sketches
+
+Fixed-size summaries kept per stats bucket instead of exact data, chosen so
+that summaries of neighbouring buckets can be merged without losing their
+error guarantees (ingest batches -> hour, hours -> day, days -> query period).
+
+SpaceSaving: heavy hitters (top paths, user agents, countries).
+- At most `capacity` counters. counts[key] never underestimates the key's true
+  count and overestimates it by at most errors[key]; a key without a counter
+  occurred at most `floor` times.
+- With N events summarized (across any number of merges), errors and floor are
+  at most N / capacity, so every key seen more than N / capacity times has a
+  counter, and the counters rank the heavy hitters correctly up to that error.
+- Merging credits every key missing from one summary with that summary's floor
+  (the mergeable Space-Saving rule), then keeps the `capacity` largest counters.
+- to_bytes()/from_bytes(): compact varint encoding, used to ship summaries from
+  backfill worker processes.
+
+HyperLogLog: distinct count (unique client IPs).
+- 2^p one-byte registers (p = 11: 2 KB), standard error 1.04 / sqrt(2^p), about
+  2.3%, at any cardinality; linear counting takes over for small counts.
+- Merging takes the register-wise maximum, so the union of any buckets, hosts
+  or periods is estimated as accurately as a single bucket.
+- to_bytes(): registers, or (index, value) pairs while fewer than a third of
+  them are set, so quiet buckets stay small. Never more than 2^p + 1 bytes.
+
+LatencyHistogram: request durations (DDSketch-style logarithmic bins).
+- Bin i holds durations in (gamma^(i-1), gamma^i] with gamma = 1.02 / 0.98, so
+  every quantile is reported within 2% of a duration that really occurred at
+  that rank. Durations outside 1 us .. 1000 s land in the edge bins; the
+  maximum is kept exactly.
+- Merging adds bin counts: a merged histogram is exactly the histogram of
+  all the merged requests, at any level of rollup.
+- to_bytes(): the counts of the occupied bin range as 16- or 32-bit integers,
+  typically 200-500 bytes for an hour of one host.
+"""
+
+import bisect
+import hashlib
+import itertools
+import math
+import operator
+import re
+import struct
+import sys
+from array import array
+
+
+HLL_PRECISION = 11
+_SPARSE = 0x80  # flag on the precision byte of a serialized HyperLogLog
+_INV_POW2 = [2.0 ** -i for i in range(66)]
+_NONZERO = re.compile(rb'[^\x00]')
+
+LATENCY_ALPHA = 0.02  # relative accuracy of LatencyHistogram quantiles
+_GAMMA = (1 + LATENCY_ALPHA) / (1 - LATENCY_ALPHA)
+_LOG_GAMMA = math.log(_GAMMA)
+_INV_LOG_GAMMA = 1 / _LOG_GAMMA
+_MIN_BIN = math.floor(math.log(1e-6) / _LOG_GAMMA)
+_MAX_BIN = math.ceil(math.log(1000.0) / _LOG_GAMMA)
+_NUM_BINS = _MAX_BIN - _MIN_BIN + 1
+_WIDE_COUNTS = 0x01  # LatencyHistogram.to_bytes() flag: counts are uint32, not uint16
+_LATENCY_HEADER = struct.Struct('<BHHQd')  # flags, first bin, bin count, zeros, max
+_LANE = 8  # bytes per bin while merging serialized histograms (see merge_bytes)
+
+
+def _put_varint(out, value):
+    """Append unsigned LEB128 `value` to bytearray `out`."""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    """Decode an unsigned LEB128 at data[pos]; returns (value, next pos)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class SpaceSaving:
+    """Space-Saving summary with at most `capacity` (key -> count, error) counters."""
+
+    __slots__ = ('capacity', 'counts', 'errors', 'floor')
+
+    def __init__(self, capacity, counts=None, errors=None, floor=0):
+        self.capacity = capacity
+        self.counts = dict(counts) if counts else {}
+        self.errors = dict(errors) if errors else {}
+        for key in self.counts:
+            self.errors.setdefault(key, 0)
+        self.floor = floor
+        self._trim()
+
+    @classmethod
+    def from_counts(cls, counts, capacity):
+        """Summary of exact {key: count} data."""
+        sketch = cls(capacity)
+        sketch.update(counts)
+        return sketch
+
+    def __len__(self):
+        return len(self.counts)
+
+    def estimate(self, key):
+        """Upper bound of the key's count."""
+        return self.counts.get(key, self.floor)
+
+    def update(self, counts):
+        """Add exact {key: count} data (e.g. one ingest batch)."""
+        mine = self.floor
+        own, errors = self.counts, self.errors
+        for key, count in counts.items():
+            if key in own:
+                own[key] += count
+            else:
+                own[key] = count + mine
+                errors[key] = mine
+        self._trim()
+
+    def merge(self, other):
+        """Add another summary (of disjoint events) to this one."""
+        mine, theirs = self.floor, other.floor
+        own, errors = self.counts, self.errors
+        if theirs:
+            for key in own.keys() - other.counts.keys():
+                own[key] += theirs
+                errors[key] += theirs
+        for key, count in other.counts.items():
+            if key in own:
+                own[key] += count
+                errors[key] += other.errors[key]
+            else:
+                own[key] = count + mine
+                errors[key] = other.errors[key] + mine
+        self.floor = mine + theirs
+        self._trim()
+
+    def _trim(self):
+        if len(self.counts) <= self.capacity:
+            return
+        ranked = sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))
+        for key, _ in ranked[self.capacity:]:
+            del self.counts[key]
+            del self.errors[key]
+        self.floor = max(self.floor, ranked[self.capacity][1])
+
+    def top(self, n=None):
+        """[(key, count, error), ...] by descending count, at most n entries."""
+        ranked = sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))
+        if n is not None:
+            ranked = ranked[:n]
+        return [(key, count, self.errors[key]) for key, count in ranked]
+
+    def to_bytes(self):
+        out = bytearray()
+        for value in (self.capacity, self.floor, len(self.counts)):
+            _put_varint(out, value)
+        for key, count in self.counts.items():
+            raw = key.encode('utf-8', 'surrogatepass')
+            _put_varint(out, len(raw))
+            out += raw
+            _put_varint(out, count)
+            _put_varint(out, self.errors[key])
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        capacity, pos = _get_varint(data, 0)
+        floor, pos = _get_varint(data, pos)
+        n, pos = _get_varint(data, pos)
+        sketch = cls(capacity, floor=floor)
+        for _ in range(n):
+            length, pos = _get_varint(data, pos)
+            key = data[pos:pos + length].decode('utf-8', 'surrogatepass')
+            pos += length
+            sketch.counts[key], pos = _get_varint(data, pos)
+            sketch.errors[key], pos = _get_varint(data, pos)
+        return sketch
+
+    def __eq__(self, other):
+        return (isinstance(other, SpaceSaving) and self.capacity == other.capacity
+                and self.floor == other.floor and self.counts == other.counts
+                and self.errors == other.errors)
+
+    def __repr__(self):
+        return f"SpaceSaving(capacity={self.capacity}, floor={self.floor}, top={self.top(3)})"
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2^p registers."""
+
+    __slots__ = ('p', 'registers')
+
+    def __init__(self, p=HLL_PRECISION, registers=None):
+        self.p = p
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << p)
+
+    def add(self, value):
+        """Count a string (e.g. an IP address)."""
+        digest = hashlib.blake2b(value.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+        self.add_hash(int.from_bytes(digest, 'big'))
+
+    def add_hash(self, h):
+        """Count a uniformly distributed 64-bit hash."""
+        rest_bits = 64 - self.p
+        index = h >> rest_bits
+        rank = rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Union with another HyperLogLog of the same precision."""
+        if other.p != self.p:
+            raise ValueError(f"cannot merge HyperLogLog p={other.p} into p={self.p}")
+        self.registers = _max_registers(self.registers, other.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        harmonic = sum(map(_INV_POW2.__getitem__, self.registers))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / harmonic
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting
+        return int(round(estimate))
+
+    def to_bytes(self):
+        registers = self.registers
+        m = len(registers)
+        if m - registers.count(0) < m // 3:
+            out = bytearray([self.p | _SPARSE])
+            for match in _NONZERO.finditer(registers):
+                index = match.start()
+                out += bytes((index >> 8, index & 0xff, registers[index]))
+            return bytes(out)
+        return bytes([self.p]) + bytes(registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        sketch = cls(data[0] & ~_SPARSE)
+        _load_registers(sketch.registers, data)
+        return sketch
+
+    @classmethod
+    def merge_bytes(cls, blobs, p=HLL_PRECISION):
+        """Union of serialized HyperLogLogs (None entries are skipped)."""
+        sketch = cls(p)
+        dense = 0  # dense register arrays are merged as one big integer
+        for data in blobs:
+            if not data:
+                continue
+            if data[0] & ~_SPARSE != p:
+                raise ValueError(f"cannot merge HyperLogLog p={data[0] & ~_SPARSE} into p={p}")
+            if data[0] & _SPARSE:
+                _load_registers(sketch.registers, data)
+            else:
+                dense = _max_ints(dense, int.from_bytes(data[1:], 'little'), len(data) - 1)
+        if dense:
+            sketch.registers = _max_registers(sketch.registers, dense.to_bytes(1 << p, 'little'))
+        return sketch
+
+    def __eq__(self, other):
+        return isinstance(other, HyperLogLog) and self.p == other.p and self.registers == other.registers
+
+    def __repr__(self):
+        return f"HyperLogLog(p={self.p}, estimate={self.estimate()})"
+
+
+def _load_registers(registers, data):
+    """Max the registers serialized in `data` into bytearray `registers`."""
+    if not data[0] & _SPARSE:
+        registers[:] = _max_registers(registers, data[1:])
+        return
+    for i in range(1, len(data), 3):
+        index = data[i] << 8 | data[i + 1]
+        if data[i + 2] > registers[index]:
+            registers[index] = data[i + 2]
+
+
+_HIGH_BITS = {}
+
+
+def _max_ints(a, b, size):
+    """Byte-wise maximum of two little-endian `size`-byte register arrays held as
+    ints. Registers are below 128, so (a | 0x80..) - b never borrows across bytes
+    and leaves the high bit of each byte set exactly where a >= b."""
+    high = _HIGH_BITS.get(size)
+    if high is None:
+        high = _HIGH_BITS[size] = int.from_bytes(b'\x80' * size, 'little')
+    a_wins = ((((a | high) - b) & high) >> 7) * 0xff
+    return (a & a_wins) | (b & ~a_wins)
+
+
+def _max_registers(a, b):
+    size = len(a)
+    merged = _max_ints(int.from_bytes(a, 'little'), int.from_bytes(b, 'little'), size)
+    return bytearray(merged.to_bytes(size, 'little'))
+
+
+class LatencyHistogram:
+    """Mergeable histogram of durations in seconds (see module docstring)."""
+
+    __slots__ = ('counts', 'zeros', 'max')
+
+    def __init__(self):
+        self.counts = [0] * _NUM_BINS  # bin _MIN_BIN + i
+        self.zeros = 0  # durations <= 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > 0:
+            i = math.ceil(math.log(seconds) * _INV_LOG_GAMMA) - _MIN_BIN
+            if i < 0:
+                i = 0
+            elif i >= _NUM_BINS:
+                i = _NUM_BINS - 1
+            self.counts[i] += 1
+            if seconds > self.max:
+                self.max = seconds
+        else:
+            self.zeros += 1
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.counts)
+
+    def merge(self, other):
+        self.counts = list(map(operator.add, self.counts, other.counts))
+        self.zeros += other.zeros
+        if other.max > self.max:
+            self.max = other.max
+
+    def quantiles(self, qs):
+        """Durations in seconds at quantiles `qs` (each 0..1), all None if empty."""
+        cumulative = list(itertools.accumulate(self.counts, initial=self.zeros))
+        total = cumulative[-1]
+        if not total:
+            return [None] * len(qs)
+        result = []
+        for q in qs:
+            i = bisect.bisect_right(cumulative, q * (total - 1))
+            # bin i - 1: its midpoint in relative terms, capped by the true maximum
+            result.append(0.0 if i == 0 else min(2 * _GAMMA ** (i - 1 + _MIN_BIN) / (_GAMMA + 1), self.max))
+        return result
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def percentiles_ms(self):
+        """{'p50', 'p90', 'p95', 'p99', 'max'} in milliseconds (None if empty)."""
+        values = self.quantiles((0.5, 0.9, 0.95, 0.99))
+        result = {name: None if value is None else round(value * 1000, 3)
+                  for name, value in zip(('p50', 'p90', 'p95', 'p99'), values)}
+        result['max'] = None if values[0] is None else round(self.max * 1000, 3)
+        return result
+
+    def to_bytes(self):
+        counts = self.counts
+        # Occupied bin range [lo, hi), found by stripping the zero bins' bytes in C.
+        raw = array('Q', counts).tobytes()
+        lo = (len(raw) - len(raw.lstrip(b'\0'))) // _LANE
+        hi = max(lo, _NUM_BINS - (len(raw) - len(raw.rstrip(b'\0'))) // _LANE)
+        wide = hi > lo and max(counts[lo:hi]) > 0xffff
+        occupied = array('I' if wide else 'H', counts[lo:hi])
+        if sys.byteorder != 'little':
+            occupied.byteswap()
+        header = _LATENCY_HEADER.pack(_WIDE_COUNTS if wide else 0, lo, hi - lo, self.zeros, self.max)
+        return header + occupied.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.merge_bytes((data,))
+
+    @classmethod
+    def merge_bytes(cls, blobs):
+        """Sum of serialized histograms (None entries are skipped). The bins are
+        added as one big integer with a 64-bit lane per bin, which no realistic
+        count overflows, instead of bin by bin."""
+        histogram = cls()
+        packed = 0
+        for data in blobs:
+            if not data:
+                continue
+            flags, lo, n, zeros, max_seconds = _LATENCY_HEADER.unpack_from(data)
+            width = 4 if flags & _WIDE_COUNTS else 2
+            lanes = bytearray(n * _LANE)
+            body = data[_LATENCY_HEADER.size:]
+            for b in range(width):
+                lanes[b::_LANE] = body[b::width]
+            packed += int.from_bytes(lanes, 'little') << (lo * _LANE * 8)
+            histogram.zeros += zeros
+            if max_seconds > histogram.max:
+                histogram.max = max_seconds
+        if packed:
+            counts = array('Q', packed.to_bytes(_NUM_BINS * _LANE, 'little'))
+            if sys.byteorder != 'little':
+                counts.byteswap()
+            histogram.counts = counts.tolist()
+        return histogram
+
+    def __eq__(self, other):
+        return (isinstance(other, LatencyHistogram) and self.counts == other.counts
+                and self.zeros == other.zeros and self.max == other.max)
+
+    def __repr__(self):
+        return f"LatencyHistogram(count={self.count}, {self.percentiles_ms()})"